@@ -0,0 +1,71 @@
+import os
+import sys
+import pymongo
+import argparse
+from pymongo import UpdateOne
+from socialcar.utils import GEOMETRY_FIELDS, geometry_fields
+
+MONGO_HOST = os.environ.get('MONGO_HOST', 'localhost')
+MONGO_PORT = int(os.environ.get('MONGO_PORT', 27017))
+MONGO_USERNAME = os.environ.get('MONGO_USERNAME', '')
+MONGO_PASSWORD = os.environ.get('MONGO_PASSWORD', '')
+
+#===============================================================================
+# add_geometry_fields ()
+#===============================================================================
+def add_geometry_fields(dbname, resource, batch_size, update_all):
+    # The 2dsphere indexes themselves are created by the server at startup
+    client = pymongo.MongoClient(MONGO_HOST, MONGO_PORT)
+    collection = client[dbname][resource]
+
+    paths = GEOMETRY_FIELDS[resource]
+    lookup = {} if update_all else { '$or': [ { field: {'$exists': False} } for field in paths ] }
+    projection = { path[0]: 1 for path in paths.values() }
+
+    updated = 0
+    requests = []
+    for item in collection.find(lookup, projection):
+        fields = geometry_fields(resource, item)
+        if fields:
+            requests.append(UpdateOne({'_id': item['_id']}, {'$set': fields}))
+        if len(requests) >= batch_size:
+            updated += collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        updated += collection.bulk_write(requests, ordered=False).modified_count
+    print('    %s: %d documents updated' % (resource, updated))
+
+#===============================================================================
+# create_arg_parser ()
+#===============================================================================
+def create_arg_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-b', '--batch-size', metavar='BATCH_SIZE', help="Number of documents updated with a single db request", type=int, default=1000)
+    parser.add_argument('-a', '--all', help="Recompute the GeoJSON fields of all documents, not only of those missing them", action='store_true')
+    parser.add_argument('dbname', metavar='DBNAME', help="Database name", type=str)
+    return parser
+
+#===============================================================================
+# main ()
+#===============================================================================
+def main():
+    parser = create_arg_parser()
+    # If script run without arguments, print syntax
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+
+    dbname = args.dbname
+    batch_size = args.batch_size
+
+    print('dbname:      %s' % (dbname))
+    print('batch_size:  %s' % (batch_size))
+    print(' * Adding GeoJSON fields to rides and lifts... * ')
+
+    for resource in sorted(GEOMETRY_FIELDS):
+        add_geometry_fields(dbname, resource, batch_size, args.all)
+
+if __name__ == '__main__':
+    main()
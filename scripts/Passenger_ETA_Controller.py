@@ -1,11 +1,10 @@
 import os
 import sys
 import pymongo
-import requests
 import argparse
 import time, datetime, threading
-from socialcar.utils import haversine_formula, str_to_oid, oid_to_str, remove_non_ascii
-from socialcar.settings import FCM_HOST, FCM_PORT, FCM_API_KEY
+from socialcar.utils import haversine_formula, str_to_oid, oid_to_str
+from socialcar.notifications import NotificationDispatcher
 
 MONGO_HOST = os.environ.get('MONGO_HOST', 'localhost')
 MONGO_PORT = int(os.environ.get('MONGO_PORT', 27017))
@@ -27,41 +26,32 @@ def calculate_eta(distance):
     #-----------------------------------------------------------------------
     return int((distance / MEAN_VELOCITY) * 60)
 
+#===============================================================================
+# users_finder ()
+#===============================================================================
+def users_finder(dbname):
+    client = pymongo.MongoClient(MONGO_HOST, MONGO_PORT)
+    users_collection = client[dbname][MONGO_USERS_COLLECTION]
+
+    def find_users(user_ids):
+        # All passengers of a batch of notifications are found with one query
+        cursor = users_collection.find({'_id': {'$in': user_ids}}, {'fcm_token': 1, 'platform': 1})
+        return { user['_id']: user for user in cursor }
+    return find_users
+
+notification_dispatcher = None
+
 #===============================================================================
 # send_push_notification ()
 #===============================================================================
 def send_push_notification(dbname, user_id, message):
-    client = pymongo.MongoClient(MONGO_HOST, MONGO_PORT)
-    db = client[dbname]
-    users_collection = db[MONGO_USERS_COLLECTION]
+    global notification_dispatcher
+    if notification_dispatcher is None:
+        notification_dispatcher = NotificationDispatcher(users_finder(dbname))
 
     message['type'] = 'eta'
     assert isinstance(message, dict)
-    
-    user = users_collection.find_one({'_id': user_id})
-    fcm_token = user['fcm_token']
-    platform = user['platform'] if 'platform' in user else 'ANDROID'
-
-    # if user platform is iOS send custom payload
-    if platform == 'IOS':
-        platform_url = 'FCMConnectorService/messaging/notification-message/send'
-        data_str = '%s' % (message)
-        data_str = remove_non_ascii(data_str)
-        data_title = "Sample_Title"
-        notification_title = "REQUEST_LIFT_TO_DRIVER_TITLE"
-        notification_body = "REQUEST_LIFT_TO_DRIVER_BODY"
-        data = 'to=%s&api_key=%s&notification_title=%s&notification_body=%s&data_title=%s&data_body=%s' % (fcm_token, FCM_API_KEY, notification_title, notification_body, data_title, data_str)
-    elif platform == 'ANDROID':
-        platform_url = 'FCMConnectorService/messaging/data-message/send'
-        data_str = '%s' % (message)
-        data_str = remove_non_ascii(data_str)
-        data = 'to=%s&api_key=%s&payload_data=%s' % (fcm_token, FCM_API_KEY, data_str)
-        
-    url = 'http://%s:%d/%s' % (FCM_HOST, FCM_PORT, platform_url)
-    headers = {'content-type': 'application/x-www-form-urlencoded'}
-    res = requests.post(url, data=data, headers=headers)
-    if res.status_code != 200:
-        app.logger.error("Error with notification (%s, \"%s\")" % (url, data))
+    return notification_dispatcher.submit(user_id, message)
 
 #===============================================================================
 # check_eta_notify ()
@@ -96,6 +86,10 @@ def check_eta_notify(dbname, radius, period):
         else:
             eta_notify_collection.remove(item['_id'])
 
+    # Wait for the notifications of this check to be delivered
+    if notification_dispatcher is not None:
+        notification_dispatcher.join()
+
 #===============================================================================
 # run_periodically ()
 #===============================================================================
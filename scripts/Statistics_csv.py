@@ -4,6 +4,7 @@ import pymongo
 import time, datetime
 import csv
 from operator import itemgetter
+from socialcar.utils import bounding_box_lookup
 
 MONGO_HOST = os.environ.get('MONGO_HOST', 'localhost')
 MONGO_PORT = int(os.environ.get('MONGO_PORT', 27017))
@@ -47,25 +48,12 @@ def user_activity_csv(dbname):
         bb_maxlat = site['bounding_box']['max_lat']
         bb_maxlon = site['bounding_box']['max_lon']
 
-        lookup_lifts1 = { '$and': [ { 'end_point.point.lat': { '$gte': bb_minlat } } , \
-                            { 'end_point.point.lat': { '$lte': bb_maxlat } } , \
-                            { 'end_point.point.lon': { '$gte': bb_minlon } } , \
-                            { 'end_point.point.lon': { '$lte': bb_maxlon } } ] }
-        lookup_lifts2 = { '$and': [ {'start_point.point.lat': {'$gte': bb_minlat } } , \
-                            { 'start_point.point.lat': { '$lte': bb_maxlat } } , \
-                            { 'start_point.point.lon': { '$gte': bb_minlon } } , \
-                            { 'start_point.point.lon': { '$lte': bb_maxlon } } ] }
-        lookup_lifts = { '$or': [ lookup_lifts1, lookup_lifts2 ] }
-
-        lookup_rides1 = { '$and': [ {'end_point.lat': { '$gte': bb_minlat } } , \
-                            { 'end_point.lat': { '$lte': bb_maxlat } } , \
-                            { 'end_point.lon': { '$gte': bb_minlon } } , \
-                            { 'end_point.lon': { '$lte': bb_maxlon } } ] }
-        lookup_rides2 = { '$and': [ {'start_point.lat': {'$gte': bb_minlat } } , \
-                            { 'start_point.lat': { '$lte': bb_maxlat } } , \
-                            { 'start_point.lon': { '$gte': bb_minlon } } , \
-                            { 'start_point.lon': { '$lte': bb_maxlon } } ] }
-        lookup_rides = { '$and': [ { 'lifts': { '$eq': [] } }, { '$or': [ lookup_rides1, lookup_rides2 ] } ] }
+        # Same items as comparing the lat/lon of their points, but found with
+        # the 2dsphere indexes; items missing their GeoJSON fields (not yet
+        # migrated with Geo_Index_Migration.py) are not counted
+        box = (bb_minlat, bb_minlon, bb_maxlat, bb_maxlon)
+        lookup_lifts = { '$or': [ bounding_box_lookup('lifts', 'end_geometry', *box), bounding_box_lookup('lifts', 'start_geometry', *box) ] }
+        lookup_rides = { '$and': [ { 'lifts': { '$eq': [] } }, { '$or': [ bounding_box_lookup('rides', 'end_geometry', *box), bounding_box_lookup('rides', 'start_geometry', *box) ] } ] }
 
         cursor_lifts = lifts_collection.find(lookup_lifts, { 'driver_id' : 1 , 'passenger_id' : 1 , 'status' : 1 , '_updated' : 1})
         cursor_rides = rides_collection.find(lookup_rides, { 'driver_id': 1, '_updated' : 1 })
@@ -217,15 +205,11 @@ def user_rating_csv(dbname):
         bb_minlon = site['bounding_box']['min_lon']
         bb_maxlat = site['bounding_box']['max_lat']
         bb_maxlon = site['bounding_box']['max_lon']
-        lookup1 = { '$and': [ {'end_point.point.lat': {'$gte': bb_minlat}} , \
-                            {'end_point.point.lat': {'$lte': bb_maxlat}} , \
-                            {'end_point.point.lon': {'$gte': bb_minlon}} , \
-                            {'end_point.point.lon': {'$lte': bb_maxlon}} ] }
-        lookup2 = { '$and': [ {'start_point.point.lat': {'$gte': bb_minlat}} , \
-                            {'start_point.point.lat': {'$lte': bb_maxlat}} , \
-                            {'start_point.point.lon': {'$gte': bb_minlon}} , \
-                            {'start_point.point.lon': {'$lte': bb_maxlon}} ] }
-        lookup_lifts = { '$or': [ lookup1, lookup2 ] }
+        # Same items as comparing the lat/lon of their points, but found with
+        # the 2dsphere indexes; items missing their GeoJSON fields (not yet
+        # migrated with Geo_Index_Migration.py) are not counted
+        box = (bb_minlat, bb_minlon, bb_maxlat, bb_maxlon)
+        lookup_lifts = { '$or': [ bounding_box_lookup('lifts', 'end_geometry', *box), bounding_box_lookup('lifts', 'start_geometry', *box) ] }
 
         cursor_lifts = lifts_collection.find(lookup_lifts, { '_id': 1, 'driver_id' : 1 , 'passenger_id' : 1 })
 
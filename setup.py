@@ -4,6 +4,7 @@ setup(
     name='socialcar',
     packages=[ 'socialcar' ],
     include_package_data=True,
+    package_data={ 'socialcar': [ 'tariffs.json' ] },
     install_requires=[
         'eve',
         'eve-docs',
@@ -3,17 +3,16 @@
 import os
 import re
 import time
-import json
+import copy
+import hashlib
 from collections import defaultdict
 import logging
 import logging.handlers
 import subprocess
-import requests
 import random
 import raven
 import bisect
 import random
-import threading
 from scripts.Statistics import STATISTICS_SCRIPT_FOLDER
 from scripts.Statistics import main as statistics_main
 from scripts.Statistics_csv import main as statisticsCSV_main
@@ -22,20 +21,39 @@ from eve.auth import BasicAuth, requires_auth
 from eve.utils import document_etag
 from eve_docs import eve_docs
 from eve.methods.post import post_internal
-from flask import abort, request, make_response, send_from_directory, Response, copy_current_request_context
+from flask import abort, request, g, make_response, send_from_directory, Response, \
+                  stream_with_context
 from flask_cors import CORS
 from flask_bootstrap import Bootstrap
 from functools import wraps
 from werkzeug.datastructures import ImmutableMultiDict
 from socialcar.settings import URL_PREFIX, API_VERSION, USE_SENTRY, SENTRY_DSN, \
-                               DEBUG, FCM_HOST, FCM_PORT, FCM_API_KEY, MONGO_DBNAME
+                               DEBUG, MONGO_DBNAME, \
+                               ROUTE_PLAN_CACHE, ROUTE_PLAN_CACHE_TTL, ROUTE_PLAN_CACHE_SIZE, \
+                               AUTH_CACHE_TTL, AUTH_CACHE_SIZE, LOG_SAMPLE_RATE, \
+                               RIDES_BOUNDARY_CACHE_TTL, RIDES_BOUNDARY_CACHE_SIZE, \
+                               RIDES_BOUNDARY_CACHE_BYTES, RIDES_BOUNDARY_CACHE_ENTRY_BYTES, \
+                               LOG_BODY_MAX_SIZE, LOG_EXCLUDED_RESOURCES, RESOURCE_SEARCH_FIELDS, \
+                               PAGINATION_DEFAULT, PAGINATION_LIMIT, QUERY_PAGE, QUERY_MAX_RESULTS, \
+                               QUERY_CURSOR, QUERY_FIELDS
 from socialcar.randomgen import random_trips
-from socialcar.utils import str_to_json, json_to_str, remove_fields, recursively_remove_fields, \
-                            objectids_to_strings, str_to_oid, oid_to_str, apply_function, \
-                            km2rad, rad2km, timestamp_to_datetime, inside_bounding_box, \
-                            remove_non_ascii, find_site_for_rides, waypoints_to_polyline, \
-                            haversine_formula, downsample_polyline
-from socialcar.fares import rail_fare, bus_fare, carpooling_fare, metro_fare, tram_fare
+from socialcar.sites import SiteRegistry, SiteCounters
+from socialcar.routeplanner import RoutePlannerClient, RoutePlannerError, RoutePlanCache
+from socialcar.cache import LRUCache, MongoCache, TieredCache
+from socialcar.notifications import NotificationDispatcher
+from socialcar.requestlog import AsyncLogHandler, truncate_body, log_record
+from pymongo import monitoring, ASCENDING
+from pymongo.errors import PyMongoError
+from socialcar.instrumentation import instrumentation, MongoCommandTimer, server_timing
+from socialcar.metrics import MetricsExporter
+from socialcar.utils import payload_to_json, json_to_payload, remove_fields, \
+                            clean_object, str_to_oid, oid_to_str, apply_function, \
+                            km2rad, rad2km, timestamp_to_datetime, \
+                            find_site_for_rides, waypoints_to_polyline, \
+                            haversine_formula, downsample_polyline, geometry_fields, \
+                            bounding_box_to_geometry, unindexed_search_fields, oid_to_cursor, \
+                            cursor_to_oid, widen_bounding_box
+from socialcar.fares import FareEngine, load_tariffs, compile_tariff
 from scripts.gtfs import route_type_to_text as EXTENDED_TRAVEL_MODES
 if USE_SENTRY:
     from raven.handlers.logging import SentryHandler
@@ -49,6 +67,17 @@ OCC_FIELD = '_occ'  # Optimistic Concurrency Control
 
 CUSTOM_ENDPOINTS = [ 'trips', 'rides_boundary', 'rides_internal', 'sites_boundary', 'reports_boundary', 'reports_around', 'stops', 'waiting_time', 'positions_button'  ]
 
+# Custom endpoints that return one page of items (see find_page()) if the
+# request has a 'cursor' or 'limit' query parameter
+PAGINATED_ENDPOINTS = [ 'rides_boundary', 'rides_internal', 'reports_boundary', 'stops' ]
+
+# Response header with the cursor of the next page of paginated requests
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+# Returned by set_custom_payload() if it has set the final response payload
+# itself (e.g. streamed or cached)
+PAYLOAD_SET = object()
+
 REQUIRED_PARAMS = {
     'trips': [ 'start_lat', 'start_lon', 'end_lat', 'end_lon',
                'start_date', 'end_date', 'use_bus', 'use_metro',
@@ -68,27 +97,61 @@ RADIUS = 5
 
 ALLOWED_TRAVEL_MODES = [ 'FEET', 'CAR_POOLING', 'METRO', 'BUS', 'RAIL', 'TRAM' ]
 
+# Ride used for carpooling legs of the Mobalt shuttle (they have no ride_id)
+MOBALT_RIDE_ID = '88e50050223f9badec44f5ff'
+
+# Fields added by Eve or the server that are never shown to clients (the
+# GeoJSON fields only exist to index the points of rides and lifts)
 EVE_EXTRA_FIELDS = [ '_created', '_updated', '_etag', '_links', '_deleted',
                      '_version', '_latest_version', '_status', OWNER_FIELD,
-                     OCC_FIELD ]
+                     OCC_FIELD, 'start_geometry', 'end_geometry' ]
 
 GET_VALUES_SEPARATOR = ','
 
-RESOURCE_SEARCH_FIELDS = {
-    'users': [ 'email', 'social_provider.social_id', 'social_provider.social_network' ],
-    'rides': [ 'driver_id' ],
-    'lifts': [ 'driver_id', 'passenger_id' ],
-    'feedbacks': [ 'role', 'reviewer_id', 'reviewed_id', 'date_$gt', 'lift_id' ],
-    'positions': [ 'user_id', 'timestamp_$gt', 'timestamp_$lt' ],
-    'destinations': [ 'user_id' ],
-    'sites': [ 'name' ],
-    'messages': [ 'sender_id', 'receiver_id', 'lift_id' ],
-}
-
 RESOURCE_GROUP_BY_FIELDS = {
     'positions': [ 'user_id' ],
 }
 
+# Fields of the items returned by custom endpoints. Only the fields of the
+# projection are fetched from the db: 'default' if the request has no 'fields'
+# query parameter, otherwise the fields it lists (e.g. fields=name,date). The
+# fields that may be listed are those of the schema of resource 'schema',
+# except Eve fields and the 'denied' ones, or else the 'allowed' ones (see
+# allowed_fields()). 'required' fields are always fetched, as the endpoint
+# needs them.
+CUSTOM_PROJECTIONS = {
+    'rides_boundary': {
+        'schema': 'rides',
+        # Maps only need the points of rides
+        'default': { 'polyline': 0, 'lifts': 0, 'extras': 0 },
+    },
+    'rides_internal': {
+        'schema': 'rides',
+        'default': {},
+    },
+    'sites_boundary': {
+        'schema': 'sites',
+        # E-mails of the users of the site
+        'denied': [ 'users' ],
+        'default': {},
+    },
+    'reports_boundary': {
+        'schema': 'reports',
+        'default': {},
+    },
+    'reports_around': {
+        'schema': 'reports',
+        'default': {},
+    },
+    'stops': {
+        # Stops are imported by GTFS-import.py and have no Eve schema
+        'allowed': [ 'stop_code', 'stop_name', 'transits' ],
+        'default': {},
+        # Converted to 'lon' and 'lat' by format_stop()
+        'required': [ 'loc' ],
+    },
+}
+
 AUTO_EMBED_FIELDS = {
     # These fields must have 'embeddable' = True in settings.py
     'rides': [ 'lifts' ]
@@ -142,8 +205,8 @@ def actual_resource(request):
 def response_set_error(response, status_code, msg):
     assert not 200 <= status_code < 300
     response.status_code = status_code
-    data = '{"_error": {"code": %d, "message": "%s"}}' % (status_code, msg)
-    response.set_data(data)
+    data = { '_error': { 'code': status_code, 'message': msg } }
+    response.set_data(json_to_payload(data))
 
 #===============================================================================
 # add_object_owner ()
@@ -186,11 +249,19 @@ def add_occ_field(items):
     for item in items if isinstance(items, list) else [ items ]:
         item[OCC_FIELD] = document_etag(item)
 
+#===============================================================================
+# add_geometry_fields ()
+#===============================================================================
+def add_geometry_fields(resource, items, original=None):
+    for item in items if isinstance(items, list) else [ items ]:
+        item.update(geometry_fields(resource, item, original))
+
 #===============================================================================
 # before_insert ()
 #===============================================================================
 def before_insert(resource, items):
     add_object_owner(resource, items)
+    add_geometry_fields(resource, items)
     add_occ_field(items)
 
 #===============================================================================
@@ -198,6 +269,7 @@ def before_insert(resource, items):
 #===============================================================================
 def before_update(resource, updates, original):
     add_object_owner(resource, [ updates ], original)
+    add_geometry_fields(resource, updates, original)
     add_occ_field(updates)
 
 #===============================================================================
@@ -205,6 +277,7 @@ def before_update(resource, updates, original):
 #===============================================================================
 def before_replace(resource, item, original):
     add_object_owner(resource, [ item ], original)
+    add_geometry_fields(resource, item)
     add_occ_field(item)
 
 #===============================================================================
@@ -433,6 +506,27 @@ def before_insert_rides(rides):
             ride['polyline'] = waypoints_to_polyline(coordinates)
         ride['polyline'] = downsample_polyline(ride['polyline'])
 
+#===============================================================================
+# check_site_tariffs ()
+#===============================================================================
+def check_site_tariffs(site, original=None):
+    # Tariffs overridden by a site must compile, or its trips could not be
+    # priced; overrides may refer to the default rules of the site
+    price_info = site.get('price_info') or {}
+    if 'tariffs' in price_info:
+        name = site.get('name', original['name'] if original else None)
+        try:
+            compile_tariff(fare_engine.tariffs.get(name, {}), price_info['tariffs'])
+        except ValueError as e:
+            abort(422, description='Invalid price_info.tariffs: %s' % (e))
+
+#===============================================================================
+# before_insert_sites ()
+#===============================================================================
+def before_insert_sites(sites):
+    for site in sites if isinstance(sites, list) else [ sites ]:
+        check_site_tariffs(site)
+
 #===============================================================================
 # before_delete_ride ()
 #===============================================================================
@@ -498,122 +592,154 @@ def after_insert_messages(messages):
         notification_thread_message(message['receiver_id'], message)
 
 #===============================================================================
-# remove_private_info ()
+# private_fields ()
 #===============================================================================
-def remove_private_info(item, resource, request):
+def private_fields(resource, request):
+    # Fields removed from the items of 'resource' returned to 'request'
     ############################################################################
     #### Temporary, unsecure hack to remove the password from /users endpoint
     ############################################################################
     if resource == 'users':
-        fields = [ 'password' ]
         if request.method == 'GET' and request.url.split('/')[-1] == 'users':
-            remove_fields(item, fields)
+            return [ 'password' ]
     ############################################################################
     #### Temporary, unsecure hack to return the password in case of sign in
     #### with social id! We should probably switch to a different auth scheme
     #### than Basic Auth which requires client always sending username/password
-    return
+    #### (the password should only be returned to POST requests and to the
+    #### user it belongs to)
     ############################################################################
-
-    if resource == 'users':
-        fields = [ 'password' ]
-        auth = request.authorization
-        if request.method == 'POST' or \
-           (auth and 'email' in item and item['email'] == auth['username']):
-            # User is authorized
-            return
-        else:
-            remove_fields(item, fields)
+    return []
 
 #===============================================================================
 # filter_data ()
 #===============================================================================
 def filter_data(resource, request, data):
-    apply_function(data, recursively_remove_fields, EVE_EXTRA_FIELDS)
-    apply_function(data, remove_private_info, resource, request)
+    # Eve fields and private fields are removed in a single walk
+    clean_object(data, EVE_EXTRA_FIELDS, private_fields(resource, request))
     return data
 
 #===============================================================================
-# finalize_payload ()
+# finalize_data ()
 #===============================================================================
-def finalize_payload(resource, request, response):
-    data = str_to_json(response.get_data())
+def finalize_data(resource, request, data):
     data = flatten_data(data)
     data = filter_data(resource, request, data)
     if isinstance(data, list):
         data = {
             resource: data
         }
-    response.set_data(json_to_str(data))
+    return data
+
+#===============================================================================
+# finalize_payload ()
+#===============================================================================
+def finalize_payload(resource, request, response):
+    data = payload_to_json(response.get_data())
+    response.set_data(json_to_payload(finalize_data(resource, request, data)))
 
 #===============================================================================
 # add_location_header ()
 #===============================================================================
-def add_location_header(resource, request, response):
+def add_location_header(resource, request, response, data):
+    # 'data' is the finalized payload of the response
     assert request.method == 'POST'
-    data = str_to_json(response.get_data())
     if 200 <= response.status_code <= 299:
         # Single item
         if resource not in data:
             response.headers.set('Location', '%s/%s' % (request.url, data['_id']))
         # List with one item
         elif resource in data and len(data) == 1 and len(data[resource]) == 1:
-            response.headers.set('Location', '%s/%s' % (request.url, data[0]['_id']))
+            response.headers.set('Location', '%s/%s' % (request.url, data[resource][0]['_id']))
         # Multiple items were created, cannot set 'Location' header
         else:
             pass
-    response.set_data(json_to_str(data))
 
 #===========================================================================
-# post_process_trip ()
+# find_many ()
+#===========================================================================
+def find_many(resource, ids, projection=None):
+    # Fetch with a single query all items of 'resource' with the given ids
+    # (ObjectIds or strings); returns a dict of the items found by _id. Items
+    # are memoized until the end of the request, so they are fetched only once
+    # even if several post-processing functions need them.
+    if getattr(g, 'found_items', None) is None:
+        g.found_items = {}
+    key = (resource, tuple(sorted(projection.items())) if projection else None)
+    found = g.found_items.setdefault(key, {})
+
+    oids = set(str_to_oid(_id) if isinstance(_id, str) else _id for _id in ids)
+    missing = [ oid for oid in oids if oid not in found ]
+    if missing:
+        for oid in missing:
+            found[oid] = None
+        cursor = app.data.driver.db[resource].find({'_id': {'$in': missing}}, projection)
+        for item in cursor:
+            found[item['_id']] = item
+    return { oid: found[oid] for oid in oids if found[oid] is not None }
+
 #===========================================================================
-def post_process_trip(trip, request):
+# post_process_trips ()
+#===========================================================================
+def post_process_trips(trips, request):
     fields_to_expand = {
         # { 'new_field_name': [ 'reference_resource', 'reference_id' ], ... }
         # After expansion 'reference_id' will be removed.
         'driver': [ 'users', 'driver_id' ],
         'car': [ 'cars', 'car_id' ]
     }
-    for step in trip['steps']:
-        transport = step['transport']
-        if transport['travel_mode'] == 'CAR_POOLING':
-            for key in fields_to_expand:
-                resource = fields_to_expand[key][0]
-                field = fields_to_expand[key][1]
-                collection = app.data.driver.db[resource]
-                item = collection.find_one({'_id': str_to_oid(transport[field])})
-                assert item
-                filter_data(resource, request, item)
-                transport[key] = item
-                transport.pop(field)
+    transports = [ step['transport'] for trip in trips for step in trip['steps']
+                   if step['transport']['travel_mode'] == 'CAR_POOLING' ]
+    if not transports:
+        return
+    # Referenced items of all trips are fetched with one query per resource
+    for key in fields_to_expand:
+        resource = fields_to_expand[key][0]
+        field = fields_to_expand[key][1]
+        items = find_many(resource, [ transport[field] for transport in transports ])
+        for item in items.values():
+            filter_data(resource, request, item)
+        for transport in transports:
+            item = items.get(str_to_oid(transport[field]))
+            assert item
+            transport[key] = item
+            transport.pop(field)
 
 #===========================================================================
-# post_process_status ()
+# post_process_statuses ()
 #===========================================================================
-def post_process_status(lift, request):
+def post_process_statuses(lifts, request):
     if 'driver_id' in request.args or 'passenger_id' in request.args:
         user_id = request.args['driver_id'] if 'driver_id' in request.args else request.args['passenger_id']
+        lift_ids = [ str_to_oid(lift['_id']) for lift in lifts ]
+        if not lift_ids:
+            return
+        # Find with a single query which of the lifts the user has reviewed
         collection = app.data.driver.db['feedbacks']
-        item = collection.find_one({ '$and': [ {'lift_id': str_to_oid(lift['_id'])}, {'reviewer_id': str_to_oid(user_id)} ] })
-        if item:
-            lift['status'] = 'REVIEWED'
-            
+        cursor = collection.find({ '$and': [ {'lift_id': {'$in': lift_ids}}, {'reviewer_id': str_to_oid(user_id)} ] }, {'lift_id': 1})
+        reviewed = set(item['lift_id'] for item in cursor)
+        for lift, lift_id in zip(lifts, lift_ids):
+            if lift_id in reviewed:
+                lift['status'] = 'REVIEWED'
+
 #===========================================================================
-# post_process_lift ()
+# post_process_lifts ()
 #===========================================================================
-def post_process_lift(lift, request):
-    post_process_trip(lift['trip'], request)
-    post_process_status(lift, request)
+def post_process_lifts(lifts, request):
+    post_process_trips([ lift['trip'] for lift in lifts ], request)
+    post_process_statuses(lifts, request)
 
 #===========================================================================
-# post_process_ride ()
+# post_process_rides ()
 #===========================================================================
-def post_process_ride(ride, request):
-    for lift in ride['lifts']:
+def post_process_rides(rides, request):
+    lifts = [ lift for ride in rides for lift in ride['lifts'] ]
+    # Passengers of all lifts are fetched with a single query
+    users = find_many('users', [ lift['passenger_id'] for lift in lifts ], {'pictures': 1})
+    for lift in lifts:
         lift.pop('trip')
-        users_col = app.data.driver.db['users']
-        user = users_col.find_one({'_id': str_to_oid(lift['passenger_id'])})
-        if user['pictures']:
+        user = users.get(str_to_oid(lift['passenger_id']))
+        if user and user.get('pictures'):
             lift.update({'passenger_img': user['pictures'][0]['file']})
 
 #===========================================================================
@@ -629,42 +755,363 @@ def post_process_feedback(feedback, request):
 #===============================================================================
 # post_process_data ()
 #===============================================================================
-def post_process_data(resource, request, data):
+def post_process_data(resource, request, data, clean=True):
+    # Functions applied to all items at once
+    func_to_apply_batch = {
+        'trips': post_process_trips,
+        'lifts': post_process_lifts,
+        'rides': post_process_rides,
+    }
+    # Functions applied to each item
     func_to_apply = {
-        'trips': post_process_trip,
-        'lifts': post_process_lift,
-        'rides': post_process_ride,
         'feedbacks': post_process_feedback,
     }
-    if resource in func_to_apply:
+    if resource in func_to_apply_batch:
+        func_to_apply_batch[resource](data if isinstance(data, list) else [ data ], request)
+    elif resource in func_to_apply:
         apply_function(data, func_to_apply[resource], request)
 
-    objectids_to_strings(data)
-    recursively_remove_fields(data, EVE_EXTRA_FIELDS)
+    # Callers that filter the data later on may skip cleaning it here
+    if clean:
+        clean_object(data, EVE_EXTRA_FIELDS)
 
     return data
 
 #===============================================================================
-# find_price ()
+# trips_with_allowed_modes ()
+#===============================================================================
+def trips_with_allowed_modes(planned_trips):
+    # Map extended (GTFS) travel modes to ours and drop trips with any leg
+    # using a travel mode that is not allowed
+    for trip in planned_trips:
+        for leg in trip['legs']:
+            travel_mode = leg['transport']['travel_mode']
+            leg['transport']['travel_mode'] = EXTENDED_TRAVEL_MODES.get(travel_mode, travel_mode)
+        if all(leg['transport']['travel_mode'] in ALLOWED_TRAVEL_MODES for leg in trip['legs']):
+            yield trip
+
+#===============================================================================
+# trips_with_available_rides ()
+#===============================================================================
+def trips_with_available_rides(trips, rides, self_user, booked_ride_ids):
+    # Yield (trip, leg_rides) where leg_rides holds the ride of each carpooling
+    # leg (None for other legs). Trips are dropped if any of their rides does
+    # not exist, is offered by the user or has already been booked by the user
+    for trip in trips:
+        leg_rides = []
+        for leg in trip['legs']:
+            item = None
+            if leg['transport']['travel_mode'] == 'CAR_POOLING':
+                ride_id = leg['transport']['ride_id'] or MOBALT_RIDE_ID
+                item = rides.get(str_to_oid(ride_id))
+                if not item or self_user['_id'] == item['driver_id'] or item['_id'] in booked_ride_ids:
+                    break
+            leg_rides.append(item)
+        else:
+            yield trip, leg_rides
+
+#===============================================================================
+# carpooling_transport ()
 #===============================================================================
-def find_price(leg, name):
-    if leg['transport']['travel_mode'] == 'METRO':
-        return metro_fare(name)
-    elif leg['transport']['travel_mode'] == 'BUS':
-        return bus_fare(leg, name)
-    elif leg['transport']['travel_mode'] == 'RAIL':
-        return rail_fare(leg['distance'], name)
-    elif leg['transport']['travel_mode'] == 'TRAM':
-        return tram_fare(leg, name)
-    elif leg['transport']['travel_mode'] == 'CAR_POOLING':
-        return carpooling_fare(leg['distance'], name)
+def carpooling_transport(leg, item, self_user, site_counters):
+    # Set custom ride_id if carpooling is Mobalt shuttle
+    ride_id = leg['transport']['ride_id'] if leg['transport']['ride_id'] else MOBALT_RIDE_ID
+    transport = {
+        'travel_mode': 'CAR_POOLING',
+        'ride_id': ride_id, # rides['_id'] foreign key
+        'driver_id': oid_to_str(item['driver_id']), # users['_id'] foreign key
+        'car_id': oid_to_str(item['car_id'])  # cars['_id'] foreign key
+    }
+    # If ride is internal
+    if 'extras' not in item:
+        site_counters.inc('ride_details.internal')
+        return transport
+
+    # If ride is of other providers except Mobalt
+    if leg['transport']['ride_id']:
+        public_uri = item['extras']['url']
+    # If ride is of Mobalt provider
     else:
-    	return 0
- 
+        user_name = self_user['name'].split(' ')[0]
+        user_surname = self_user['name'].split(' ')[-1]
+        user_email = self_user['email']
+        user_phone = self_user['phone']
+        start_address = leg['route']['points'][0]['address'] if leg['route']['points'][0]['address'] else 'Unknown address'
+        starting_stop_name = leg['route']['points'][0]['address'] if leg['route']['points'][0]['address'] else 'Unknown address'
+        starting_stop_time = leg['route']['points'][0]['departure_time']
+        arrival_stop_name = leg['route']['points'][-1]['address'] if leg['route']['points'][0]['address'] else 'Unknown address'
+        # Compose Mobalt URL parameters
+        mobalt_url_params = ('&name=%s&surname=%s&email=%s&phone=%s&start_address=%s&starting_stop_name=%s&starting_stop_time=%s&arrival_stop_name=%s' % (user_name, user_surname, user_email, user_phone, start_address, starting_stop_name, starting_stop_time, arrival_stop_name))
+        public_uri = (leg['transport']['route_url'] + mobalt_url_params)
+
+    site_counters.inc('ride_details.external')
+    transport['public_uri'] = public_uri
+    # Information regarding external carpooling bookings
+    site_counters.add_to_set('external_carpooling', {
+        'uuid': item['extras']['uuid'],
+        'url': item['extras']['url'],
+        'username': self_user['email']
+    })
+    return transport
+
+#===============================================================================
+# public_transport ()
+#===============================================================================
+def public_transport(leg):
+    # If transport name is empty replace with existing info
+    if not leg['transport']['short_name'] and not leg['transport']['long_name']:
+        route_short_name = leg['transport']['travel_mode']
+        route_long_name = leg['transport']['travel_mode']
+    elif not leg['transport']['short_name']:
+        route_short_name = '%s %s' % (leg['transport']['travel_mode'], leg['transport']['long_name'])
+        route_long_name = leg['transport']['long_name']
+    elif not leg['transport']['long_name']:
+        route_short_name = leg['transport']['short_name']
+        route_long_name = '%s %s' % (leg['transport']['travel_mode'], leg['transport']['short_name'])
+    else:
+        route_short_name = leg['transport']['short_name']
+        route_long_name = leg['transport']['long_name']
+    return {
+        'travel_mode': leg['transport']['travel_mode'],
+        'short_name': route_short_name,
+        'long_name': route_long_name
+    }
+
+#===============================================================================
+# trips_with_steps ()
+#===============================================================================
+def trips_with_steps(trips, self_user, name, currency, tariffs, site_counters):
+    # Build and price the steps of each trip, and count it in site statistics
+    for trip, leg_rides in trips:
+        steps = []
+        bus_list = []
+        travel_modes = set()
+        # All legs of the trip are priced at once
+        prices = fare_engine.price_legs(trip['legs'], name, tariffs)
+        for leg, item, price in zip(trip['legs'], leg_rides, prices):
+            travel_modes.add(leg['transport']['travel_mode'])
+            intermediate_points = []
+            # If leg is carpooling
+            if item is not None:
+                transport = carpooling_transport(leg, item, self_user, site_counters)
+                distance = int(float(leg['distance']))
+            # If leg is FEET
+            elif leg['transport']['travel_mode'] == 'FEET':
+                transport = public_transport(leg)
+                distance = int(float(leg['distance']))
+            # If leg is PT
+            else:
+                transport = public_transport(leg)
+                for point in leg['route']['points'][1:-1]:
+                    med_point = {
+                        'point': {
+                            'lat': float(point['point']['lat']),
+                            'lon': float(point['point']['lon'])
+                        },
+                        'date': int(point['departure_time']),
+                        'address': point['address'] if point['address'] else 'Unknown address'
+                    }
+                    intermediate_points.append(med_point)
+                distance = int(float(leg['stops']))
+
+            step = {
+                'route': {
+                    'start_point': {
+                        'point': {
+                            'lat': float(leg['route']['points'][0]['point']['lat']),
+                            'lon': float(leg['route']['points'][0]['point']['lon'])
+                        },
+                        'date': int(leg['departure_time']),
+                        'address': leg['route']['points'][0]['address'] if leg['route']['points'][0]['address'] else 'Unknown address'
+                    },
+                    'end_point': {
+                        'point': {
+                            'lat': float(leg['route']['points'][-1]['point']['lat']),
+                            'lon': float(leg['route']['points'][-1]['point']['lon'])
+                        },
+                        'date': int(leg['departure_time']) + round(float(leg['duration']), 0),
+                        'address': leg['route']['points'][-1]['address'] if leg['route']['points'][-1]['address'] else 'Unknown address'
+                    },
+                    'intermediate_points': intermediate_points
+                },
+                'transport': transport,
+                'price': {
+                    'amount': price,
+                    'currency': currency
+                },
+                'distance': distance
+            }
+            # Further calculations for Ljubljana city bus
+            if name == 'Ljubljana' and leg['transport']['travel_mode'] == 'BUS' and leg['transport']['agency_id'] == 'lpp':
+                bus_list.append(step)
+                if len(bus_list) > 1:
+                    # If changing bus within 90 minutes time frame do not issue a new ticket (step['price']['amount'] should be set to 0)
+                    if step['route']['start_point']['date'] - bus_list[0]['route']['start_point']['date'] <= 5400:
+                        # In case of changing zone within 90 minutes time frame modify ticket price accordingly if needed
+                        if step['price']['amount'] > bus_list[0]['price']['amount']:
+                            bus_list[0]['price']['amount'] = step['price']['amount']
+                        # Fare for current bus is set to zero since less than 90 minutes have passed
+                        step['price']['amount'] = 0
+                    else:
+                        bus_list = [ step ]
+            steps.append(step)
+
+        # Find number of carpooling only, carpooling + PT and total number of offered solutions
+        if 'CAR_POOLING' in travel_modes and travel_modes.intersection([ 'METRO', 'BUS', 'RAIL', 'TRAM' ]):
+            site_counters.inc('ride_details.carpooling_PT')
+        elif travel_modes == set([ 'CAR_POOLING', 'FEET' ]) or travel_modes == set([ 'CAR_POOLING' ]):
+            site_counters.inc('ride_details.carpooling_only')
+        site_counters.inc('ride_details.total_solutions')
+        yield steps
+
+#===============================================================================
+# trips_with_fixed_addresses ()
+#===============================================================================
+def trips_with_fixed_addresses(trips):
+    for steps in trips:
+        # Change end point address of FEET leg to next leg start point's address
+        for i in range(0, len(steps)-2):
+            if steps[i]['transport']['travel_mode'] == 'FEET':
+                steps[i]['route']['end_point']['address'] = steps[i+1]['route']['start_point']['address']
+        # Change start point address of FEET leg to previous leg end point's address
+        for i in range(1, len(steps)-1):
+            if steps[i]['transport']['travel_mode'] == 'FEET':
+                steps[i]['route']['start_point']['address'] = steps[i-1]['route']['end_point']['address']
+        yield { 'steps': steps }
+
+#===============================================================================
+# parse_page ()
+#===============================================================================
+def parse_page(request):
+    # Returns the (cursor, limit) of the page requested, or None if the whole
+    # result is requested
+    if QUERY_CURSOR not in request.args and QUERY_MAX_RESULTS not in request.args:
+        return None
+    cursor = None
+    if QUERY_CURSOR in request.args:
+        cursor = cursor_to_oid(request.args[QUERY_CURSOR])
+    try:
+        limit = int(request.args.get(QUERY_MAX_RESULTS, PAGINATION_DEFAULT))
+    except ValueError:
+        raise ValueError('Invalid limit %s' % (request.args[QUERY_MAX_RESULTS]))
+    if limit <= 0:
+        limit = PAGINATION_DEFAULT
+    return cursor, min(limit, PAGINATION_LIMIT)
+
+#===============================================================================
+# find_page ()
+#===============================================================================
+def find_page(collection, lookup, page, projection=None):
+    # Find the items matching 'lookup' of 'page' (as returned by parse_page()).
+    # Pages are sorted by _id and start after the _id of the cursor, so the _id
+    # index finds them without skipping items.
+    cursor, limit = page
+    if cursor is not None:
+        lookup = { '$and': [ lookup, {'_id': {'$gt': cursor}} ] }
+    return collection.find(lookup, projection).sort('_id', ASCENDING).limit(limit)
+
+#===============================================================================
+# set_next_cursor ()
+#===============================================================================
+def set_next_cursor(response, items, limit):
+    # Only a full page may be followed by more items
+    if limit and len(items) >= limit:
+        response.headers[NEXT_CURSOR_HEADER] = oid_to_cursor(items[-1]['_id'])
+
+#===============================================================================
+# allowed_fields ()
+#===============================================================================
+def allowed_fields(resource):
+    # Fields that may be requested from custom endpoint 'resource' (see
+    # CUSTOM_PROJECTIONS)
+    spec = CUSTOM_PROJECTIONS[resource]
+    if 'allowed' in spec:
+        return spec['allowed']
+    schema = app.config['DOMAIN'][spec['schema']]['schema']
+    return sorted(field for field in schema
+                  if field not in EVE_EXTRA_FIELDS and field not in spec.get('denied', []))
+
+#===============================================================================
+# custom_projection ()
+#===============================================================================
+def custom_projection(resource, request):
+    # Returns the projection of the items of custom endpoint 'resource' (see
+    # CUSTOM_PROJECTIONS), or raises ValueError if fields not allowed are
+    # requested
+    spec = CUSTOM_PROJECTIONS[resource]
+    allowed = allowed_fields(resource)
+    if QUERY_FIELDS not in request.args:
+        # Fields removed from responses anyway are not fetched either
+        projection = { field: 0 for field in EVE_EXTRA_FIELDS }
+        projection.update(spec['default'])
+        return projection
+    fields = [ field for field in request.args[QUERY_FIELDS].split(GET_VALUES_SEPARATOR) if field ]
+    if not fields or not set(fields).issubset(allowed):
+        raise ValueError('Invalid fields (allowed: %s)' % ', '.join(allowed))
+    return { field: 1 for field in fields + spec.get('required', []) }
+
+#===============================================================================
+# stream_items ()
+#===============================================================================
+def stream_items(resource, request, response, key, collection, lookup, projection=None,
+                 transform=None, done=None, done_max_size=0):
+    # Set the response to stream the items of 'collection' matching 'lookup' as
+    # '{"<key>": [ ... ]}', fetching, cleaning and serializing one item at a
+    # time while the response is sent, so memory use does not grow with the
+    # number of items. The total count is found by a separate count query.
+    # If given, done(payload, count) is called once the whole payload is sent,
+    # unless it is larger than 'done_max_size' bytes (then it is not kept).
+    def serialize():
+        yield '{"%s":[' % (key)
+        first = True
+        for item in collection.find(lookup, projection):
+            if transform is not None:
+                transform(item)
+            filter_data(resource, request, item)
+            if not first:
+                yield ','
+            yield json_to_payload(item)
+            first = False
+        yield ']}'
+
+    def generate():
+        chunks = [] if done is not None else None
+        size = 0
+        for chunk in serialize():
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode()
+            if chunks is not None:
+                size += len(chunk)
+                if size > done_max_size:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            done(b''.join(chunks), count)
+
+    count = collection.count_documents(lookup)
+    response.headers.set('X-Total-Count', count)
+    response.headers.pop('Content-Length', None)
+    response.response = stream_with_context(generate())
+
+#===============================================================================
+# format_stop ()
+#===============================================================================
+def format_stop(stop):
+    # In MongoDB the coordinates is always a list of [lot, lan]
+    stop['lon'] = stop['loc']['coordinates'][0]
+    stop['lat'] = stop['loc']['coordinates'][1]
+    stop.pop('loc')
+    if 'transits' in stop:
+        stop['transits'] = sorted(stop['transits'], key=lambda k: k['transport']['short_name'])
+
 #===============================================================================
 # set_custom_payload ()
 #===============================================================================
 def set_custom_payload(resource, request, response):
+    # Returns the payload of the custom endpoint, None on errors (in which case
+    # the error is set on the response) or PAYLOAD_SET
     items = []
 
     if (resource in REQUIRED_PARAMS and
@@ -672,59 +1119,76 @@ def set_custom_payload(resource, request, response):
             msg = 'Missing or invalid parameters' + \
                   ' (required: %s)' % ', '.join(REQUIRED_PARAMS[resource])
             response_set_error(response, 422, msg)
-            return
+            return None
+
+    page = None
+    if resource in PAGINATED_ENDPOINTS:
+        try:
+            page = parse_page(request)
+        except ValueError as e:
+            response_set_error(response, 400, str(e))
+            return None
+    limit = page[1] if page else None
+
+    projection = None
+    if resource in CUSTOM_PROJECTIONS:
+        try:
+            projection = custom_projection(resource, request)
+        except ValueError as e:
+            response_set_error(response, 422, str(e))
+            return None
 
     #---------------------------------------------------------------------------
     # /trips
     #---------------------------------------------------------------------------
     if resource == 'trips':
-        trip_date = 'date=' + timestamp_to_datetime(request.args['start_date'], '%Y%m%d')
-        trip_time = 'time=' + timestamp_to_datetime(request.args['start_date'], '%H:%M:%S')
-        start_lat = 'slat=' + request.args['start_lat']
-        start_lon = 'slng=' + request.args['start_lon']
-        end_lat = 'tlat=' + request.args['end_lat']
-        end_lon = 'tlng=' + request.args['end_lon']
         in_service = False
-        fetched_site = None
-
-        # Fetch collection 'sites' from db
-        sites_collection = app.data.driver.db['sites']
-        cursor = sites_collection.find({})
-        # For every site in db
-        for site in cursor:
-            bb_minlat = site['bounding_box']['min_lat']
-            bb_minlon = site['bounding_box']['min_lon']
-            bb_maxlat = site['bounding_box']['max_lat']
-            bb_maxlon = site['bounding_box']['max_lon']
-            s_lat = float(request.args['start_lat'])
-            s_lon = float(request.args['start_lon'])
-            t_lat = float(request.args['end_lat'])
-            t_lon = float(request.args['end_lon'])
-            # Check if given coordinates are within a site's bounding box and retrieve url
-            if inside_bounding_box(bb_minlat, bb_minlon, bb_maxlat, bb_maxlon, s_lat, s_lon, t_lat, t_lon):
-                in_service = True
-                base_url = site['url']
-                name = site['name']
-                currency = site['price_info']['currency']
-                fetched_site = site
+        site_counters = None
+        name = currency = tariffs = None
+
+        # Find the site whose bounding box contains the given coordinates
+        s_lat = float(request.args['start_lat'])
+        s_lon = float(request.args['start_lon'])
+        t_lat = float(request.args['end_lat'])
+        t_lon = float(request.args['end_lon'])
+        site = site_registry.find(s_lat, s_lon, t_lat, t_lon)
+        if site:
+            in_service = True
+            name = site['name']
+            currency = site['price_info']['currency']
+            tariffs = site['price_info'].get('tariffs')
+            # Site statistics are accumulated here and written once at the end
+            site_counters = SiteCounters(site['_id'])
         # If within a site's bounding box
         if in_service:
-            full_url = "%s?%s&%s&%s&%s&%s&%s" % (base_url, trip_date, trip_time, start_lat, start_lon, end_lat, end_lon)
-            app.logger.debug('%s' % (full_url))
-            try:
-                # GET request to Route Planning
-                r = requests.get(full_url, timeout=38)
-                json_extended_response = json.loads(r.text)
-                if json_extended_response['result'] == True:
-                    json_response = json_extended_response['data']
-                else:
-                    # TODO: Return error here
-                    app.logger.debug('%s' % (json_extended_response['error']['message']))
-                    json_response = []
-            except requests.exceptions.Timeout:
-                # TODO: Return error here
-                app.logger.debug('Request to %s time out' % (full_url))
+            params = {
+                'date': timestamp_to_datetime(request.args['start_date'], '%Y%m%d'),
+                'time': timestamp_to_datetime(request.args['start_date'], '%H:%M:%S'),
+                'slat': request.args['start_lat'],
+                'slng': request.args['start_lon'],
+                'tlat': request.args['end_lat'],
+                'tlng': request.args['end_lon'],
+            }
+            # Similar requests are answered from the cache, without planning
+            cache_key = route_plan_cache.key(site['_id'], request.args)
+            json_response = route_plan_cache.get(cache_key)
+            if json_response is None:
+                # Query all Route Planning services of the site concurrently
+                urls = [ site['url'] ] + site.get('extra_urls', [])
+                jobs = [ (url, params, site.get('route_planner_timeout')) for url in urls ]
                 json_response = []
+                planned = True
+                for url, result in zip(urls, route_planner.plan_many(jobs)):
+                    app.logger.debug('%s %s' % (url, params))
+                    if isinstance(result, RoutePlannerError):
+                        # TODO: Return error here
+                        app.logger.debug('%s' % (result))
+                        planned = False
+                    else:
+                        json_response.extend(result)
+                # Cache only complete answers of the planners
+                if planned:
+                    route_plan_cache.set(cache_key, json_response)
         else:
             # TODO: Return error here
             app.logger.debug('Coordinates outside the site boundaries')
@@ -739,260 +1203,112 @@ def set_custom_payload(resource, request, response):
         fetched_lifts = list(lifts_collection.find({ '$and': [ {'passenger_id': self_user['_id']} , \
                                                         {'status': 'ACTIVE'} , \
                                                         {'start_point.date': {'$gte': int(time.time())}} , \
-                                                        {'_deleted': {'$ne': True}}] }))
+                                                        {'_deleted': {'$ne': True}}] }, { 'ride_id': 1 }))
 
         # Find rides for which the user has already created a lift for
-        fetched_rides = []
-        if fetched_lifts:
-            collection = app.data.driver.db['rides']
-            for fetched_lift in fetched_lifts:
-                lookup = {'_id': fetched_lift['ride_id']}
-                fetched_ride = collection.find_one(lookup)
-                fetched_rides.append(fetched_ride)
-
-        trips = []
-        # For each trip
-        for trip in json_response:
-            steps = []
-            discard_trip = False
-            bus_list = []
-            travel_mode_list = []
-            # For each leg
+        booked_ride_ids = set(fetched_lift['ride_id'] for fetched_lift in fetched_lifts)
+
+        # Trips using a travel mode we don't support are dropped right away
+        valid_trips = list(trips_with_allowed_modes(json_response))
+
+        # Fetch with a single query all rides of the carpooling legs
+        ride_ids = set()
+        for trip in valid_trips:
             for leg in trip['legs']:
-                if leg['transport']['travel_mode'] in EXTENDED_TRAVEL_MODES:
-                    leg['transport']['travel_mode'] = EXTENDED_TRAVEL_MODES[leg['transport']['travel_mode']]
-                if leg['transport']['travel_mode'] in ALLOWED_TRAVEL_MODES:
-                    if leg['transport']['travel_mode'] not in travel_mode_list:
-                        travel_mode_list.append(leg['transport']['travel_mode'])
-                    # If leg is carpooling
-                    intermediate_points = []
-                    if leg['transport']['travel_mode'] == 'CAR_POOLING':
-                        # Set custom ride_id if carpooling is Mobalt shuttle
-                        ride_id = leg['transport']['ride_id'] if leg['transport']['ride_id'] else '88e50050223f9badec44f5ff'
-                        collection = app.data.driver.db['rides']
-                        item = collection.find_one({'_id': str_to_oid(ride_id)})
-                        # If user is not the driver of the ride and has not already created a lift for that ride
-                        if oid_to_str(self_user['_id']) != oid_to_str(item['driver_id']) and item not in fetched_rides:
-                            # If ride is external
-                            if 'extras' in item:
-                                # If ride is of other providers except Mobalt
-                                if leg['transport']['ride_id']:
-                                    public_uri = item['extras']['url']
-                                # If ride is of Mobalt provider
-                                else:
-                                    user_name = self_user['name'].split(' ')[0]
-                                    user_surname = self_user['name'].split(' ')[-1]
-                                    user_email = self_user['email']
-                                    user_phone = self_user['phone']
-                                    start_address = leg['route']['points'][0]['address'] if leg['route']['points'][0]['address'] else 'Unknown address'
-                                    starting_stop_name = leg['route']['points'][0]['address'] if leg['route']['points'][0]['address'] else 'Unknown address'
-                                    starting_stop_time = leg['route']['points'][0]['departure_time']
-                                    arrival_stop_name = leg['route']['points'][-1]['address'] if leg['route']['points'][0]['address'] else 'Unknown address'
-                                    # Compose Mobalt URL parameters
-                                    mobalt_url_params = ('&name=%s&surname=%s&email=%s&phone=%s&start_address=%s&starting_stop_name=%s&starting_stop_time=%s&arrival_stop_name=%s' % (user_name, user_surname, user_email, user_phone, start_address, starting_stop_name, starting_stop_time, arrival_stop_name))
-                                    public_uri = (leg['transport']['route_url'] + mobalt_url_params)
-                                
-                                fetched_site['ride_details']['external'] = fetched_site['ride_details']['external'] + 1
-                                transport = {
-                                    'travel_mode': 'CAR_POOLING',
-                                    'ride_id': ride_id, # rides['_id'] foreign key
-                                    'driver_id': oid_to_str(item['driver_id']), # users['_id'] foreign key
-                                    'car_id': oid_to_str(item['car_id']),  # cars['_id'] foreign key
-                                    'public_uri': public_uri
-                                }
-                                # Dictionary containing information regarding external carpooling bookings
-                                external_booking = {
-                                    'uuid': item['extras']['uuid'],
-                                    'url': item['extras']['url'],
-                                    'username': self_user['email']
-                                }
-                                fetched_site['external_carpooling'].append(external_booking)
-                            # If ride is internal
-                            else:
-                                fetched_site['ride_details']['internal'] = fetched_site['ride_details']['internal'] + 1
-                                transport = {
-                                    'travel_mode': 'CAR_POOLING',
-                                    'ride_id': ride_id, # rides['_id'] foreign key
-                                    'driver_id': oid_to_str(item['driver_id']), # users['_id'] foreign key
-                                    'car_id': oid_to_str(item['car_id'])  # cars['_id'] foreign key
-                                }
-                            distance = int(float(leg['distance']))
-                            sites_collection.update({'_id': fetched_site['_id']}, fetched_site, upsert = False)
-                        # Else discard the ride
-                        else:
-                            discard_trip = True
-                            break
-                    # Else if leg is PT or feet
-                    else:
-                        # If transport name is empty replace with existing info
-                        if not leg['transport']['short_name'] and not leg['transport']['long_name']:
-                            route_short_name = leg['transport']['travel_mode']
-                            route_long_name = leg['transport']['travel_mode']
-                        elif not leg['transport']['short_name']:
-                            route_short_name = '%s %s' % (leg['transport']['travel_mode'], leg['transport']['long_name'])
-                            route_long_name = leg['transport']['long_name']
-                        elif not leg['transport']['long_name']:
-                            route_short_name = leg['transport']['short_name']
-                            route_long_name = '%s %s' % (leg['transport']['travel_mode'], leg['transport']['short_name'])
-                        else:
-                            route_short_name = leg['transport']['short_name']
-                            route_long_name = leg['transport']['long_name']
-                        # if leg is FEET
-                        if leg['transport']['travel_mode'] == 'FEET':
-                            transport = {
-                                'travel_mode': leg['transport']['travel_mode'],
-                                'short_name': route_short_name,
-                                'long_name': route_long_name 
-                            }
-                            distance = int(float(leg['distance']))
-                        # if leg is PT
-                        else:
-                            transport = {
-                                'travel_mode': leg['transport']['travel_mode'],
-                                'short_name': route_short_name,
-                                'long_name': route_long_name 
-                            }
-                            for point in leg['route']['points'][1:-1]:
-                                med_point = {
-                                    'point': {
-                                        'lat': float(point['point']['lat']),
-                                        'lon': float(point['point']['lon'])
-                                    },
-                                    'date': int(point['departure_time']),
-                                    'address': point['address'] if point['address'] else 'Unknown address'
-                                }
-                                intermediate_points.append(med_point)
-                            distance = int(float(leg['stops']))
-
-                    step = {
-                        'route': {
-                            'start_point': {
-                                'point': {
-                                    'lat': float(leg['route']['points'][0]['point']['lat']),
-                                    'lon': float(leg['route']['points'][0]['point']['lon'])
-                                },
-                                'date': int(leg['departure_time']),
-                                'address': leg['route']['points'][0]['address'] if leg['route']['points'][0]['address'] else 'Unknown address'
-                            },
-                            'end_point': {
-                                'point': {
-                                    'lat': float(leg['route']['points'][-1]['point']['lat']),
-                                    'lon': float(leg['route']['points'][-1]['point']['lon'])
-                                },
-                                'date': int(leg['departure_time']) + round(float(leg['duration']), 0),
-                                'address': leg['route']['points'][-1]['address'] if leg['route']['points'][-1]['address'] else 'Unknown address'
-                            },
-                            'intermediate_points': intermediate_points
-                        },
-                        'transport': transport,
-                        'price': {
-                            'amount': find_price(leg, name),
-                            'currency': currency
-                        },
-                        'distance': distance
-                    }
-                    # Further calculations for Ljubljana city bus
-                    if name == 'Ljubljana' and leg['transport']['travel_mode'] == 'BUS' and leg['transport']['agency_id'] == 'lpp':
-                        bus_list.append(step)
-                        if len(bus_list) > 1:
-                            # If changing bus within 90 minutes time frame do not issue a new ticket (step['price']['amount'] should be set to 0)
-                            if step['route']['start_point']['date'] - bus_list[0]['route']['start_point']['date'] <= 5400:
-                                # In case of changing zone within 90 minutes time frame modify ticket price accordingly if needed
-                                if step['price']['amount'] > bus_list[0]['price']['amount']:
-                                    for item in steps:
-                                        if item == bus_list[0]:
-                                            item['price']['amount'] = step['price']['amount']
-                                # Fare for current bus is set to zero since less than 90 minutes have passed
-                                step['price']['amount'] = 0
-                            else:
-                                bus_list = []
-                                bus_list.append(step)
-                    steps.append(step)
-                else:
-                    discard_trip = True
-                    break
-            if not discard_trip:
-                # Find number of carpooling only, carpooling + PT and total number of offered solutions and update db
-                if ('CAR_POOLING' in travel_mode_list) and (('METRO' in travel_mode_list) or ('BUS' in travel_mode_list) or ('RAIL' in travel_mode_list) or ('TRAM' in travel_mode_list)):
-                    fetched_site['ride_details']['carpooling_PT'] = fetched_site['ride_details']['carpooling_PT'] + 1
-                elif len(travel_mode_list) == 2 and 'CAR_POOLING' in travel_mode_list and 'FEET' in travel_mode_list:
-                    fetched_site['ride_details']['carpooling_only'] = fetched_site['ride_details']['carpooling_only'] + 1
-                elif len(travel_mode_list) == 1 and travel_mode_list[0] == 'CAR_POOLING':
-                    fetched_site['ride_details']['carpooling_only'] = fetched_site['ride_details']['carpooling_only'] + 1
-                fetched_site['ride_details']['total_solutions'] = fetched_site['ride_details']['total_solutions'] + 1
-                sites_collection.update({'_id': fetched_site['_id']}, fetched_site, upsert = False)
-
-                # Change end point address of FEET leg to next leg start point's address
-                for i in range(0, len(steps)-2):
-                    if steps[i]['transport']['travel_mode'] == 'FEET':
-                        steps[i]['route']['end_point']['address'] = steps[i+1]['route']['start_point']['address']
-                # Change start point address of FEET leg to previous leg end point's address
-                for i in range(1, len(steps)-1):
-                    if steps[i]['transport']['travel_mode'] == 'FEET':
-                        steps[i]['route']['start_point']['address'] = steps[i-1]['route']['end_point']['address']
-
-                trips.append({ 'steps': steps })
-        if fetched_site is not None:
-            if self_user['email'] not in fetched_site['users']:
-                fetched_site['users'].append(self_user['email'])
-                sites_collection.update({'_id': fetched_site['_id']}, fetched_site, upsert = False)
-        items = trips
+                if leg['transport']['travel_mode'] == 'CAR_POOLING':
+                    ride_ids.add(str_to_oid(leg['transport']['ride_id'] or MOBALT_RIDE_ID))
+        rides = {}
+        if ride_ids:
+            cursor = app.data.driver.db['rides'].find({'_id': {'$in': list(ride_ids)}})
+            rides = { ride['_id']: ride for ride in cursor }
+
+        # Each trip goes through all stages before the next one is processed,
+        # and trips are discarded before they are priced or counted
+        trips = trips_with_available_rides(valid_trips, rides, self_user, booked_ride_ids)
+        trips = trips_with_steps(trips, self_user, name, currency, tariffs, site_counters)
+        trips = trips_with_fixed_addresses(trips)
+        items = list(trips)
+
+        if site_counters is not None:
+            site_counters.add_to_set('users', self_user['email'])
+            site_counters.flush(app.data.driver.db['sites'])
 
     #---------------------------------------------------------------------------
     # /rides_boundary
     #---------------------------------------------------------------------------
     elif resource == 'rides_boundary':
-        min_lat = float(request.args['min_lat'])
-        min_lon = float(request.args['min_lon'])
-        max_lat = float(request.args['max_lat'])
-        max_lon = float(request.args['max_lon'])
-
-        if request.args['site'] == 'brussels':
-            site_name = 'Brussels'
-        elif request.args['site'] == 'edinburgh':
-            site_name = 'Edinburgh'
-        elif request.args['site'] == 'ljubljana':
-            site_name = 'Ljubljana'
-        elif request.args['site'] == 'ticino':
-            site_name = 'Canton Ticino'
-
-        # Fetch collection 'sites' from db
-        sites_collection = app.data.driver.db['sites']
-        site = sites_collection.find_one({'name': site_name})
-        
-        lookup1 = { '$and': [ {'end_point.lat': {'$gte': min_lat}} , \
-                            {'end_point.lat': {'$lte': max_lat}} , \
-                            {'end_point.lon': {'$gte': min_lon}} , \
-                            {'end_point.lon': {'$lte': max_lon}} ] }
-
-        lookup2 = { '$and': [ {'start_point.lat': {'$gte': min_lat}} , \
-                            {'start_point.lat': {'$lte': max_lat}} , \
-                            {'start_point.lon': {'$gte': min_lon}} , \
-                            {'start_point.lon': {'$lte': max_lon}} ] }
-
-        lookup3 = { '$and': [ {'_deleted': {'$eq': False}} , \
-                            {'activated': {'$eq': True}} , \
-                            {'date': {'$gt': site['carpooling_info']['nightly_updated']}} ] }           
-
-        lookup = { '$and': [ lookup1, lookup2, lookup3 ] }
-        cursor = app.data.driver.db['rides'].find(lookup)
+        # The box is widened to a multiple of ~10m, so requests for the same
+        # area of a map share the cached response; rides inside the requested
+        # box are never left out, rides up to ~10m outside it may be added
+        min_lat, min_lon, max_lat, max_lon = widen_bounding_box(float(request.args['min_lat']),
+                                                                float(request.args['min_lon']),
+                                                                float(request.args['max_lat']),
+                                                                float(request.args['max_lon']))
+
+        # Sites are found by the slug of their name, e.g. 'ticino'
+        site = site_registry.find_by_slug(request.args['site'])
+        if site is None:
+            response_set_error(response, 422, 'Unknown site %s' % (request.args['site']))
+            return None
+        # Only the counters that change are read from db
+        projection_info = { 'carpooling_info.version': 1, 'carpooling_info.nightly_updated': 1 }
+        info = app.data.driver.db['sites'].find_one({'_id': site['_id']}, projection_info)['carpooling_info']
+
+        # Both points of the ride must be inside the box; geo queries use the
+        # 2dsphere indexes of the GeoJSON fields of rides
+        box = { '$geoWithin': { '$geometry': bounding_box_to_geometry(min_lat, min_lon, max_lat, max_lon) } }
+        lookup = {
+            'start_geometry': box,
+            'end_geometry': box,
+            'activated': True,
+            '_deleted': False,
+            'date': {'$gt': info['nightly_updated']},
+        }
+        if page is None:
+            # The version of the site changes whenever one of its rides does,
+            # so cached responses (and ETags) stay valid until then. Some
+            # changes do not bump it (e.g. lifts, rides moved to another
+            # site), so they are valid until the end of their time bucket at most.
+            time_bucket = int(time.time() // RIDES_BOUNDARY_CACHE_TTL)
+            cache_key = (site['_id'], min_lat, min_lon, max_lat, max_lon, info.get('version'),
+                         info['nightly_updated'], request.args.get(QUERY_FIELDS), time_bucket)
+            etag = hashlib.md5(repr(cache_key).encode()).hexdigest()
+            response.set_etag(etag)
+            if request.if_none_match.contains(etag):
+                response.status_code = 304
+                response.set_data(b'')
+                return None
+            cached = rides_boundary_cache.get(cache_key)
+            if cached is not None:
+                payload, count = cached
+                response.set_data(payload)
+                response.headers.set('X-Total-Count', count)
+                return PAYLOAD_SET
+            stream_items(resource, request, response, 'rides', app.data.driver.db['rides'], lookup, projection,
+                         done=lambda payload, count: rides_boundary_cache.set(cache_key, (payload, count)),
+                         done_max_size=RIDES_BOUNDARY_CACHE_ENTRY_BYTES)
+            return PAYLOAD_SET
+        cursor = find_page(app.data.driver.db['rides'], lookup, page, projection)
         rides = []
         for ride in cursor:
             rides.append(ride)
+        set_next_cursor(response, rides, limit)
         items = { 'rides': rides }
-        apply_function(items, recursively_remove_fields, EVE_EXTRA_FIELDS)
 
     #---------------------------------------------------------------------------
     # /rides_internal
     #---------------------------------------------------------------------------
     elif resource == 'rides_internal':
         lookup = { 'extras': {'$exists': False} }
-        cursor = app.data.driver.db['rides'].find(lookup)
+        if page is None:
+            stream_items(resource, request, response, 'rides', app.data.driver.db['rides'], lookup, projection)
+            return PAYLOAD_SET
+        cursor = find_page(app.data.driver.db['rides'], lookup, page, projection)
         rides = []
         for ride in cursor:
             rides.append(ride)
+        set_next_cursor(response, rides, limit)
         items = { 'rides': rides }
-        apply_function(items, recursively_remove_fields, EVE_EXTRA_FIELDS)
 
     #---------------------------------------------------------------------------
     # /sites_boundary
@@ -1007,12 +1323,11 @@ def set_custom_payload(resource, request, response):
                             {'bounding_box.min_lon': {'$lte': min_lon}} , \
                             {'bounding_box.max_lat': {'$gte': max_lat}} , \
                             {'bounding_box.max_lon': {'$gte': max_lon}} ] }
-        cursor = app.data.driver.db['sites'].find(lookup)
+        cursor = app.data.driver.db['sites'].find(lookup, projection)
         sites = []
         for site in cursor:
             sites.append(site)
         items = { 'sites': sites }
-        apply_function(items, recursively_remove_fields, EVE_EXTRA_FIELDS)
 
     #---------------------------------------------------------------------------
     # /reports_boundary
@@ -1028,12 +1343,15 @@ def set_custom_payload(resource, request, response):
                             {'location.geometry.coordinates.1': {'$lte': max_lat}} , \
                             {'location.geometry.coordinates.0': {'$lte': max_lon}}, \
                             {'_deleted': {'$ne': True}} ] }
-        cursor = app.data.driver.db['reports'].find(lookup)
+        if page is None:
+            stream_items(resource, request, response, 'reports', app.data.driver.db['reports'], lookup, projection)
+            return PAYLOAD_SET
+        cursor = find_page(app.data.driver.db['reports'], lookup, page, projection)
         reports = []
         for report in cursor:
             reports.append(report)
+        set_next_cursor(response, reports, limit)
         items = { 'reports': reports }
-        apply_function(items, recursively_remove_fields, EVE_EXTRA_FIELDS)
 
     #---------------------------------------------------------------------------
     # /reports_around
@@ -1045,12 +1363,11 @@ def set_custom_payload(resource, request, response):
 
         lookup = { '$and': [ {'location.geometry': {'$geoWithin': {'$centerSphere': [ [lon, lat], radius ] }}}, \
                             {'_deleted': {'$ne': True}} ] }
-        cursor = app.data.driver.db['reports'].find(lookup)
+        cursor = app.data.driver.db['reports'].find(lookup, projection)
         reports = []
         for report in cursor:
             reports.append(report)
         items = { 'reports': reports }
-        apply_function(items, recursively_remove_fields, EVE_EXTRA_FIELDS)
 
     #---------------------------------------------------------------------------
     # /positions_button
@@ -1066,7 +1383,9 @@ def set_custom_payload(resource, request, response):
         if distance <= RADIUS:
             # print("    Passenger %s got notified that driver %s is %skm away. Estimated time of arrival: %smin" % (lift['passenger_id'], lift['driver_id'], distance, eta))
             # TODO: Send push notification here - PushMessagingServer.send(to=passenger_FCM_token, payload_data={'lift_id':lift_id, 'distance':distance ,'eta':eta})
-            send_push_notification_eta(oid_to_str(lift['passenger_id']), {'lift_id': oid_to_str(lift['_id']),'distance':distance ,'eta':eta})
+            # The notification is sent in the background; its ticket is kept
+            # in the request context for anyone interested in the outcome
+            g.eta_notification = send_push_notification_eta(oid_to_str(lift['passenger_id']), {'lift_id': oid_to_str(lift['_id']),'distance':distance ,'eta':eta})
             items = { 'status': 'OK', 'details': 'Passenger will be notified that you are close to the pickup point.' }
         else:
             items = { 'status': 'KO', 'details': 'You are not so close to the passenger pickup point.' }
@@ -1079,15 +1398,15 @@ def set_custom_payload(resource, request, response):
         lat = float(request.args['lat'])
         radius = km2rad(request.args.get('radius', STOPS_AROUND_RADIUS_KM))
         lookup = {'loc': {'$geoWithin': {'$centerSphere': [ [lon, lat], radius ] }}}
-        cursor = app.data.driver.db['stops'].find(lookup)
+        if page is None:
+            stream_items(resource, request, response, 'stops', app.data.driver.db['stops'], lookup, projection, format_stop)
+            return PAYLOAD_SET
+        cursor = find_page(app.data.driver.db['stops'], lookup, page, projection)
         stops = []
         for stop in cursor:
-            # In MongoDB the coordinates is always a list of [lot, lan]
-            stop['lon'] = stop['loc']['coordinates'][0]
-            stop['lat'] = stop['loc']['coordinates'][1]
-            stop.pop('loc')
-            stop['transits'] = sorted(stop['transits'], key=lambda k: k['transport']['short_name'])
+            format_stop(stop)
             stops.append(stop)
+        set_next_cursor(response, stops, limit)
         items = { 'stops': stops }
 
     #---------------------------------------------------------------------------
@@ -1128,12 +1447,12 @@ def set_custom_payload(resource, request, response):
                     })
             items = stop
 
-    objectids_to_strings(items)
+    # Fields are removed and ObjectIds converted by after_GET
     data = {
         '_items': items
     }
-    response.set_data(json_to_str(data))
     response.headers.set('X-Total-Count', len(data['_items']))
+    return data
 
 #===============================================================================
 # data_group_by ()
@@ -1165,6 +1484,7 @@ def disable_filters(request):
 def before_GET(resource, request, lookup):
 
     resource = actual_resource(request)
+    paginated = not lookup and app.config['DOMAIN'].get(resource, {}).get('pagination')
 
     #---------------------------------------------------------------------------
     # Disable filters such as 'where', 'projection' etc
@@ -1191,6 +1511,21 @@ def before_GET(resource, request, lookup):
                 else:  # Add new operator to existing
                     lookup[field].update({operator: value})
 
+    #---------------------------------------------------------------------------
+    # Keyset pagination: the page after the cursor (items are sorted by _id,
+    # see 'default_sort' in settings.py) replaces numbered pages
+    #---------------------------------------------------------------------------
+    if paginated:
+        args = dict(request.args)
+        remove_fields(args, [ QUERY_PAGE ])
+        request.args = ImmutableMultiDict(args)
+        if QUERY_CURSOR in request.args:
+            try:
+                cursor = cursor_to_oid(request.args[QUERY_CURSOR])
+            except ValueError as e:
+                abort(400, description=str(e))
+            lookup.setdefault('_id', {}).update({'$gt': cursor})
+
     #---------------------------------------------------------------------------
     # Auto-embed (replace object ids with objects)
     #---------------------------------------------------------------------------
@@ -1204,12 +1539,18 @@ def before_GET(resource, request, lookup):
 # after_GET ()
 #===============================================================================
 def after_GET(resource, request, response):
+    # The payload is parsed (unless built here) and serialized only once; all
+    # processing in between works on the in-memory data
+    data = None
 
     #---------------------------------------------------------------------------
     # Custom endpoint
     #---------------------------------------------------------------------------
     if resource in CUSTOM_ENDPOINTS:
-        set_custom_payload(resource, request, response)
+        data = set_custom_payload(resource, request, response)
+        # Streamed or cached payloads are final, and must not be read here
+        if data is PAYLOAD_SET:
+            return
 
     #---------------------------------------------------------------------------
     # If status code not 2XX, no need to further process response content
@@ -1223,19 +1564,24 @@ def after_GET(resource, request, response):
     #---------------------------------------------------------------------------
     if not 200 <= response.status_code < 300:
         if response.status_code != 304:
-            data = str_to_json(response.get_data())
-            response.set_data(json_to_str({ '_error': data['_error'] }))
+            data = payload_to_json(response.get_data())
+            response.set_data(json_to_payload({ '_error': data['_error'] }))
         return
 
     resource = actual_resource(request)
 
-    data = str_to_json(response.get_data())
+    if data is None:
+        data = payload_to_json(response.get_data())
+        # Paginated resources: the cursor of the next page is found before
+        # items are grouped
+        if '_meta' in data:
+            set_next_cursor(response, data['_items'], data['_meta'].get('max_results'))
     data = flatten_data(data)
 
     #---------------------------------------------------------------------------
     # Add, remove or modify fields before returning data to client
     #---------------------------------------------------------------------------
-    data = post_process_data(resource, request, data)
+    data = post_process_data(resource, request, data, clean=False)
 
     #---------------------------------------------------------------------------
     # Group data by key if required
@@ -1245,8 +1591,7 @@ def after_GET(resource, request, response):
             data_group_by(data, group_key)
             break  # In case more than one group_by_* args provided
 
-    response.set_data(json_to_str(data))
-    finalize_payload(resource, request, response)
+    response.set_data(json_to_payload(finalize_data(resource, request, data)))
 
 #===============================================================================
 # before_POST ()
@@ -1258,25 +1603,23 @@ def before_POST(resource, request):
 # after_POST ()
 #===============================================================================
 def after_POST(resource, request, response):
+    data = payload_to_json(response.get_data())
     if response.status_code == 201:
         act_resource = actual_resource(request)
         if act_resource == 'feedbacks':
-            data = str_to_json(response.get_data())
             items = data['_items'] if '_items' in data else [ data ]
             for item in items:
                 post_process_feedback(item, request)
-            response.set_data(json_to_str(data))
 
-    finalize_payload(resource, request, response)
-    add_location_header(resource, request, response)
+    data = finalize_data(resource, request, data)
+    add_location_header(resource, request, response, data)
     # In case email already exists, return 409 status code
     if resource == 'users' and response.status_code == 422:
-        data = str_to_json(response.get_data())
         if ('email' in data['_issues'] and
            'is not unique' in data['_issues']['email']):
             response.status_code = 409
             data['_error']['code'] = str(response.status_code)
-            response.set_data(json_to_str(data))
+    response.set_data(json_to_payload(data))
 
 #===============================================================================
 # before_PUT ()
@@ -1320,6 +1663,78 @@ def after_DELETE(resource, request, response):
 def item_deleted(item):
     return '_deleted' in item and item['_deleted']
 
+#===============================================================================
+# password_digest ()
+#===============================================================================
+def password_digest(password):
+    # Passwords are not kept in memory, only their digest
+    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+#===============================================================================
+# verified_role ()
+#===============================================================================
+def verified_role(username, password):
+    # Return 'admin' or 'user' if the credentials are valid, else None
+    digest = password_digest(password)
+    cached = credentials_cache.get(username)
+    if cached and cached[0] == digest:
+        return cached[1]
+
+    admin = app.data.driver.db['admins'].find_one({'username': username}, {'password': 1, '_deleted': 1})
+    if admin and admin['password'] == password and not item_deleted(admin):
+        role = 'admin'
+    else:
+        user = app.data.driver.db['users'].find_one({'email': username}, {'password': 1, '_deleted': 1})
+        if not user or item_deleted(user) or user['password'] != password:
+            return None
+        role = 'user'
+
+    # Only valid credentials are cached
+    credentials_cache.set(username, (digest, role))
+    return role
+
+#===============================================================================
+# item_ownership ()
+#===============================================================================
+def item_ownership(resource, oid):
+    # Return (deleted, owners) of an item, or None if it does not exist
+    collection = resource_collection(resource)
+    ownership = owners_cache.get((collection, oid))
+    if ownership is None:
+        item = app.data.driver.db[collection].find_one({'_id': oid}, {OWNER_FIELD: 1, '_deleted': 1})
+        if not item:
+            return None
+        ownership = (item_deleted(item), item.get(OWNER_FIELD, []))
+        owners_cache.set((collection, oid), ownership)
+    return ownership
+
+#===============================================================================
+# resource_collection ()
+#===============================================================================
+def resource_collection(resource):
+    # Owners are cached by collection, as resources sharing one (e.g.
+    # feedbacks and feedbacks_all) share its items
+    datasource = app.config['DOMAIN'].get(resource, {}).get('datasource', {})
+    return datasource.get('source') or resource
+
+#===============================================================================
+# forget_credentials ()
+#===============================================================================
+def forget_credentials(*items):
+    # Called with the new and/or original documents of a changed user
+    for item in items:
+        if 'email' in item:
+            credentials_cache.delete(item['email'])
+
+#===============================================================================
+# forget_ownership ()
+#===============================================================================
+def forget_ownership(resource, *items):
+    collection = resource_collection(resource)
+    for item in items:
+        if '_id' in item:
+            owners_cache.delete((collection, item['_id']))
+
 #===============================================================================
 # my_basic_auth ()
 #===============================================================================
@@ -1335,16 +1750,12 @@ class my_basic_auth(BasicAuth):
             if all([ param in request.url for param in params ]):
                 return True
 
-        # Check if user is an admin
-        admin = app.data.driver.db['admins'].find_one({'username': username})
-        if admin and admin['password'] == password and not item_deleted(admin):
+        # Check if user is an admin or an authenticated user
+        role = verified_role(username, password)
+        if role == 'admin':
             return True
-
-        # Check if user is authenticated
-        user = app.data.driver.db['users'].find_one({'email': username})
-        if not user or item_deleted(user):
+        if role is None:
             return False
-        authenticated = (user['password'] == password)
 
         # Check if user is authorized
         authorized = False
@@ -1353,160 +1764,66 @@ class my_basic_auth(BasicAuth):
                 oid = str_to_oid(request.url.split('/')[6].split('?')[0])
             except:
                 oid = None
-            item = app.data.driver.db[resource].find_one({'_id': oid})
+            ownership = item_ownership(resource, oid)
             # In case item is deleted, authorize user so [s]he gets a 404 error
             # rather than a '401: Provide proper credentials' error
-            if item and item_deleted(item):
+            if ownership and ownership[0]:
                 authorized = True
-            elif item and OWNER_FIELD in item and username in item[OWNER_FIELD]:
+            elif ownership and username in ownership[1]:
                 authorized = True
         else:
             assert method in [ 'POST', 'GET' ]
             authorized = True
 
-        return authenticated and authorized
+        return authorized
+
+#===============================================================================
+# find_notified_users ()
+#===============================================================================
+def find_notified_users(user_ids):
+    # Called by notification workers to look up all users of a batch at once
+    collection = app.data.driver.db['users']
+    cursor = collection.find({'_id': {'$in': [ str_to_oid(user_id) for user_id in user_ids ]}},
+                             {'fcm_token': 1, 'platform': 1})
+    return { oid_to_str(user['_id']): user for user in cursor }
 
 #===============================================================================
 # notification_thread_lift ()
 #===============================================================================
 def notification_thread_lift(user_id, lift):
-    
-    # send_push_notification ()
-    # The copy_current_request_context decorator ensures that the HTTP request that is active when a function is called
-    # remains active even when the function is subsequently executed in a thread
-    @copy_current_request_context
-    def send_push_notification(user_id, message):
-        message['type'] = 'lift'
-        assert isinstance(user_id, str)
-        assert isinstance(message, dict)
-        user_id = str_to_oid(user_id)
-        message = filter_data(actual_resource(request), request, message)
-        
-        user = app.data.driver.db['users'].find_one({'_id': user_id})
-        assert user and user['_id'] == user_id
-        fcm_token = user['fcm_token']
-        platform = user['platform'] if 'platform' in user else 'ANDROID'
-
-        # if user platform is iOS send custom payload
-        if platform == 'IOS':
-            message = {
-                '_id': message['_id'],
-                'passenger_id': message['passenger_id'],
-                'driver_id': message['driver_id'],
-                'ride_id': message['ride_id'],
-                'car_id': message['car_id'],
-                'status': message['status']
-            }
-            platform_url = 'FCMConnectorService/messaging/notification-message/send'
-            data_str = '%s' % (message)
-            data_str = remove_non_ascii(data_str)
-            data_title = "Sample_Title"
-            if message['status'] == 'PENDING':
-                notification_title = "REQUEST_LIFT_TO_DRIVER_TITLE"
-                notification_body = "REQUEST_LIFT_TO_DRIVER_BODY"
-            elif message['status'] == 'ACTIVE':
-                notification_title = "ACCEPTED_LIFT_TITLE"
-                notification_body = "ACCEPTED_LIFT_BODY"
-            elif message['status'] == 'REFUSED':
-                notification_title = "REFUSED_LIFT_TITLE"
-                notification_body = "REFUSED_LIFT_BODY"
-            elif message['status'] == 'CANCELLED':
-                notification_title = "CANCELLED_LIFT_TITLE"
-                notification_body = "CANCELLED_LIFT_BODY"
-            data = 'to=%s&api_key=%s&notification_title=%s&notification_body=%s&data_title=%s&data_body=%s' % (fcm_token, FCM_API_KEY, notification_title, notification_body, data_title, data_str)
-        elif platform == 'ANDROID':
-            platform_url = 'FCMConnectorService/messaging/data-message/send'
-            data_str = '%s' % (message)
-            data_str = remove_non_ascii(data_str)
-            data = 'to=%s&api_key=%s&payload_data=%s' % (fcm_token, FCM_API_KEY, data_str)
-            
-        url = 'http://%s:%d/%s' % (FCM_HOST, FCM_PORT, platform_url)
-        headers = {'content-type': 'application/x-www-form-urlencoded'}
-        res = requests.post(url, data=data, headers=headers)
-        if res.status_code != 200:
-            app.logger.error("Error with notification (%s, \"%s\")" % (url, data))
-    t = threading.Thread(target = send_push_notification, args = [user_id, lift])
-    t.start()
+    # The payload is built now, while the request is available; the user is
+    # looked up and notified later by a notification worker
+    assert isinstance(user_id, str)
+    assert isinstance(lift, dict)
+    message = copy.deepcopy(lift)
+    message['type'] = 'lift'
+    message = filter_data(actual_resource(request), request, message)
+    notification_dispatcher.submit(user_id, message)
 
 #===============================================================================
 # notification_thread_message ()
 #===============================================================================
 def notification_thread_message(user_id, message):
-    
-    # send_push_notification ()
-    # The copy_current_request_context decorator ensures that the HTTP request that is active when a function is called
-    # remains active even when the function is subsequently executed in a thread
-    @copy_current_request_context
-    def send_push_notification(user_id, message):
-        message['type'] = 'message'
-        assert isinstance(user_id, str)
-        assert isinstance(message, dict)
-        user_id = str_to_oid(user_id)
-        message = filter_data(actual_resource(request), request, message)
-        
-        user = app.data.driver.db['users'].find_one({'_id': user_id})
-        assert user and user['_id'] == user_id
-        fcm_token = user['fcm_token']
-        platform = user['platform'] if 'platform' in user else 'ANDROID'
-
-        # if user platform is iOS send custom payload
-        if platform == 'IOS':
-            platform_url = 'FCMConnectorService/messaging/notification-message/send'
-            data_str = '%s' % (message)
-            data_str = remove_non_ascii(data_str)
-            data_title = "Sample_Title"
-            notification_title = "MESSAGE_TITLE"
-            notification_body = "MESSAGE_BODY"
-            data = 'to=%s&api_key=%s&notification_title=%s&notification_body=%s&data_title=%s&data_body=%s' % (fcm_token, FCM_API_KEY, notification_title, notification_body, data_title, data_str)
-        elif platform == 'ANDROID':
-            platform_url = 'FCMConnectorService/messaging/data-message/send'
-            data_str = '%s' % (message)
-            data_str = remove_non_ascii(data_str)
-            data = 'to=%s&api_key=%s&payload_data=%s' % (fcm_token, FCM_API_KEY, data_str)
-            
-        url = 'http://%s:%d/%s' % (FCM_HOST, FCM_PORT, platform_url)
-        headers = {'content-type': 'application/x-www-form-urlencoded'}
-        res = requests.post(url, data=data, headers=headers)
-        if res.status_code != 200:
-            app.logger.error("Error with notification (%s, \"%s\")" % (url, data))
-    t = threading.Thread(target = send_push_notification, args = [user_id, message])
-    t.start()
+    # The payload is built now, while the request is available; the user is
+    # looked up and notified later by a notification worker
+    assert isinstance(user_id, str)
+    assert isinstance(message, dict)
+    message = copy.deepcopy(message)
+    message['type'] = 'message'
+    message = filter_data(actual_resource(request), request, message)
+    notification_dispatcher.submit(user_id, message)
 
 #===============================================================================
 # send_push_notification_eta ()
 #===============================================================================
 def send_push_notification_eta(user_id, message):
+    # Returns at once with the NotificationTicket of the notification, which
+    # is delivered by a notification worker
     message['type'] = 'eta'
     assert isinstance(user_id, str)
     assert isinstance(message, dict)
-    user_id = str_to_oid(user_id)
     message = filter_data(actual_resource(request), request, message)
-
-    user = app.data.driver.db['users'].find_one({'_id': user_id})
-    assert user and user['_id'] == user_id
-    fcm_token = user['fcm_token']
-    platform = user['platform'] if 'platform' in user else 'ANDROID'
-
-    # if user platform is iOS send custom payload
-    if platform == 'IOS':
-        platform_url = 'FCMConnectorService/messaging/notification-message/send'
-        data_str = '%s' % (message)
-        data_str = remove_non_ascii(data_str)
-        data_title = "Sample_Title"
-        notification_title = "REQUEST_LIFT_TO_DRIVER_TITLE"
-        notification_body = "REQUEST_LIFT_TO_DRIVER_BODY"
-        data = 'to=%s&api_key=%s&notification_title=%s&notification_body=%s&data_title=%s&data_body=%s' % (fcm_token, FCM_API_KEY, notification_title, notification_body, data_title, data_str)
-    elif platform == 'ANDROID':
-        platform_url = 'FCMConnectorService/messaging/data-message/send'
-        data_str = '%s' % (message)
-        data_str = remove_non_ascii(data_str)
-        data = 'to=%s&api_key=%s&payload_data=%s' % (fcm_token, FCM_API_KEY, data_str)
-        
-    url = 'http://%s:%d/%s' % (FCM_HOST, FCM_PORT, platform_url)
-    headers = {'content-type': 'application/x-www-form-urlencoded'}
-    res = requests.post(url, data=data, headers=headers)
-    if res.status_code != 200:
-        app.logger.error("Error with notification (%s, \"%s\")" % (url, data))
+    return notification_dispatcher.submit(user_id, message)
 
 #===============================================================================
 # check_auth_for_statistics ()
@@ -1514,11 +1831,7 @@ def send_push_notification_eta(user_id, message):
 def check_auth_for_statistics(username, password):
     #This function is called to check if a username password combination belongs to an admin user.
     
-    # Check if user is an admin
-    admin = app.data.driver.db['admins'].find_one({'username': username})
-    if admin and admin['password'] == password and not item_deleted(admin):
-        return True
-    return False
+    return verified_role(username, password) == 'admin'
 
 #===============================================================================
 # authenticate ()
@@ -1547,53 +1860,122 @@ def requires_auth(f):
 # update_sites_carpool_info ()
 #===============================================================================
 def update_sites_carpool_info(ride):
-    # Fetch collection 'sites' from db
     collection = app.data.driver.db['sites']
-    cursor = collection.find({})
-    # For every site in db
-    for site in cursor:
-        bb_minlat = site['bounding_box']['min_lat']
-        bb_minlon = site['bounding_box']['min_lon']
-        bb_maxlat = site['bounding_box']['max_lat']
-        bb_maxlon = site['bounding_box']['max_lon']
-        s_lat = ride['start_point']['lat']
-        s_lon = ride['start_point']['lon']
-        t_lat = ride['end_point']['lat']
-        t_lon = ride['end_point']['lon']
-        # Check ii given coordinates are within a site's bounding box and take url
-        if inside_bounding_box(bb_minlat, bb_minlon, bb_maxlat, bb_maxlon, s_lat, s_lon, t_lat, t_lon):
-            site['carpooling_info']['version'] = site['carpooling_info']['version'] + 1
-            site['carpooling_info']['updated'] = int(time.time())
-            collection.update({'_id': site['_id']}, site, upsert = False)
+    s_lat = ride['start_point']['lat']
+    s_lon = ride['start_point']['lon']
+    t_lat = ride['end_point']['lat']
+    t_lon = ride['end_point']['lon']
+    # For every site whose bounding box contains the given coordinates
+    for site in site_registry.find_all(s_lat, s_lon, t_lat, t_lon):
+        update = {
+            '$inc': {'carpooling_info.version': 1},
+            '$set': {'carpooling_info.updated': int(time.time())},
+        }
+        collection.update({'_id': site['_id']}, update, upsert = False)
 
 #===============================================================================
 # update_sites_reports_info ()
 #===============================================================================
 def update_sites_reports_info(reports):
-    # Fetch collection 'sites' from db
     collection = app.data.driver.db['sites']
-    cursor = collection.find({})
-    # For every site in db
-    for site in cursor:
-        bb_minlat = site['bounding_box']['min_lat']
-        bb_minlon = site['bounding_box']['min_lon']
-        bb_maxlat = site['bounding_box']['max_lat']
-        bb_maxlon = site['bounding_box']['max_lon']
-        s_lat = reports['location']['geometry']['coordinates'][1]
-        s_lon = reports['location']['geometry']['coordinates'][0]
-        t_lat = reports['location']['geometry']['coordinates'][1]
-        t_lon = reports['location']['geometry']['coordinates'][0]
-        # Check ii given coordinates are within a site's bounding box and take url
-        if inside_bounding_box(bb_minlat, bb_minlon, bb_maxlat, bb_maxlon, s_lat, s_lon, t_lat, t_lon):
-            site['reports_info']['version'] = site['reports_info']['version'] + 1
-            site['reports_info']['updated'] = int(time.time())
-            collection.update({'_id': site['_id']}, site, upsert = False)
+    lat = reports['location']['geometry']['coordinates'][1]
+    lon = reports['location']['geometry']['coordinates'][0]
+    # For every site whose bounding box contains the given coordinates
+    for site in site_registry.find_all(lat, lon, lat, lon):
+        update = {
+            '$inc': {'reports_info.version': 1},
+            '$set': {'reports_info.updated': int(time.time())},
+        }
+        collection.update({'_id': site['_id']}, update, upsert = False)
+
+#===============================================================================
+# check_search_indexes ()
+#===============================================================================
+def check_search_indexes():
+    # Eve creates the indexes of the search fields at startup, but silently
+    # leaves them out if e.g. an index with the same keys already exists
+    with app.app_context():
+        for resource, search_fields in RESOURCE_SEARCH_FIELDS.items():
+            source = app.config['DOMAIN'][resource]['datasource']['source']
+            try:
+                index_information = app.data.driver.db[source].index_information()
+            except PyMongoError as e:
+                app.logger.warning('Could not check indexes of %s (%s)' % (source, e))
+                continue
+            for field in unindexed_search_fields(search_fields, index_information):
+                app.logger.warning('Search field %s of %s is not indexed' % (field, resource))
+
+#===============================================================================
+# collect_app_metrics ()
+#===============================================================================
+def collect_app_metrics():
+    # Metrics of this worker reported by /metrics, besides those of requests
+    notifications = notification_dispatcher.stats()
+    samples = [ ('gauge', 'socialcar_notification_queue_depth', {}, notifications['queued']) ]
+    for status in [ 'sent', 'failed', 'dropped', 'retried' ]:
+        samples.append(('counter', 'socialcar_notifications_total', {'status': status}, notifications[status]))
+    caches = {
+        'route_plan': route_plan_cache,
+        'credentials': credentials_cache,
+        'owners': owners_cache,
+        'rides_boundary': rides_boundary_cache,
+    }
+    for name, cache in caches.items():
+        stats = cache.stats()
+        samples.append(('counter', 'socialcar_cache_hits_total', {'cache': name}, stats.get('hits', 0)))
+        samples.append(('counter', 'socialcar_cache_misses_total', {'cache': name}, stats.get('misses', 0)))
+    return samples
 
 #===============================================================================
 # main ()
 #===============================================================================
+# Time db commands of requests; must be registered before Eve's db client is
+# created
+monitoring.register(MongoCommandTimer(instrumentation))
+
 app = Eve(auth=my_basic_auth, settings=os.path.join(SCRIPT_PATH, 'settings.py'), static_folder=STATISTICS_SCRIPT_FOLDER)
 
+# Warn about searches that would scan whole collections
+check_search_indexes()
+
+# Sites are loaded once per worker and refreshed when they change
+site_registry = SiteRegistry(lambda: app.data.driver.db['sites'])
+
+# Route Planning services are called through pooled keep-alive connections
+route_planner = RoutePlannerClient()
+
+# Push notifications are delivered in the background by a few threads per
+# worker, which can use the db like any request
+notification_dispatcher = NotificationDispatcher(find_notified_users, app.app_context, app.logger)
+
+# Valid credentials and owners of items are cached to authorize requests
+# without db queries
+credentials_cache = LRUCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+owners_cache = LRUCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+# Serialized responses of rides_boundary, by site, area and site version
+rides_boundary_cache = LRUCache(RIDES_BOUNDARY_CACHE_SIZE, RIDES_BOUNDARY_CACHE_TTL,
+                                RIDES_BOUNDARY_CACHE_BYTES, lambda cached: len(cached[0]))
+
+# Fares are computed with the tariffs shipped in tariffs.json, unless a site
+# overrides them in its 'price_info.tariffs'
+fare_engine = FareEngine(load_tariffs(), app.logger)
+
+# Raw answers of the Route Planning services are cached, either per worker or
+# (with a small per-worker cache in front) in db so all workers share them
+if ROUTE_PLAN_CACHE == 'mongo':
+    route_plan_cache = RoutePlanCache(TieredCache(
+        LRUCache(ROUTE_PLAN_CACHE_SIZE, ROUTE_PLAN_CACHE_TTL),
+        MongoCache(lambda: app.data.driver.db['route_plan_cache'], ROUTE_PLAN_CACHE_TTL)))
+elif ROUTE_PLAN_CACHE == 'local':
+    route_plan_cache = RoutePlanCache(LRUCache(ROUTE_PLAN_CACHE_SIZE, ROUTE_PLAN_CACHE_TTL))
+else:
+    route_plan_cache = RoutePlanCache(None)
+
+# Metrics of all workers are exported at /metrics
+metrics_exporter = MetricsExporter(instrumentation)
+metrics_exporter.add_collector(collect_app_metrics)
+
 # Database event hooks
 app.on_insert += before_insert
 app.on_update += before_update
@@ -1626,6 +2008,19 @@ app.on_replaced_reports += after_replace_report
 app.on_updated_reports += after_update_report
 app.on_insert_messages += before_insert_messages
 app.on_inserted_messages += after_insert_messages
+app.on_updated += forget_ownership
+app.on_replaced += forget_ownership
+app.on_deleted_item += forget_ownership
+app.on_updated_users += forget_credentials
+app.on_replaced_users += forget_credentials
+app.on_deleted_item_users += forget_credentials
+app.on_insert_sites += before_insert_sites
+app.on_update_sites += check_site_tariffs
+app.on_replace_sites += check_site_tariffs
+app.on_inserted_sites += site_registry.invalidate
+app.on_replaced_sites += site_registry.invalidate
+app.on_updated_sites += site_registry.invalidate
+app.on_deleted_item_sites += site_registry.invalidate
 
 # Requests event hooks
 app.on_pre_GET += before_GET
@@ -1656,28 +2051,70 @@ if USE_SENTRY:
     setup_logging(sentry_handler)
     app.logger.addHandler(sentry_handler)
 
+#===============================================================================
+# start_request_timers ()
+#===============================================================================
+@app.before_request
+def start_request_timers():
+    instrumentation.start_request()
+
+#===============================================================================
+# finish_request_timers ()
+#===============================================================================
+@app.after_request
+def finish_request_timers(response):
+    # Registered before the other after_request functions, so it runs last
+    # Paths that are not resources (e.g. 404s) share a label, so clients
+    # cannot add label values (and metrics) at will
+    resource = actual_resource(request)
+    if resource not in app.config['DOMAIN'] and resource not in CUSTOM_ENDPOINTS:
+        resource = 'other'
+    timings = instrumentation.finish_request(resource, request.method)
+    metrics_exporter.write()
+    if DEBUG and timings is not None:
+        response.headers['Server-Timing'] = server_timing(timings)
+        response.headers['X-DB-Queries'] = str(timings['db_queries'])
+    return response
+
 #===============================================================================
 # log_request ()
 #===============================================================================
 @app.before_request
 def log_request():
-    data = str(request.data.decode()) if request.data else ''
+    # Whether the request is logged is decided once, so a response is logged
+    # iff its request was
     user = request.authorization['username'] if request.authorization else None
-    if user not in EXCLUDE_FROM_LOGS:
-        app.logger.debug('%s Request %s' % (user, data))
+    g.logged = app.logger.isEnabledFor(logging.DEBUG) and \
+               user not in EXCLUDE_FROM_LOGS and \
+               actual_resource(request) not in LOG_EXCLUDED_RESOURCES and \
+               random.random() < LOG_SAMPLE_RATE
+    if g.logged:
+        # Other bodies (e.g. picture uploads) are neither buffered nor logged
+        if request.is_json:
+            data = truncate_body(request.get_data(), LOG_BODY_MAX_SIZE)
+        else:
+            data = '<content type not json>'
+        app.logger.debug(log_record(event='request', user=user, method=request.method,
+                                    path=request.full_path, body=data))
 
 #===============================================================================
 # log_response ()
 #===============================================================================
 @app.after_request
 def log_response(response):
-    if response.content_type == 'application/json':
-        data = str(response.data.decode()) if response.data else ''
+    if not g.get('logged'):
+        return response
+    if response.is_streamed:
+        # Reading the body would consume the stream
+        data = '<streamed>'
+    elif response.content_type == 'application/json':
+        data = truncate_body(response.get_data(), LOG_BODY_MAX_SIZE)
     else:
         data = '<content type not json>'
     user = request.authorization['username'] if request.authorization else None
-    if user not in EXCLUDE_FROM_LOGS:
-        app.logger.debug('%s Response %s' % (user, data))
+    app.logger.debug(log_record(event='response', user=user, method=request.method,
+                                path=request.full_path, status=response.status_code,
+                                size=response.content_length, body=data))
     return response
 
 #===============================================================================
@@ -1715,6 +2152,15 @@ def print_statistics_csv():
     statisticsCSV_main(MONGO_DBNAME)
     return send_from_directory(STATISTICS_SCRIPT_FOLDER, 'user_activity.csv')
 
+#===============================================================================
+# print_metrics ()
+#===============================================================================
+@app.route('/metrics')
+@requires_auth
+# Custom endpoint for Prometheus metrics of all workers (e.g http://127.0.0.1:5000/metrics)
+def print_metrics():
+    return Response(metrics_exporter.render(), mimetype='text/plain; version=0.0.4')
+
 #===============================================================================
 # send_exception_info_to_sentry ()
 #===============================================================================
@@ -1745,12 +2191,14 @@ if LOG_EVERY_REQ_AND_RES:
 
     # Enable also logging to file (create new log file when size reaches 10MB)
     file_handler = logging.handlers.RotatingFileHandler(
-         os.path.join(SCRIPT_PATH, '../logs', 'log'), maxBytes=1000000, backupCount=1000)
+         os.path.join(SCRIPT_PATH, '../logs', 'log'), maxBytes=10000000, backupCount=100,
+         delay=True)
     file_handler.setFormatter(logging.Formatter(
         '%(asctime)s %(levelname)s %(clientip)s %(message)s'
         ' CONTEXT: %(method)s %(url)s %(filename)s:%(lineno)d'))
     file_handler.setLevel(logging.DEBUG)
-    app.logger.addHandler(file_handler)
+    # Records are written to file by a separate thread of each worker
+    app.logger.addHandler(AsyncLogHandler([ file_handler ]))
 
     # This must be set to the minimum level of all loggers
     app.logger.setLevel(logging.DEBUG)
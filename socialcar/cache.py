@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+#===============================================================================
+# LRUCache ()
+#===============================================================================
+class LRUCache(object):
+    """
+    Thread-safe in-process cache. Entries expire 'ttl' seconds after they are
+    set and, once 'maxsize' entries (or, if given, 'maxbytes' bytes as measured
+    by 'sizeof' of the values) are stored, the least recently used entries are
+    evicted. Each worker process has its own copy.
+
+    Examples:
+    >>> c = LRUCache(maxsize=2, ttl=60)
+    >>> c.set('a', 1); c.set('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.set('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> c.get('a'), c.get('c')
+    (1, 3)
+    >>> c.stats()['hits'], c.stats()['misses']
+    (3, 1)
+    >>> c = LRUCache(maxsize=10, ttl=60, maxbytes=5)
+    >>> c.set('a', b'abc'); c.set('b', b'de'); c.set('c', b'f')
+    >>> c.get('a') is None, c.stats()['bytes']
+    (True, 3)
+    """
+    def __init__(self, maxsize=1000, ttl=300, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (value, time.time() + self.ttl)
+            if self.maxbytes is not None:
+                self.bytes += self.sizeof(value)
+            while len(self.entries) > self.maxsize or \
+                  (self.maxbytes is not None and self.bytes > self.maxbytes):
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        # Must be called with the lock held
+        entry = self.entries.pop(key, None)
+        if entry is not None and self.maxbytes is not None:
+            self.bytes -= self.sizeof(entry[0])
+
+    def delete(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses, 'size': len(self.entries),
+                 'bytes': self.bytes }
+
+#===============================================================================
+# MongoCache ()
+#===============================================================================
+class MongoCache(object):
+    """
+    Cache shared by all worker processes, stored in a db collection. Expired
+    entries are ignored on read and removed by a TTL index on 'expires'.
+    Values must be storable in db (e.g. strings).
+
+    Args:
+        get_collection: function returning the collection used as storage
+        ttl: seconds after which entries expire
+    """
+    def __init__(self, get_collection, ttl=300):
+        self.get_collection = get_collection
+        self.ttl = ttl
+        self.indexed = False
+        self.hits = 0
+        self.misses = 0
+
+    def collection(self):
+        collection = self.get_collection()
+        if not self.indexed:
+            collection.create_index('expires', expireAfterSeconds=0)
+            self.indexed = True
+        return collection
+
+    def get(self, key):
+        now = datetime.datetime.utcnow()
+        entry = self.collection().find_one({'_id': key, 'expires': {'$gt': now}})
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['value']
+
+    def set(self, key, value):
+        expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl)
+        self.collection().update({'_id': key}, {'_id': key, 'value': value, 'expires': expires}, upsert = True)
+
+    def delete(self, key):
+        self.collection().remove({'_id': key})
+
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses }
+
+#===============================================================================
+# TieredCache ()
+#===============================================================================
+class TieredCache(object):
+    """
+    Looks up entries in a fast (usually in-process) cache first and falls back
+    to a slower shared one, copying the entries found there into the fast one.
+
+    Examples:
+    >>> shared = LRUCache()
+    >>> c = TieredCache(LRUCache(), shared)
+    >>> shared.set('a', 1)
+    >>> c.get('a'), c.first.get('a')
+    (1, 1)
+    """
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def get(self, key):
+        value = self.first.get(key)
+        if value is None:
+            value = self.second.get(key)
+            if value is not None:
+                self.first.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.first.set(key, value)
+        self.second.set(key, value)
+
+    def delete(self, key):
+        self.first.delete(key)
+        self.second.delete(key)
+
+    def stats(self):
+        first, second = self.first.stats(), self.second.stats()
+        # A request is a miss only if it missed both caches
+        return { 'hits': first['hits'] + second['hits'], 'misses': second['misses'] }
@@ -1,18 +1,25 @@
-import pymongo
+import bisect
+import json
+import logging
 import os
+import threading
+import time
+import pymongo
 from socialcar.settings import MONGO_DBNAME
 
-TABLE_OF_ZONES = [[1,1,3,1,1,2,3,2,2,1],
-                  [1,1,2,1,1,2,3,2,2,1],
-                  [3,2,1,3,3,3,3,3,3,3],
-                  [1,1,3,1,1,2,2,2,2,1],
-                  [1,1,3,1,1,2,3,2,2,1],
-                  [2,2,3,2,2,1,3,2,2,2],
-                  [3,3,3,2,3,3,1,3,3,3],
-                  [2,2,3,2,2,2,3,1,2,2],
-                  [2,2,3,2,2,2,3,2,1,2],
-                  [1,1,3,1,1,2,3,2,2,1]]
+# Default tariffs of the sites, by site name. Each site has a 'modes' dict with
+# the pricing rule of each travel mode and an optional 'rules' dict of named
+# rules that can be referred to (by name) from other rules of the site.
+TARIFFS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tariffs.json')
+
+# Travel modes that have a fare; legs of any other mode (e.g. FEET) are free
+PRICED_TRAVEL_MODES = [ 'METRO', 'BUS', 'RAIL', 'TRAM', 'CAR_POOLING' ]
 
+# Price of legs for which the site has no tariff
+UNKNOWN_FARE = -1
+
+# Factors converting kilometers to the distance unit of a tariff
+DISTANCE_UNITS = { 'km': 1.0, 'mile': 0.621 }
 
 MONGO_HOST = os.environ.get('MONGO_HOST', 'localhost')
 MONGO_PORT = int(os.environ.get('MONGO_PORT', 27017))
@@ -21,383 +28,330 @@ MONGO_PASSWORD = os.environ.get('MONGO_PASSWORD', '')
 MONGO_ZONE_ID_COLLECTION = 'citybus_zone'
 BUS_STOP_ID = 'lpp_id'
 
+# Every worker checks the bus stop zones for changes at most this often (secs)
+ZONES_REFRESH_INTERVAL = int(os.environ.get('ZONES_REFRESH_INTERVAL', 60))
+
 #===============================================================================
-# rail_fare ()
+# load_tariffs ()
 #===============================================================================
-def rail_fare(distance, name):
-    # convert meters to kilometers
-    distance = float(distance)/1000
-    # in case tariff per km is used as in .xlsx for Brussels
-    if name == 'Brussels':
-        if distance <= 8:
-            return 2.20
-        elif distance <= 9:
-            return 2.30
-        elif distance <= 10:
-            return 2.40
-        elif distance <= 11:
-            return 2.60
-        elif distance <= 12:
-            return 2.70
-        elif distance <= 13:
-            return 2.80
-        elif distance <= 14:
-            return 3.00
-        elif distance <= 15:
-            return 3.10
-        elif distance <= 16:
-            return 3.20
-        elif distance <= 17:
-            return 3.40
-        elif distance <= 18:
-            return 3.50
-        elif distance <= 19:
-            return 3.70
-        elif distance <= 20:
-            return 3.80
-        elif distance <= 21:
-            return 3.90
-        elif distance <= 22:
-            return 4.10
-        elif distance <= 23:
-            return 4.20
-        elif distance <= 24:
-            return 4.40
-        elif distance <= 25:
-            return 4.50
-        elif distance <= 26:
-            return 4.60
-        elif distance <= 27:
-            return 4.80
-        elif distance <= 28:
-            return 4.90
-        elif distance <= 29:
-            return 5.10
-        elif distance <= 30:
-            return 5.20
-        elif distance <= 33:
-            return 5.50
-        elif distance <= 36:
-            return 5.90
-        elif distance <= 39:
-            return 6.30
-        elif distance <= 42:
-            return 6.70
-        elif distance <= 45:
-            return 7.10
-        elif distance <= 48:
-            return 7.60
-        elif distance <= 51:
-            return 8.00
-        elif distance <= 54:
-            return 8.40
-        elif distance <= 57:
-            return 8.80
-        elif distance <= 60:
-            return 9.20
-        elif distance <= 65:
-            return 9.80
-        elif distance <= 70:
-            return 10.50
-        elif distance <= 75:
-            return 11.20
-        elif distance <= 80:
-            return 11.90
-        elif distance <= 85:
-            return 12.60
-        elif distance <= 90:
-            return 13.30
-        elif distance <= 95:
-            return 14.00
-        elif distance <= 100:
-            return 14.70
-        elif distance <= 105:
-            return 15.30
-        elif distance <= 110:
-            return 16.00
-        elif distance <= 115:
-            return 16.70
-        elif distance <= 120:
-            return 17.40
-        elif distance <= 125:
-            return 18.10
-        elif distance <= 130:
-            return 18.80
-        elif distance <= 135:
-            return 19.50
-        elif distance <= 140:
-            return 20.20
-        elif distance <= 145:
-            return 20.90
-        else:
-            return 21.90
-    # in case tariff per km is used instead of City - Rail Ljubljana (2.2 EUR fare) as in .xlsx for Ljubljana
-    elif name == 'Ljubljana':
-        if distance <= 10:
-            return 1.28
-        elif distance <= 20:
-            return 1.85
-        elif distance <= 30:
-            return 2.58
-        elif distance <= 40:
-            return 3.44
-        elif distance <= 50:
-            return 4.28
-        elif distance <= 60:
-            return 5.08
-        elif distance <= 70:
-            return 5.80
-        elif distance <= 80:
-            return 6.59
-        elif distance <= 90:
-            return 6.99
-        elif distance <= 100:
-            return 7.17
-        elif distance <= 120:
-            return 7.70
-        elif distance <= 140:
-            return 8.49
-        elif distance <= 160:
-            return 9.56
-        elif distance <= 180:
-            return 10.91
-        elif distance <= 200:
-            return 12.02
-        elif distance <= 220:
-            return 12.95
-        elif distance <= 240:
-            return 13.99
-        elif distance <= 260:
-            return 14.77
-        elif distance <= 280:
-            return 15.81
-        elif distance <= 300:
-            return 16.68
-        elif distance <= 320:
-            return 17.67
-        elif distance <= 340:
-            return 18.58
-        elif distance <= 360:
-            return 19.50
-        elif distance <= 380:
-            return 20.54
-        elif distance <= 400:
-            return 21.59
-        elif distance <= 420:
-            return 22.37
-        elif distance <= 440:
-            return 23.29
-        elif distance <= 460:
-            return 24.34
-        elif distance <= 480:
-            return 25.24
-        elif distance <= 500:
-            return 26.44
-        elif distance <= 525:
-            return 27.47
-        elif distance <= 550:
-            return 28.67
-        elif distance <= 575:
-            return 30.10
-        else:
-            return 31.29
-    else:
-        return -1
+def load_tariffs(path=TARIFFS_FILE):
+    with open(path) as f:
+        return json.load(f)
 
 #===============================================================================
-# bus_fare ()
+# leg_distance ()
 #===============================================================================
-def bus_fare(leg, name):
-    if name == 'Brussels':
-        # If provider is TEC
-        if leg['transport']['agency_id'] == 'TEC':
-            return 3.50
-        # If provider is De Lijn
-        else:
-            return 3.00
-    elif name == 'Ljubljana':
-        # from 'agency_id'  find type of bus (citybus or intercity), e.g for citybus:'lpp_2197', intercity: '2206108040402'
-        if leg['transport']['agency_id'] == 'lpp':
-            return citybus_ljubljana(leg['route']['points'][0]['stop_id'], leg['route']['points'][-1]['stop_id'], leg['distance'])
+def leg_distance(leg, unit):
+    # convert meters to kilometers (or miles)
+    return float(leg['distance'])/1000 * DISTANCE_UNITS[unit]
+
+#===============================================================================
+# StopZones ()
+#===============================================================================
+class StopZones(object):
+    """
+    In-memory map of bus stop ids to the zone they belong to, so fares by
+    zone can be computed without any db query. The map is loaded once per
+    worker; every 'refresh_interval' seconds the zones are read again and the
+    map is rebuilt only if they changed. Stops that are not in the map are
+    considered outside the zones (zone 0).
+
+    Args:
+        get_collection: function returning the collection with the zones
+        refresh_interval: max time (secs) before changes of the zones are seen
+
+    Examples:
+    >>> z = StopZones(None)
+    >>> z.load([{'lpp_id': '100', 'zone_id': 1}, {'lpp_id': '200', 'zone_id': 3}])
+    >>> z.zones('100', '200'), z.zones('100', '300')
+    ((1, 3), (1, 0))
+    """
+    def __init__(self, get_collection, refresh_interval=ZONES_REFRESH_INTERVAL):
+        self.get_collection = get_collection
+        self.refresh_interval = refresh_interval
+        self.zone_ids = {}
+        self.fingerprint = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    #---------------------------------------------------------------------------
+    # load ()
+    #---------------------------------------------------------------------------
+    def load(self, stops):
+        pairs = sorted((str(stop[BUS_STOP_ID]), str(stop['zone_id'])) for stop in stops)
+        # The map is only replaced if the zones changed
+        fingerprint = hash(tuple(pairs))
+        if fingerprint != self.fingerprint:
+            self.zone_ids = { stop[BUS_STOP_ID]: stop['zone_id'] for stop in stops }
+            self.fingerprint = fingerprint
+        self.loaded_at = time.time()
+
+    #---------------------------------------------------------------------------
+    # ensure_fresh ()
+    #---------------------------------------------------------------------------
+    def ensure_fresh(self):
+        if self.loaded_at is not None and \
+           time.time() - self.loaded_at <= self.refresh_interval:
+            return
+        # Only one thread of the worker reads the zones; the others keep using
+        # the previous map meanwhile (or wait for the first one to be loaded)
+        if not self.lock.acquire(self.loaded_at is None):
+            return
+        try:
+            if self.loaded_at is None or \
+               time.time() - self.loaded_at > self.refresh_interval:
+                self.load(list(self.get_collection().find({}, { '_id': 0, BUS_STOP_ID: 1, 'zone_id': 1 })))
+        finally:
+            self.lock.release()
+
+    #---------------------------------------------------------------------------
+    # zones ()
+    #---------------------------------------------------------------------------
+    def zones(self, start_id, end_id):
+        self.ensure_fresh()
+        zone_ids = self.zone_ids
+        return zone_ids.get(start_id, 0), zone_ids.get(end_id, 0)
+
+#===============================================================================
+# MongoZonesCollection ()
+#===============================================================================
+class MongoZonesCollection(object):
+    """
+    Returns the zones collection through a single client per worker process
+    (clients must not be shared with forked workers).
+    """
+    def __init__(self):
+        self.pid = None
+        self.client = None
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        # have a collection in db with stop_id, zone_id to find the zone each bus stop belongs to (e.g db collection citybus_zone)
+        with self.lock:
+            if self.pid != os.getpid():
+                self.client = pymongo.MongoClient(MONGO_HOST, MONGO_PORT)
+                self.pid = os.getpid()
+        return self.client[MONGO_DBNAME][MONGO_ZONE_ID_COLLECTION]
+
+stop_zones = StopZones(MongoZonesCollection())
+
+#===============================================================================
+# compile_flat ()
+#===============================================================================
+def compile_flat(rule, rules):
+    price = float(rule['price'])
+    return lambda leg: price
+
+#===============================================================================
+# compile_distance_table ()
+#===============================================================================
+def compile_distance_table(rule, rules):
+    """
+    Price i applies to distances up to (and including) breakpoint i; the last
+    price applies to distances above the last breakpoint.
+
+    Examples:
+    >>> fare = compile_distance_table({'breakpoints': [5, 10], 'prices': [1.0, 2.0, 3.0]}, {})
+    >>> [ fare({'distance': d}) for d in (100, 5000, 5001, 10000, 99000) ]
+    [1.0, 1.0, 2.0, 2.0, 3.0]
+    """
+    breakpoints = [ float(breakpoint) for breakpoint in rule['breakpoints'] ]
+    prices = [ float(price) for price in rule['prices'] ]
+    if breakpoints != sorted(breakpoints) or len(prices) != len(breakpoints) + 1:
+        raise ValueError('Distance table needs sorted breakpoints and one more price than breakpoints')
+    unit = rule.get('unit', 'km')
+    return lambda leg: prices[bisect.bisect_left(breakpoints, leg_distance(leg, unit))]
+
+#===============================================================================
+# compile_linear ()
+#===============================================================================
+def compile_linear(rule, rules):
+    """
+    Price per distance unit is 'rate' up to 'limit' units, and 'rate_above'
+    for the rest of the distance.
+
+    Examples:
+    >>> fare = compile_linear({'limit': 10, 'rate': 0.5, 'rate_above': 0.25}, {})
+    >>> fare({'distance': 4000}), fare({'distance': 14000})
+    (2.0, 6.0)
+    """
+    unit = rule.get('unit', 'km')
+    limit = float(rule['limit'])
+    rate = float(rule['rate'])
+    rate_above = float(rule.get('rate_above', rate))
+
+    def fare(leg):
+        distance = leg_distance(leg, unit)
+        if distance <= limit:
+            return rate * distance
         else:
-            return bus_intercity_ljubljana(leg['distance'])
-    elif name == 'Canton Ticino':
-        return 2.20 # ??how to calculate fare for 13 zones??
-    else:
-        return -1
+            return (rate * limit) + (distance - limit) * rate_above
+    return fare
 
 #===============================================================================
-# citybus_ljubljana ()
+# compile_agency ()
 #===============================================================================
-def citybus_ljubljana(start_id, end_id, distance):
-    # have a collection in db with stop_id, zone_id to find the zone each bus stop belongs to (e.g db collection citybus_zone)
-    client = pymongo.MongoClient(MONGO_HOST, MONGO_PORT)
-    db = client[MONGO_DBNAME]
-    collection = db[MONGO_ZONE_ID_COLLECTION] # name of collection in db for stop_id --> zone_id mapping
-    # find zone_id for first and last bus stops
-    start = collection.find_one({BUS_STOP_ID: start_id})
-    end = collection.find_one({BUS_STOP_ID: end_id})
-    # from TABLE_OF_ZONES find the number of zones crossed
-    if start['zone_id'] == 0 or end['zone_id'] == 0:
-        # if 'zone_id' == 0 use intercity bus fare
-        return bus_intercity_ljubljana(distance)
-    else:
-        number_of_zones = TABLE_OF_ZONES[start['zone_id']-1][end['zone_id']-1]
-
-    if number_of_zones == 1:
-        return 1.20
-    elif number_of_zones == 2:
-        return 1.60
-    else:
-        return 2.50
+def compile_agency(rule, rules):
+    agencies = { agency_id: compile_rule(agency_rule, rules)
+                 for agency_id, agency_rule in rule.get('agencies', {}).items() }
+    default = compile_rule(rule['default'], rules) if 'default' in rule else None
+
+    def fare(leg):
+        agency_fare = agencies.get(leg['transport'].get('agency_id'), default)
+        return agency_fare(leg) if agency_fare else UNKNOWN_FARE
+    return fare
 
 #===============================================================================
-# bus_intercity_ljubljana ()
+# compile_zones ()
 #===============================================================================
-def bus_intercity_ljubljana(distance):
-    # convert meters to kilometers
-    distance = float(distance)/1000
-    if distance <= 5:
-        return 1.30
-    elif distance <= 10:
-        return 1.80
-    elif distance <= 15:
-        return 2.30
-    elif distance <= 20:
-        return 2.70
-    elif distance <= 25:
-        return 3.10
-    elif distance <= 30:
-        return 3.60
-    elif distance <= 35:
-        return 4.10
-    elif distance <= 40:
-        return 4.70
-    elif distance <= 45:
-        return 5.20
-    elif distance <= 50:
-        return 5.60
-    elif distance <= 55:
-        return 6.00
-    elif distance <= 60:
-        return 6.30
-    elif distance <= 65:
-        return 6.70
-    elif distance <= 70:
-        return 6.90
-    elif distance <= 75:
-        return 7.20
-    elif distance <= 80:
-        return 7.50
-    elif distance <= 85:
-        return 7.90
-    elif distance <= 90:
-        return 8.30
-    elif distance <= 95:
-        return 8.70
-    elif distance <= 100:
-        return 9.20
-    elif distance <= 105:
-        return 9.60
-    elif distance <= 110:
-        return 9.90
-    elif distance <= 115:
-        return 10.30
-    elif distance <= 120:
-        return 10.70
-    elif distance <= 125:
-        return 11.10
-    elif distance <= 130:
-        return 11.40
-    elif distance <= 135:
-        return 11.60
-    elif distance <= 140:
-        return 12.00
-    elif distance <= 145:
-        return 12.40
-    elif distance <= 150:
-        return 12.80
-    elif distance <= 160:
-        return 13.60
-    elif distance <= 170:
-        return 14.40
-    elif distance <= 180:
-        return 15.20
-    elif distance <= 190:
-        return 16.00
-    elif distance <= 200:
-        return 16.80
-    elif distance <= 210:
-        return 17.60
-    elif distance <= 220:
-        return 18.40
-    elif distance <= 230:
-        return 19.20
-    elif distance <= 240:
-        return 20.00
-    elif distance <= 250:
-        return 20.80
-    elif distance <= 260:
-        return 21.60
-    elif distance <= 270:
-        return 22.40
-    elif distance <= 280:
-        return 23.20
-    elif distance <= 290:
-        return 24.00
-    elif distance <= 300:
-        return 24.80
-    elif distance <= 310:
-        return 25.60
-    elif distance <= 320:
-        return 26.40
-    elif distance <= 330:
-        return 27.20
-    elif distance <= 340:
-        return 28.00
-    elif distance <= 350:
-        return 28.80
-    elif distance <= 360:
-        return 29.60
-    else:
-        return 30.40
+def compile_zones(rule, rules):
+    # 'table' gives the number of zones crossed between two zones (numbered
+    # from 1), and 'prices' the fare for crossing 1, 2, ... zones; the last
+    # price applies to any larger number of zones. Stops in zone 0 are outside
+    # the zones and use the 'outside' rule.
+    table = rule['table']
+    prices = [ float(price) for price in rule['prices'] ]
+    outside = compile_rule(rule['outside'], rules) if 'outside' in rule else None
+
+    def fare(leg):
+        start, end = stop_zones.zones(leg['route']['points'][0]['stop_id'], leg['route']['points'][-1]['stop_id'])
+        if start == 0 or end == 0:
+            return outside(leg) if outside else UNKNOWN_FARE
+        number_of_zones = table[start-1][end-1]
+        return prices[min(number_of_zones, len(prices)) - 1]
+    return fare
+
+RULE_COMPILERS = {
+    'flat': compile_flat,
+    'distance_table': compile_distance_table,
+    'linear': compile_linear,
+    'agency': compile_agency,
+    'zones': compile_zones,
+}
 
 #===============================================================================
-# metro_fare ()
+# compile_rule ()
 #===============================================================================
-def metro_fare(name):
-    if name == 'Brussels':
-        return 2.10
-    else:
-        return -1
+def compile_rule(rule, rules):
+    """
+    Turn a pricing rule (or the name of one of 'rules') into a function that
+    returns the price of a leg.
+
+    Raises:
+        ValueError: the rule is unknown or malformed
+    """
+    if not isinstance(rule, dict):
+        if rule not in rules or not isinstance(rules[rule], dict):
+            raise ValueError('Unknown pricing rule %s' % (rule))
+        rule = rules[rule]
+    if rule.get('type') not in RULE_COMPILERS:
+        raise ValueError('Unknown pricing rule type %s' % (rule.get('type')))
+    try:
+        return RULE_COMPILERS[rule['type']](rule, rules)
+    except (KeyError, TypeError) as e:
+        raise ValueError('Invalid %s pricing rule (%s)' % (rule['type'], e))
 
 #===============================================================================
-# tram_fare ()
+# compile_tariff ()
 #===============================================================================
-def tram_fare(site, distance):
-    return -1
+def compile_tariff(tariff, overrides=None):
+    """
+    Compile 'tariff' (as in tariffs.json), with the rules and modes of
+    'overrides' replacing its own, into a dict of fare functions by travel
+    mode.
+
+    Raises:
+        ValueError: the overrides or a rule are malformed
+
+    Examples:
+    >>> sorted(compile_tariff({'modes': {'BUS': {'type': 'flat', 'price': 1}}}, {'modes': {'RAIL': 'r'}, 'rules': {'r': {'type': 'flat', 'price': 2}}}))
+    ['BUS', 'RAIL']
+    >>> compile_tariff({}, {'modes': ['BUS']})
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid tariffs (modes must be a dict)
+    """
+    overrides = overrides or {}
+    if not isinstance(overrides, dict):
+        raise ValueError('Invalid tariffs (not a dict)')
+    for field in [ 'rules', 'modes' ]:
+        if not isinstance(overrides.get(field, {}), dict):
+            raise ValueError('Invalid tariffs (%s must be a dict)' % (field))
+    rules = dict(tariff.get('rules', {}), **overrides.get('rules', {}))
+    modes = dict(tariff.get('modes', {}), **overrides.get('modes', {}))
+    return { mode: compile_rule(rule, rules) for mode, rule in modes.items() }
 
 #===============================================================================
-# carpooling_fare ()
+# FareEngine ()
 #===============================================================================
-def carpooling_fare(distance, name):
-    # convert meters to kilometers
-    distance = float(distance)/1000
-    if name == 'Edinburgh':
-        # convert kms to miles
-        distance = distance * 0.621
-        limit = 30
-        coefficient_one = 0.15
-        coefficient_two = 0.07
-    elif name == 'Brussels':
-        limit = 100
-        coefficient_one = 0.08
-        coefficient_two = 0.04
-    else:
-        return -1
-
-    if distance <= limit:
-        return coefficient_one * distance
-    else:
-       return (coefficient_one * limit) + (distance - limit) * coefficient_two 
+class FareEngine(object):
+    """
+    Prices legs with the tariffs of the sites. The tariff of a site is compiled
+    once into a function per travel mode, so pricing a leg is a dict lookup
+    plus (for distance tables) a binary search. Sites may override the default
+    tariffs with their own (e.g. 'price_info.tariffs' in db); each different
+    override is compiled once too. Sites with malformed overrides are priced
+    with the default tariffs.
+
+    Args:
+        tariffs: default tariffs by site name, as in tariffs.json
+        logger: logger for malformed overrides
+
+    Examples:
+    >>> engine = FareEngine({'A': {'modes': {'METRO': {'type': 'flat', 'price': 2}}}})
+    >>> legs = [ {'transport': {'travel_mode': mode}, 'distance': 1000} for mode in ('METRO', 'FEET', 'RAIL') ]
+    >>> engine.price_legs(legs, 'A')
+    [2.0, 0, -1]
+    >>> engine.price_legs(legs, 'A', {'modes': {'RAIL': {'type': 'flat', 'price': 5}}})
+    [2.0, 0, 5.0]
+    >>> engine.price_legs(legs, 'B')
+    [-1, 0, -1]
+    >>> engine.price_legs(legs, 'A', {'modes': {'RAIL': {'type': 'flat'}}})
+    [2.0, 0, -1]
+    """
+    def __init__(self, tariffs, logger=None):
+        self.tariffs = tariffs
+        self.logger = logger or logging.getLogger(__name__)
+        self.compiled = {}
+        self.lock = threading.Lock()
+
+    #---------------------------------------------------------------------------
+    # pricer ()
+    #---------------------------------------------------------------------------
+    def pricer(self, site_name, overrides=None):
+        key = (site_name, json.dumps(overrides, sort_keys=True) if overrides else None)
+        fares = self.compiled.get(key)
+        if fares is None:
+            tariff = self.tariffs.get(site_name, {})
+            try:
+                fares = compile_tariff(tariff, overrides)
+            except ValueError as e:
+                # Malformed overrides are logged (once, since the default
+                # fares are cached in their place) rather than failing trips
+                self.logger.error('Invalid tariffs of site %s, default tariffs used (%s)' % (site_name, e))
+                fares = compile_tariff(tariff)
+            with self.lock:
+                self.compiled[key] = fares
+        return fares
+
+    #---------------------------------------------------------------------------
+    # price_legs ()
+    #---------------------------------------------------------------------------
+    def price_legs(self, legs, site_name, overrides=None):
+        fares = self.pricer(site_name, overrides)
+        prices = []
+        for leg in legs:
+            travel_mode = leg['transport']['travel_mode']
+            if travel_mode not in PRICED_TRAVEL_MODES:
+                prices.append(0)
+            elif travel_mode in fares:
+                prices.append(fares[travel_mode](leg))
+            else:
+                prices.append(UNKNOWN_FARE)
+        return prices
 
+    #---------------------------------------------------------------------------
+    # price ()
+    #---------------------------------------------------------------------------
+    def price(self, leg, site_name, overrides=None):
+        return self.price_legs([ leg ], site_name, overrides)[0]
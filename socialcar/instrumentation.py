@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pymongo import monitoring
+
+# Upper bounds (secs) of the buckets of time histograms
+TIME_BUCKETS = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30 ]
+# Upper bounds of the buckets of db round-trips per request histograms
+COUNT_BUCKETS = [ 1, 2, 5, 10, 20, 50, 100, 200, 500 ]
+
+# Time spent in each of these is measured for every request
+REQUEST_TIMERS = [ 'mongo', 'route_planner', 'fcm' ]
+
+#===============================================================================
+# Histogram ()
+#===============================================================================
+class Histogram(object):
+    """
+    Counts observed values by bucket. Bucket i counts the values up to (and
+    including) bound i but above bound i-1; the last bucket counts the values
+    above the last bound.
+
+    Examples:
+    >>> h = Histogram([ 1, 5 ])
+    >>> for value in (0.5, 1, 3, 7):
+    ...     h.observe(value)
+    >>> h.snapshot() == {'bounds': [1, 5], 'buckets': [2, 1, 1], 'sum': 11.5, 'count': 4}
+    True
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [ 0 ] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return { 'bounds': list(self.bounds), 'buckets': list(self.buckets),
+                 'sum': self.sum, 'count': self.count }
+
+#===============================================================================
+# Instrumentation ()
+#===============================================================================
+class Instrumentation(object):
+    """
+    Measures where requests spend their time. Timers of the request being
+    handled by a thread are kept in a thread local, so code called during the
+    request (the db command listener, the route planner client, ...) only has
+    to add() to them. When the request finishes its timers are added to the
+    histograms of its resource and method.
+
+    Calls that are timed() outside any request (e.g. by notification threads)
+    are only added to the histogram of the call.
+
+    Examples:
+    >>> i = Instrumentation()
+    >>> i.start_request()
+    >>> i.db_command(0.002); i.db_command(0.003)
+    >>> timings = i.finish_request('rides', 'GET')
+    >>> timings['mongo'], timings['db_queries']
+    (0.005, 2)
+    >>> i.snapshot()['histograms'][('request_db_queries', ('rides', 'GET'))]['buckets'][:3]
+    [0, 1, 0]
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = defaultdict(int)
+
+    #---------------------------------------------------------------------------
+    # observe ()
+    #---------------------------------------------------------------------------
+    def observe(self, metric, labels, value, bounds=TIME_BUCKETS):
+        key = (metric, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(bounds)
+            self.histograms[key].observe(value)
+
+    #---------------------------------------------------------------------------
+    # count ()
+    #---------------------------------------------------------------------------
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    #---------------------------------------------------------------------------
+    # start_request ()
+    #---------------------------------------------------------------------------
+    def start_request(self):
+        self.local.started = time.time()
+        self.local.timers = defaultdict(float)
+        self.local.db_queries = 0
+
+    #---------------------------------------------------------------------------
+    # add ()
+    #---------------------------------------------------------------------------
+    def add(self, timer, seconds):
+        # Time spent outside requests (e.g. by background threads) is ignored
+        timers = getattr(self.local, 'timers', None)
+        if timers is not None:
+            timers[timer] += seconds
+
+    #---------------------------------------------------------------------------
+    # timed ()
+    #---------------------------------------------------------------------------
+    @contextmanager
+    def timed(self, timer):
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            self.add(timer, elapsed)
+            self.observe(timer, (), elapsed)
+
+    #---------------------------------------------------------------------------
+    # db_command ()
+    #---------------------------------------------------------------------------
+    def db_command(self, seconds):
+        self.count('mongo_commands')
+        self.add('mongo', seconds)
+        if getattr(self.local, 'timers', None) is not None:
+            self.local.db_queries += 1
+
+    #---------------------------------------------------------------------------
+    # finish_request ()
+    #---------------------------------------------------------------------------
+    def finish_request(self, resource, method):
+        """
+        Add the timers of the current request to the histograms of 'resource'
+        and 'method' and return them, with the total time and the number of
+        db round-trips of the request. Returns None if no request was started.
+        """
+        timers = getattr(self.local, 'timers', None)
+        if timers is None:
+            return None
+        labels = (resource, method)
+        timings = { timer: timers[timer] for timer in REQUEST_TIMERS }
+        timings['total'] = time.time() - self.local.started
+        timings['db_queries'] = self.local.db_queries
+        self.local.timers = None
+        self.count('requests')
+        for timer in [ 'total' ] + REQUEST_TIMERS:
+            self.observe('request_%s' % (timer), labels, timings[timer])
+        self.observe('request_db_queries', labels, timings['db_queries'], COUNT_BUCKETS)
+        return timings
+
+    #---------------------------------------------------------------------------
+    # snapshot ()
+    #---------------------------------------------------------------------------
+    def snapshot(self):
+        with self.lock:
+            return {
+                'histograms': { key: histogram.snapshot() for key, histogram in self.histograms.items() },
+                'counters': dict(self.counters),
+            }
+
+#===============================================================================
+# MongoCommandTimer ()
+#===============================================================================
+class MongoCommandTimer(monitoring.CommandListener):
+    """
+    Adds the duration of every db command to the timers of the request that
+    sent it. Must be registered before the db clients are created.
+    """
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.instrumentation.db_command(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.instrumentation.db_command(event.duration_micros / 1e6)
+
+#===============================================================================
+# server_timing ()
+#===============================================================================
+def server_timing(timings):
+    """
+    Format request timings (secs) as a Server-Timing header (in millisecs).
+
+    Examples:
+    >>> server_timing({'total': 0.1234, 'mongo': 0.01, 'route_planner': 0, 'fcm': 0, 'db_queries': 3})
+    'total;dur=123.4, mongo;dur=10.0, route_planner;dur=0.0, fcm;dur=0.0'
+    """
+    return ', '.join('%s;dur=%.1f' % (timer, timings[timer] * 1000)
+                     for timer in [ 'total' ] + REQUEST_TIMERS)
+
+instrumentation = Instrumentation()
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+import os
+import glob
+import fcntl
+import json
+import time
+import threading
+from collections import defaultdict
+from socialcar.settings import METRICS_DIR, METRICS_INTERVAL
+
+# Name, help and label names of the histograms of the instrumentation
+HISTOGRAMS = {
+    'request_total': ('socialcar_request_duration_seconds', 'Time to handle requests', [ 'resource', 'method' ]),
+    'request_mongo': ('socialcar_request_mongo_seconds', 'Time requests spent in MongoDB', [ 'resource', 'method' ]),
+    'request_route_planner': ('socialcar_request_route_planner_seconds', 'Time requests spent in Route Planning services', [ 'resource', 'method' ]),
+    'request_fcm': ('socialcar_request_fcm_seconds', 'Time requests spent in FCM calls', [ 'resource', 'method' ]),
+    'request_db_queries': ('socialcar_request_db_queries', 'MongoDB round-trips per request', [ 'resource', 'method' ]),
+    'route_planner': ('socialcar_route_planner_seconds', 'Latency of Route Planning services', []),
+    'fcm': ('socialcar_fcm_seconds', 'Latency of FCM connector calls', []),
+}
+
+# Name and help of the counters of the instrumentation
+COUNTERS = {
+    'mongo_commands': ('socialcar_mongo_commands_total', 'MongoDB commands sent'),
+}
+
+# Snapshot with the counters and histograms of the processes that exited
+EXITED_SNAPSHOT = 'exited.json'
+
+# Help of the metrics reported by collectors
+METRIC_HELP = {
+    'socialcar_requests_total': 'Requests handled',
+    'socialcar_notification_queue_depth': 'Push notifications waiting to be delivered',
+    'socialcar_notifications_total': 'Push notifications by delivery status',
+    'socialcar_cache_hits_total': 'Cache lookups that found the entry',
+    'socialcar_cache_misses_total': 'Cache lookups that did not find the entry',
+    'socialcar_cache_hit_ratio': 'Ratio of cache lookups that found the entry',
+}
+
+#===============================================================================
+# format_labels ()
+#===============================================================================
+def format_labels(labels):
+    """
+    Examples:
+    >>> format_labels({'resource': 'rides', 'method': 'GET'})
+    '{method="GET",resource="rides"}'
+    >>> format_labels({})
+    ''
+    """
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for name, value in sorted(labels.items())))
+
+#===============================================================================
+# format_value ()
+#===============================================================================
+def format_value(value):
+    """
+    Examples:
+    >>> format_value(3.0), format_value(0.75)
+    ('3', '0.75')
+    """
+    return '%d' % (value) if value == int(value) else repr(float(value))
+
+#===============================================================================
+# pid_alive ()
+#===============================================================================
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+#===============================================================================
+# labels_key ()
+#===============================================================================
+def labels_key(labels):
+    return tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+#===============================================================================
+# merge_snapshots ()
+#===============================================================================
+def merge_snapshots(snapshots):
+    """
+    Sum 'snapshots'. Returns the histograms and the samples of each type, both
+    keyed by (name, sorted labels).
+
+    Examples:
+    >>> s = {'pid': 1, 'histograms': [], 'samples': [['counter', 'c', {'a': 1}, 2], ['gauge', 'g', {}, 1]]}
+    >>> histograms, samples = merge_snapshots([ s, s ])
+    >>> dict(samples['counter']), dict(samples['gauge'])
+    ({('c', (('a', '1'),)): 4.0}, {('g', ()): 2.0})
+    """
+    histograms = {}
+    samples = { 'counter': defaultdict(float), 'gauge': defaultdict(float) }
+    for snapshot in snapshots:
+        for name, labels, histogram in snapshot['histograms']:
+            key = (name, labels_key(labels))
+            if key not in histograms:
+                histograms[key] = { 'bounds': histogram['bounds'], 'buckets': [ 0 ] * len(histogram['buckets']),
+                                    'sum': 0, 'count': 0 }
+            total = histograms[key]
+            total['buckets'] = [ a + b for a, b in zip(total['buckets'], histogram['buckets']) ]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+        for sample_type, name, labels, value in snapshot['samples']:
+            samples[sample_type][(name, labels_key(labels))] += value
+    return histograms, samples
+
+#===============================================================================
+# read_snapshot ()
+#===============================================================================
+def read_snapshot(path):
+    # Returns None if there is no (complete) snapshot at 'path'
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+#===============================================================================
+# write_snapshot ()
+#===============================================================================
+def write_snapshot(path, snapshot):
+    # Write to a temporary file first, so readers never see half a file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(path + '.tmp', path)
+
+#===============================================================================
+# MetricsExporter ()
+#===============================================================================
+class MetricsExporter(object):
+    """
+    Exports the metrics of all worker processes in the Prometheus text format.
+    Every process writes a snapshot of its own metrics to a file of
+    'directory' (at most every 'interval' secs), and render() sums the
+    snapshots of all processes. The counters and histograms of processes that
+    exited (e.g. recycled workers) are folded into a snapshot of their own, so
+    totals never drop; only their gauges are dropped.
+
+    Args:
+        instrumentation: Instrumentation with the histograms and counters
+        directory: directory shared by the worker processes
+        interval: min time (secs) between two snapshots of a process
+
+    Examples:
+    >>> import tempfile
+    >>> from socialcar.instrumentation import Instrumentation
+    >>> i = Instrumentation()
+    >>> e = MetricsExporter(i, tempfile.mkdtemp())
+    >>> e.add_collector(lambda: [ ('counter', 'socialcar_cache_hits_total', {'cache': 'c'}, 3),
+    ...                           ('counter', 'socialcar_cache_misses_total', {'cache': 'c'}, 1) ])
+    >>> i.start_request(); _ = i.finish_request('rides', 'GET')
+    >>> text = e.render()
+    >>> 'socialcar_requests_total{method="GET",resource="rides"} 1' in text
+    True
+    >>> 'socialcar_cache_hit_ratio{cache="c"} 0.75' in text
+    True
+    """
+    def __init__(self, instrumentation, directory=METRICS_DIR, interval=METRICS_INTERVAL):
+        self.instrumentation = instrumentation
+        self.directory = directory
+        self.interval = interval
+        self.collectors = []
+        self.written_at = 0
+        self.lock = threading.Lock()
+
+    #---------------------------------------------------------------------------
+    # add_collector ()
+    #---------------------------------------------------------------------------
+    def add_collector(self, collector):
+        # 'collector' returns a list of (type, name, labels, value) samples,
+        # with type 'counter' or 'gauge'
+        self.collectors.append(collector)
+
+    #---------------------------------------------------------------------------
+    # snapshot ()
+    #---------------------------------------------------------------------------
+    def snapshot(self):
+        instrumented = self.instrumentation.snapshot()
+        histograms = []
+        for (metric, labels), histogram in instrumented['histograms'].items():
+            name, _, label_names = HISTOGRAMS[metric]
+            histograms.append([ name, dict(zip(label_names, labels)), histogram ])
+        samples = [ [ 'counter', COUNTERS[counter][0], {}, value ]
+                    for counter, value in instrumented['counters'].items() if counter in COUNTERS ]
+        for collector in self.collectors:
+            samples.extend([ list(sample) for sample in collector() ])
+        return { 'pid': os.getpid(), 'histograms': histograms, 'samples': samples }
+
+    #---------------------------------------------------------------------------
+    # write ()
+    #---------------------------------------------------------------------------
+    def write(self, force=False):
+        now = time.time()
+        if not force and now - self.written_at < self.interval:
+            return
+        with self.lock:
+            if not force and now - self.written_at < self.interval:
+                return
+            self.written_at = now
+            os.makedirs(self.directory, exist_ok=True)
+            write_snapshot(os.path.join(self.directory, '%d.json' % (os.getpid())), self.snapshot())
+
+    #---------------------------------------------------------------------------
+    # fold_exited ()
+    #---------------------------------------------------------------------------
+    def fold_exited(self, path):
+        # Add the counters and histograms of the snapshot at 'path' of a process
+        # that exited to the snapshot of exited processes, and remove it. The
+        # lock keeps processes rendering at the same time from folding it twice.
+        with open(os.path.join(self.directory, 'exited.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            snapshot = read_snapshot(path)
+            if snapshot is None:
+                return
+            exited_path = os.path.join(self.directory, EXITED_SNAPSHOT)
+            exited = read_snapshot(exited_path) or { 'pid': None, 'histograms': [], 'samples': [] }
+            histograms, samples = merge_snapshots([ exited, snapshot ])
+            write_snapshot(exited_path, {
+                'pid': None,
+                'histograms': [ [ name, dict(labels), histogram ]
+                                for (name, labels), histogram in histograms.items() ],
+                'samples': [ [ 'counter', name, dict(labels), value ]
+                             for (name, labels), value in samples['counter'].items() ],
+            })
+            os.remove(path)
+
+    #---------------------------------------------------------------------------
+    # collect ()
+    #---------------------------------------------------------------------------
+    def collect(self):
+        """
+        Sum the snapshots of all live processes and of the exited ones. Returns
+        the histograms and the samples of each type, both keyed by (name,
+        sorted labels).
+        """
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            if os.path.basename(path) == EXITED_SNAPSHOT:
+                continue
+            snapshot = read_snapshot(path)
+            if snapshot is not None and not pid_alive(snapshot['pid']):
+                self.fold_exited(path)
+        snapshots = [ read_snapshot(path) for path in glob.glob(os.path.join(self.directory, '*.json')) ]
+        return merge_snapshots([ snapshot for snapshot in snapshots if snapshot is not None ])
+
+    #---------------------------------------------------------------------------
+    # render ()
+    #---------------------------------------------------------------------------
+    def render(self):
+        self.write(force=True)
+        histograms, samples = self.collect()
+
+        # Requests are counted by the histograms of their durations
+        for (name, labels), histogram in histograms.items():
+            if name == HISTOGRAMS['request_total'][0]:
+                samples['counter'][('socialcar_requests_total', labels)] += histogram['count']
+        # Hit ratios of the caches, from the hits and misses of all processes
+        for (name, labels), hits in list(samples['counter'].items()):
+            if name == 'socialcar_cache_hits_total':
+                lookups = hits + samples['counter'].get(('socialcar_cache_misses_total', labels), 0)
+                if lookups:
+                    samples['gauge'][('socialcar_cache_hit_ratio', labels)] = hits / lookups
+
+        helps = dict(METRIC_HELP)
+        helps.update({ name: help for name, help, _ in HISTOGRAMS.values() })
+        helps.update({ name: help for name, help in COUNTERS.values() })
+        lines = []
+        for sample_type in ('counter', 'gauge'):
+            names = sorted(set(name for name, _ in samples[sample_type]))
+            for name in names:
+                lines.append('# HELP %s %s' % (name, helps.get(name, name)))
+                lines.append('# TYPE %s %s' % (name, sample_type))
+                for (sample_name, labels), value in sorted(samples[sample_type].items()):
+                    if sample_name == name:
+                        lines.append('%s%s %s' % (name, format_labels(dict(labels)), format_value(value)))
+        for name in sorted(set(name for name, _ in histograms)):
+            lines.append('# HELP %s %s' % (name, helps.get(name, name)))
+            lines.append('# TYPE %s histogram' % (name))
+            for (histogram_name, labels), histogram in sorted(histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram['bounds'] + [ '+Inf' ], histogram['buckets']):
+                    cumulative += count
+                    bucket_labels = dict(labels, le=bound)
+                    lines.append('%s_bucket%s %d' % (name, format_labels(bucket_labels), cumulative))
+                lines.append('%s_sum%s %s' % (name, format_labels(dict(labels)), format_value(histogram['sum'])))
+                lines.append('%s_count%s %d' % (name, format_labels(dict(labels)), histogram['count']))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import logging
+import queue
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from socialcar.settings import FCM_HOST, FCM_PORT, FCM_API_KEY, NOTIFICATION_WORKERS, \
+                               NOTIFICATION_QUEUE_SIZE, NOTIFICATION_RETRIES, \
+                               NOTIFICATION_BACKOFF, NOTIFICATION_BATCH_SIZE, \
+                               FCM_RECIPIENTS_PER_REQUEST
+from socialcar.instrumentation import instrumentation
+
+# Timeout (secs) of requests to the FCM connector
+NOTIFICATION_TIMEOUT = 10
+
+# FCM connector services for notification messages (shown by the device, used
+# for iOS) and data messages (handled by the app, used for Android)
+FCM_NOTIFICATION_MESSAGE_URL = 'FCMConnectorService/messaging/notification-message/send'
+FCM_DATA_MESSAGE_URL = 'FCMConnectorService/messaging/data-message/send'
+
+# Title and body of notifications shown on iOS, by message type and status
+IOS_NOTIFICATIONS = {
+    ('lift', 'PENDING'): ('REQUEST_LIFT_TO_DRIVER_TITLE', 'REQUEST_LIFT_TO_DRIVER_BODY'),
+    ('lift', 'ACTIVE'): ('ACCEPTED_LIFT_TITLE', 'ACCEPTED_LIFT_BODY'),
+    ('lift', 'REFUSED'): ('REFUSED_LIFT_TITLE', 'REFUSED_LIFT_BODY'),
+    ('lift', 'CANCELLED'): ('CANCELLED_LIFT_TITLE', 'CANCELLED_LIFT_BODY'),
+    ('message', None): ('MESSAGE_TITLE', 'MESSAGE_BODY'),
+    ('eta', None): ('REQUEST_LIFT_TO_DRIVER_TITLE', 'REQUEST_LIFT_TO_DRIVER_BODY'),
+}
+
+# Notification messages are small, so iOS only gets these fields of lifts
+IOS_LIFT_FIELDS = [ '_id', 'passenger_id', 'driver_id', 'ride_id', 'car_id', 'status' ]
+
+#===============================================================================
+# NotificationError ()
+#===============================================================================
+class NotificationError(Exception):
+    """
+    A notification could not be delivered. If 'retry' is True the failure is
+    transient (e.g. the connector is overloaded) and delivery is retried.
+    """
+    def __init__(self, message, retry=False):
+        super(NotificationError, self).__init__(message)
+        self.retry = retry
+
+#===============================================================================
+# payload_data ()
+#===============================================================================
+def payload_data(message):
+    # Non-ASCII characters are escaped, ObjectIds and dates sent as strings
+    return json.dumps(message, default=str)
+
+#===============================================================================
+# ios_notification ()
+#===============================================================================
+def ios_notification(fcm_token, message):
+    """
+    Examples:
+    >>> data = ios_notification('token', {'type': 'message', 'body': 'Hi'})
+    >>> data['notification_title'], data['data_body']
+    ('MESSAGE_TITLE', '{"type": "message", "body": "Hi"}')
+    """
+    message_type = message.get('type')
+    if message_type == 'lift':
+        message = { field: message[field] for field in IOS_LIFT_FIELDS }
+        key = (message_type, message['status'])
+    else:
+        key = (message_type, None)
+    if key not in IOS_NOTIFICATIONS:
+        raise NotificationError('No iOS notification for %s message' % (' '.join(str(k) for k in key if k)))
+    notification_title, notification_body = IOS_NOTIFICATIONS[key]
+    return {
+        'to': fcm_token,
+        'api_key': FCM_API_KEY,
+        'notification_title': notification_title,
+        'notification_body': notification_body,
+        'data_title': 'Sample_Title',
+        'data_body': payload_data(message),
+    }
+
+#===============================================================================
+# android_notification ()
+#===============================================================================
+def android_notification(fcm_token, message):
+    """
+    Examples:
+    >>> android_notification('token', {'type': 'eta', 'eta': 5})['payload_data']
+    '{"type": "eta", "eta": 5}'
+    """
+    return {
+        'to': fcm_token,
+        'api_key': FCM_API_KEY,
+        'payload_data': payload_data(message),
+    }
+
+# Connector service and payload builder of each platform
+NOTIFICATION_BUILDERS = {
+    'IOS': (FCM_NOTIFICATION_MESSAGE_URL, ios_notification),
+    'ANDROID': (FCM_DATA_MESSAGE_URL, android_notification),
+}
+
+#===============================================================================
+# build_notification ()
+#===============================================================================
+def build_notification(user, message):
+    """
+    Return the url of the connector service and the form data to post to it
+    in order to notify 'user' (a dict with 'fcm_token' and optional
+    'platform', ANDROID by default) of 'message'.
+    """
+    platform = user['platform'] if 'platform' in user else 'ANDROID'
+    if platform not in NOTIFICATION_BUILDERS:
+        raise NotificationError('Unknown platform %s' % (platform))
+    platform_url, builder = NOTIFICATION_BUILDERS[platform]
+    url = 'http://%s:%d/%s' % (FCM_HOST, FCM_PORT, platform_url)
+    return url, builder(user['fcm_token'], message)
+
+#===============================================================================
+# NotificationTicket ()
+#===============================================================================
+class NotificationTicket(object):
+    """
+    Handle of a submitted notification, to check (or wait for) its delivery.
+    'status' is QUEUED until the notification is SENT or FAILED, or DROPPED
+    if it could not even be queued.
+    """
+    QUEUED = 'QUEUED'
+    SENT = 'SENT'
+    FAILED = 'FAILED'
+    DROPPED = 'DROPPED'
+
+    def __init__(self):
+        self.status = self.QUEUED
+        self.error = None
+        self.event = threading.Event()
+
+    def finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.event.set()
+
+    def wait(self, timeout=None):
+        # Returns the status, which is still QUEUED if 'timeout' expired
+        self.event.wait(timeout)
+        return self.status
+
+#===============================================================================
+# NotificationDispatcher ()
+#===============================================================================
+class NotificationDispatcher(object):
+    """
+    Delivers push notifications in the background. Notifications are queued in
+    a bounded queue; when it is full new notifications are dropped rather than
+    blocking whoever submits them.
+
+    A lookup thread takes all notifications waiting in the queue (up to
+    'batch_size') and finds their users with a single find_users() call.
+    Their notifications are then grouped by connector service, in requests
+    of up to 'recipients_per_request' notifications, and each request is a
+    job of its own for a pool of 'workers' threads, which share a pooled
+    keep-alive HTTP session, so a slow or failing request only holds up its
+    own thread. Failed notifications are retried with exponential backoff.
+    At most 'queue_size' requests wait for a thread; meanwhile no more users
+    are looked up.
+
+    Requests are sent by post_batch(). The FCM connector takes a single
+    recipient per request, so by default each notification is a request;
+    a connector taking many recipients per request only needs post_batch()
+    to send them at once, and a larger 'recipients_per_request'.
+
+    Threads, queue and session are created the first time a notification is
+    submitted in each process, so they are never shared with forked workers.
+
+    Args:
+        find_users: function taking a list of user ids and returning a dict of
+            the users found (with 'fcm_token' and 'platform') by user id
+        context: optional function returning a context manager users are
+            looked up in (e.g. app.app_context)
+        logger: logger for delivery errors
+
+    Examples:
+    >>> d = NotificationDispatcher(lambda user_ids: {}, workers=1, retries=0)
+    >>> ticket = d.submit('582431a6a377f26970c543b3', {'type': 'message'})
+    >>> ticket.wait(5), str(ticket.error)
+    ('FAILED', 'Unknown user 582431a6a377f26970c543b3')
+    >>> d.stats()['failed']
+    1
+    """
+    def __init__(self, find_users, context=None, logger=None, workers=NOTIFICATION_WORKERS,
+                 queue_size=NOTIFICATION_QUEUE_SIZE, retries=NOTIFICATION_RETRIES,
+                 backoff=NOTIFICATION_BACKOFF, batch_size=NOTIFICATION_BATCH_SIZE,
+                 recipients_per_request=FCM_RECIPIENTS_PER_REQUEST):
+        self.find_users = find_users
+        self.context = context
+        self.logger = logger or logging.getLogger(__name__)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retries = retries
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.recipients_per_request = recipients_per_request
+        self.counters = { 'sent': 0, 'failed': 0, 'dropped': 0, 'retried': 0, 'batches': 0 }
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.session = None
+        self.executor = None
+        self.slots = None
+
+    #---------------------------------------------------------------------------
+    # ensure_started ()
+    #---------------------------------------------------------------------------
+    def ensure_started(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+                self.queue = queue.Queue(self.queue_size)
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+                self.slots = threading.BoundedSemaphore(self.queue_size)
+                thread = threading.Thread(target=self.run, args=[ self.queue ],
+                                          name='notifications-lookup')
+                thread.daemon = True
+                thread.start()
+                self.pid = os.getpid()
+
+    #---------------------------------------------------------------------------
+    # count ()
+    #---------------------------------------------------------------------------
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    #---------------------------------------------------------------------------
+    # submit ()
+    #---------------------------------------------------------------------------
+    def submit(self, user_id, message):
+        """
+        Queue notification 'message' (a dict with a 'type') to user 'user_id'.
+        Returns its NotificationTicket, DROPPED if the queue was full.
+        """
+        self.ensure_started()
+        ticket = NotificationTicket()
+        try:
+            self.queue.put_nowait((user_id, message, ticket))
+        except queue.Full:
+            self.count('dropped')
+            self.logger.error('Notification queue full, notification dropped')
+            ticket.finish(NotificationTicket.DROPPED)
+        return ticket
+
+    #---------------------------------------------------------------------------
+    # run ()
+    #---------------------------------------------------------------------------
+    def run(self, jobs):
+        while True:
+            batch = [ jobs.get() ]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(jobs.get_nowait())
+                except queue.Empty:
+                    break
+            # Each job is done once its post is done (or it failed)
+            self.deliver_batch(batch, jobs)
+
+    #---------------------------------------------------------------------------
+    # fail ()
+    #---------------------------------------------------------------------------
+    def fail(self, ticket, error):
+        self.count('failed')
+        self.logger.error('Error with notification (%s)' % (error))
+        ticket.finish(NotificationTicket.FAILED, error)
+
+    #---------------------------------------------------------------------------
+    # deliver_batch ()
+    #---------------------------------------------------------------------------
+    def deliver_batch(self, batch, jobs):
+        self.count('batches')
+        user_ids = list(set(user_id for user_id, _, _ in batch))
+        try:
+            if self.context is not None:
+                with self.context():
+                    users = self.find_users(user_ids)
+            else:
+                users = self.find_users(user_ids)
+        except Exception as e:
+            users = {}
+            lookup_error = e
+        else:
+            lookup_error = None
+        # Notifications are grouped by the connector service they go to
+        connectors = {}
+        for user_id, message, ticket in batch:
+            try:
+                if user_id not in users:
+                    raise lookup_error or NotificationError('Unknown user %s' % (user_id))
+                url, data = build_notification(users[user_id], message)
+            except Exception as e:
+                self.fail(ticket, e)
+                jobs.task_done()
+            else:
+                connectors.setdefault(url, []).append((data, ticket))
+        for url, notifications in connectors.items():
+            for i in range(0, len(notifications), self.recipients_per_request):
+                self.slots.acquire()
+                self.executor.submit(self.deliver_job, url, notifications[i:i + self.recipients_per_request], jobs)
+
+    #---------------------------------------------------------------------------
+    # deliver_job ()
+    #---------------------------------------------------------------------------
+    def deliver_job(self, url, notifications, jobs):
+        try:
+            self.deliver(url, notifications)
+        finally:
+            self.slots.release()
+            for _ in notifications:
+                jobs.task_done()
+
+    #---------------------------------------------------------------------------
+    # deliver ()
+    #---------------------------------------------------------------------------
+    def deliver(self, url, notifications):
+        # 'notifications' is a list of (data, ticket); only the ones that
+        # failed with a transient error are retried
+        failed = []
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.count('retried')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                errors = self.post_batch(url, [ data for data, _ in notifications ])
+            except Exception as e:
+                errors = [ e ] * len(notifications)
+            failed = []
+            for (data, ticket), error in zip(notifications, errors):
+                if error is None:
+                    self.count('sent')
+                    ticket.finish(NotificationTicket.SENT)
+                elif isinstance(error, requests.exceptions.RequestException) or getattr(error, 'retry', False):
+                    failed.append(((data, ticket), error))
+                else:
+                    self.fail(ticket, error)
+            notifications = [ notification for notification, _ in failed ]
+            if not notifications:
+                break
+        for (_, ticket), error in failed:
+            self.fail(ticket, error)
+        return not failed
+
+    #---------------------------------------------------------------------------
+    # post_batch ()
+    #---------------------------------------------------------------------------
+    def post_batch(self, url, batch):
+        """
+        Send the notifications (form data) in 'batch' to connector service
+        'url'. Returns the error of each of them, None if it was sent.
+        """
+        # The FCM connector takes a single recipient per request
+        errors = []
+        for data in batch:
+            try:
+                self.post(url, data)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+    #---------------------------------------------------------------------------
+    # post ()
+    #---------------------------------------------------------------------------
+    def post(self, url, data):
+        with instrumentation.timed('fcm'):
+            res = self.session.post(url, data=data, timeout=NOTIFICATION_TIMEOUT)
+        if res.status_code != 200:
+            # Errors of the connector itself are worth retrying
+            raise NotificationError('%s returned %d' % (url, res.status_code),
+                                    retry=res.status_code >= 500)
+
+    #---------------------------------------------------------------------------
+    # join ()
+    #---------------------------------------------------------------------------
+    def join(self):
+        # Wait until all queued notifications have been delivered (or failed)
+        if self.queue is not None:
+            self.queue.join()
+
+    #---------------------------------------------------------------------------
+    # stats ()
+    #---------------------------------------------------------------------------
+    def stats(self):
+        stats = dict(self.counters)
+        stats['queued'] = self.queue.qsize() if self.queue is not None else 0
+        return stats
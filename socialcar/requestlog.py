@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import atexit
+import queue
+import threading
+import logging.handlers
+from socialcar.settings import LOG_QUEUE_SIZE
+
+#===============================================================================
+# truncate_body ()
+#===============================================================================
+def truncate_body(data, max_size):
+    """
+    Decode at most 'max_size' bytes of request/response body 'data', so large
+    bodies are never decoded (or logged) in full.
+
+    Examples:
+    >>> truncate_body(b'{"a": 1}', 100)
+    '{"a": 1}'
+    >>> truncate_body(b'0123456789', 4)
+    '0123...(10 bytes)'
+    """
+    if len(data) > max_size:
+        return '%s...(%d bytes)' % (data[:max_size].decode(errors='replace'), len(data))
+    return data.decode(errors='replace')
+
+#===============================================================================
+# log_record ()
+#===============================================================================
+def log_record(**fields):
+    """
+    Examples:
+    >>> log_record(event='request', user='bob', status=None)
+    '{"event":"request","user":"bob","status":null}'
+    """
+    return json.dumps(fields, separators=(',', ':'), ensure_ascii=False)
+
+#===============================================================================
+# AsyncLogHandler ()
+#===============================================================================
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """
+    Hands log records over to a listener thread that writes them with
+    'handlers', so logging never makes a request wait for the disk. At most
+    'queue_size' records wait to be written; further records are dropped
+    rather than blocking the request.
+
+    The queue and listener are created the first time a record is logged in
+    each process (threads do not survive forking workers), and the listener
+    writes the records left in the queue when the process exits.
+
+    Examples:
+    >>> class Records(logging.Handler):
+    ...     def __init__(self):
+    ...         super(Records, self).__init__()
+    ...         self.messages = []
+    ...     def emit(self, record):
+    ...         self.messages.append(record.getMessage())
+    >>> records = Records()
+    >>> handler = AsyncLogHandler([ records ])
+    >>> logger = logging.getLogger('doctest.requestlog')
+    >>> logger.addHandler(handler)
+    >>> logger.warning('%s logged', 'Asynchronously')
+    >>> handler.stop(); records.messages
+    ['Asynchronously logged']
+    """
+    def __init__(self, handlers, queue_size=LOG_QUEUE_SIZE):
+        super(AsyncLogHandler, self).__init__(None)
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.start_lock = threading.Lock()
+        self.pid = None
+        self.listener = None
+
+    #---------------------------------------------------------------------------
+    # ensure_started ()
+    #---------------------------------------------------------------------------
+    def ensure_started(self):
+        with self.start_lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(self.queue_size)
+                self.listener = logging.handlers.QueueListener(self.queue, *self.handlers,
+                                                               respect_handler_level=True)
+                self.listener.start()
+                if self.pid is None:
+                    atexit.register(self.stop)
+                self.pid = os.getpid()
+
+    #---------------------------------------------------------------------------
+    # enqueue ()
+    #---------------------------------------------------------------------------
+    def enqueue(self, record):
+        self.ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    #---------------------------------------------------------------------------
+    # stop ()
+    #---------------------------------------------------------------------------
+    def stop(self):
+        # Write the queued records and stop the listener of this process
+        with self.start_lock:
+            if self.pid == os.getpid() and self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+                self.pid = None
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from socialcar.settings import ROUTE_PLANNER_TIMEOUT, ROUTE_PLANNER_CONNECT_TIMEOUT, \
+                               ROUTE_PLANNER_POOL_SIZE
+from socialcar.instrumentation import instrumentation
+
+# Coordinates are rounded to this many decimals (~100m) in route plan cache keys
+ROUTE_PLAN_CACHE_PRECISION = 3
+# Departure times within the same bucket (secs) share route plan cache entries
+ROUTE_PLAN_CACHE_TIME_BUCKET = 300
+# Query parameters of /trips that change the trips found by the planners
+ROUTE_PLAN_CACHE_FLAGS = [ 'use_bus', 'use_metro', 'use_train', 'transfer_mode' ]
+
+# After this many consecutive failures a planner is not called for a while
+CIRCUIT_BREAKER_THRESHOLD = 5
+# Seconds to wait before trying again a planner whose circuit is open
+CIRCUIT_BREAKER_COOLDOWN = 30
+
+#===============================================================================
+# RoutePlannerError ()
+#===============================================================================
+class RoutePlannerError(Exception):
+    pass
+
+#===============================================================================
+# parse_answer ()
+#===============================================================================
+def parse_answer(answer):
+    """
+    Return the (trips, error message) of a planner answer; one of them is None.
+
+    Raises:
+        ValueError: the answer does not have the expected format
+
+    Examples:
+    >>> parse_answer({'result': True, 'data': []})
+    ([], None)
+    >>> parse_answer({'result': False, 'error': {'message': 'No route'}})
+    (None, 'No route')
+    >>> parse_answer({'result': False})
+    Traceback (most recent call last):
+        ...
+    ValueError: Malformed answer
+    """
+    if isinstance(answer, dict):
+        if answer.get('result') == True and isinstance(answer.get('data'), list):
+            return answer['data'], None
+        error = answer.get('error')
+        if answer.get('result') == False and isinstance(error, dict) and 'message' in error:
+            return None, error['message']
+    raise ValueError('Malformed answer')
+
+#===============================================================================
+# CircuitBreaker ()
+#===============================================================================
+class CircuitBreaker(object):
+    """
+    Stops calling a planner after 'threshold' consecutive failures. Once
+    'cooldown' seconds have passed, a single trial request is let through: if
+    it succeeds the circuit closes again, else it stays open for another
+    'cooldown' seconds.
+
+    Examples:
+    >>> b = CircuitBreaker(threshold=2, cooldown=60)
+    >>> b.record_failure(); b.allow()
+    True
+    >>> b.record_failure(); b.allow()
+    False
+    >>> b.record_success(); b.allow()
+    True
+    """
+    def __init__(self, threshold=CIRCUIT_BREAKER_THRESHOLD, cooldown=CIRCUIT_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.cooldown:
+                # Half-open: let this request through, keep the others out
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+#===============================================================================
+# RoutePlannerClient ()
+#===============================================================================
+class RoutePlannerClient(object):
+    """
+    Client for the Route Planning services of the sites. All requests of a
+    worker go through a pooled keep-alive session, every planner url has its
+    own circuit breaker, and several planners can be queried concurrently with
+    plan_many().
+    """
+    def __init__(self, timeout=ROUTE_PLANNER_TIMEOUT, connect_timeout=ROUTE_PLANNER_CONNECT_TIMEOUT,
+                 pool_size=ROUTE_PLANNER_POOL_SIZE):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.pool_size = pool_size
+        self.breakers = {}
+        self.lock = threading.Lock()
+        self.pid = None
+        self.session = None
+        self.executor = None
+
+    #---------------------------------------------------------------------------
+    # ensure_session ()
+    #---------------------------------------------------------------------------
+    def ensure_session(self):
+        # Sessions and threads must not be shared with forked workers, so they
+        # are (re)created the first time they are used in each process
+        with self.lock:
+            if self.pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                      pool_maxsize=self.pool_size, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+                self.executor = ThreadPoolExecutor(max_workers=self.pool_size)
+                self.breakers = {}
+                self.pid = os.getpid()
+
+    #---------------------------------------------------------------------------
+    # breaker ()
+    #---------------------------------------------------------------------------
+    def breaker(self, url):
+        with self.lock:
+            if url not in self.breakers:
+                self.breakers[url] = CircuitBreaker()
+            return self.breakers[url]
+
+    #---------------------------------------------------------------------------
+    # plan ()
+    #---------------------------------------------------------------------------
+    def plan(self, url, params, timeout=None):
+        """
+        Query planner 'url' and return its list of trips.
+
+        Raises:
+            RoutePlannerError: the planner is unavailable, timed out or
+            returned an error
+        """
+        self.ensure_session()
+        breaker = self.breaker(url)
+        if not breaker.allow():
+            raise RoutePlannerError('Route planner %s temporarily disabled' % (url))
+        try:
+            r = self.session.get(url, params=params,
+                                 timeout=(self.connect_timeout, timeout or self.timeout))
+            trips, error = parse_answer(json.loads(r.text))
+        except requests.exceptions.Timeout:
+            breaker.record_failure()
+            raise RoutePlannerError('Request to %s time out' % (url))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            breaker.record_failure()
+            raise RoutePlannerError('Request to %s failed (%s)' % (url, e))
+        # The planner answered, so it is reachable even if it found no route
+        breaker.record_success()
+        if error is not None:
+            raise RoutePlannerError(error)
+        return trips
+
+    #---------------------------------------------------------------------------
+    # plan_many ()
+    #---------------------------------------------------------------------------
+    def plan_many(self, jobs):
+        """
+        Run a plan() for each (url, params, timeout) in 'jobs' concurrently.
+        Returns a list with either the trips or the RoutePlannerError of each
+        job, in the same order as 'jobs'.
+        """
+        def run(job):
+            try:
+                return self.plan(*job)
+            except RoutePlannerError as e:
+                return e
+
+        with instrumentation.timed('route_planner'):
+            if len(jobs) == 1:
+                return [ run(jobs[0]) ]
+            self.ensure_session()
+            return list(self.executor.map(run, jobs))
+
+#===============================================================================
+# RoutePlanCache ()
+#===============================================================================
+class RoutePlanCache(object):
+    """
+    Cache of the raw trips returned by the Route Planning services of a site.
+    Requests with close origins/destinations, departure times in the same time
+    bucket and the same transport flags share a cache entry. Trips are stored
+    serialized, so each get() returns a fresh copy that can be modified.
+
+    Args:
+        backend: object with get(key)/set(key, value), e.g. a LRUCache or a
+            MongoCache; None disables caching
+
+    Examples:
+    >>> args = {'start_lat': '50.84671', 'start_lon': '4.35247', 'end_lat': '50.8', 'end_lon': '4.4',
+    ...         'start_date': '1488793728', 'use_bus': 'true', 'use_metro': 'true',
+    ...         'use_train': 'false', 'transfer_mode': 'FASTEST'}
+    >>> RoutePlanCache.key('site', args)
+    'site|50.847|4.352|50.800|4.400|4962645|true|true|false|FASTEST'
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def key(site_id, args):
+        coordinates = [ '%.*f' % (ROUTE_PLAN_CACHE_PRECISION, float(args[field]))
+                        for field in ('start_lat', 'start_lon', 'end_lat', 'end_lon') ]
+        time_bucket = '%d' % (int(args['start_date']) // ROUTE_PLAN_CACHE_TIME_BUCKET)
+        flags = [ args.get(flag, '') for flag in ROUTE_PLAN_CACHE_FLAGS ]
+        return '|'.join([ str(site_id) ] + coordinates + [ time_bucket ] + flags)
+
+    def get(self, key):
+        if self.backend is None:
+            return None
+        value = self.backend.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, trips):
+        if self.backend is not None:
+            self.backend.set(key, json.dumps(trips))
+
+    def stats(self):
+        return self.backend.stats() if self.backend is not None else {}
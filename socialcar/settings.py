@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
+import tempfile
 import pymongo
+from socialcar.utils import search_indexes, page_indexes
 
 # Eve configuration global settings: http://python-eve.org/config.html
 
@@ -21,6 +23,54 @@ SENTRY_DSN = os.environ.get('SENTRY_DSN', '{YOUR_SENTRY_DSN}') # TODO: Insert Se
 FCM_HOST = os.environ.get('FCM_HOST', 'localhost')
 FCM_PORT = int(os.environ.get('FCM_PORT', 8081))
 FCM_API_KEY = os.environ.get('FCM_API_KEY', '{YOUR_FCM_API_KEY}') # TODO: Insert FCM API key here
+# Route Planning services (timeouts in secs, may be overridden per site)
+ROUTE_PLANNER_TIMEOUT = float(os.environ.get('ROUTE_PLANNER_TIMEOUT', 38))
+ROUTE_PLANNER_CONNECT_TIMEOUT = float(os.environ.get('ROUTE_PLANNER_CONNECT_TIMEOUT', 3.05))
+ROUTE_PLANNER_POOL_SIZE = int(os.environ.get('ROUTE_PLANNER_POOL_SIZE', 10))
+# Cache of Route Planning answers: 'mongo' (shared by all workers), 'local'
+# (per worker) or 'none'
+ROUTE_PLAN_CACHE = os.environ.get('ROUTE_PLAN_CACHE', 'mongo')
+ROUTE_PLAN_CACHE_TTL = int(os.environ.get('ROUTE_PLAN_CACHE_TTL', 300))
+ROUTE_PLAN_CACHE_SIZE = int(os.environ.get('ROUTE_PLAN_CACHE_SIZE', 1000))
+# Verified credentials and item owners are cached per worker for this long
+# (secs); changes made through the API are seen immediately by the worker that
+# handled them
+AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 60))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+# Responses of rides_boundary are cached per worker until a ride of their site
+# changes, but at most for this long (secs). The cache holds at most
+# RIDES_BOUNDARY_CACHE_SIZE responses and RIDES_BOUNDARY_CACHE_BYTES bytes;
+# responses larger than RIDES_BOUNDARY_CACHE_ENTRY_BYTES are not cached.
+RIDES_BOUNDARY_CACHE_TTL = int(os.environ.get('RIDES_BOUNDARY_CACHE_TTL', 300))
+RIDES_BOUNDARY_CACHE_SIZE = int(os.environ.get('RIDES_BOUNDARY_CACHE_SIZE', 1000))
+RIDES_BOUNDARY_CACHE_BYTES = int(os.environ.get('RIDES_BOUNDARY_CACHE_BYTES', 32 * 1024 * 1024))
+RIDES_BOUNDARY_CACHE_ENTRY_BYTES = int(os.environ.get('RIDES_BOUNDARY_CACHE_ENTRY_BYTES', 1024 * 1024))
+# Push notifications are delivered by this many threads per worker; at most
+# NOTIFICATION_QUEUE_SIZE notifications wait to be delivered, and failed ones
+# are retried NOTIFICATION_RETRIES times (after NOTIFICATION_BACKOFF secs,
+# doubled on every retry)
+NOTIFICATION_WORKERS = int(os.environ.get('NOTIFICATION_WORKERS', 4))
+NOTIFICATION_QUEUE_SIZE = int(os.environ.get('NOTIFICATION_QUEUE_SIZE', 1000))
+NOTIFICATION_RETRIES = int(os.environ.get('NOTIFICATION_RETRIES', 3))
+NOTIFICATION_BACKOFF = float(os.environ.get('NOTIFICATION_BACKOFF', 0.5))
+# Max number of queued notifications a notification thread delivers at once
+NOTIFICATION_BATCH_SIZE = int(os.environ.get('NOTIFICATION_BATCH_SIZE', 50))
+# Notifications to the same connector service are posted in requests of up to
+# FCM_RECIPIENTS_PER_REQUEST notifications. The FCM connector takes a single
+# recipient ('to') per request, so with it each notification is a request
+FCM_RECIPIENTS_PER_REQUEST = 1
+# Requests and their responses are logged with probability LOG_SAMPLE_RATE and
+# their bodies truncated to LOG_BODY_MAX_SIZE bytes. Requests to any of the
+# (comma separated) LOG_EXCLUDED_RESOURCES are never logged. At most
+# LOG_QUEUE_SIZE records wait to be written to the log file.
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1.0))
+LOG_BODY_MAX_SIZE = int(os.environ.get('LOG_BODY_MAX_SIZE', 4096))
+LOG_EXCLUDED_RESOURCES = [ resource for resource in os.environ.get('LOG_EXCLUDED_RESOURCES', '').split(',') if resource ]
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Every worker writes a snapshot of its metrics to METRICS_DIR at most every
+# METRICS_INTERVAL secs; /metrics adds up the snapshots of all workers
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'socialcar-metrics'))
+METRICS_INTERVAL = float(os.environ.get('METRICS_INTERVAL', 5))
 
 # Disable XML support (use only JSON)
 XML = False
@@ -64,18 +114,29 @@ OPLOG = False
 # document will be sent.
 BANDWIDTH_SAVER = False
 
-# Enable pagination for GET requests.
+# Enable pagination for GET requests. Only resources that can grow without
+# bounds (e.g. positions) are paginated. Pages are not numbered: each response
+# of a paginated resource that may be followed by more items has a
+# 'X-Next-Cursor' header, and the next page is requested with query parameter
+# 'cursor' set to it (keyset pagination on '_id'). Clients of these resources
+# only get all items by following the cursors (see Pagination in README.md).
 PAGINATION = False
 # Each GET request returns at most these many objects
-PAGINATION_DEFAULT = 50
+PAGINATION_DEFAULT = 500
 # User can change the number of objects return on GET request using query
-# parameter 'max_results' (e.g., &max_results=30). Values exceeding this
-# pagination limit will be silently replaced with this value.
-PAGINATION_LIMIT = 100
-# Key for the pages query parameter
+# parameter 'limit' (e.g., &limit=30). Values exceeding this pagination limit
+# will be silently replaced with this value.
+PAGINATION_LIMIT = 1000
+# Key for the pages query parameter (ignored, pages are found by cursor)
 QUERY_PAGE = 'page'
 # Key for the max results query parameter.
 QUERY_MAX_RESULTS = 'limit'
+# Key for the cursor query parameter
+QUERY_CURSOR = 'cursor'
+# Key for the query parameter selecting the fields returned by custom endpoints
+QUERY_FIELDS = 'fields'
+# Don't count all items of paginated resources on every request
+OPTIMIZE_PAGINATION_FOR_SPEED = True
 
 # Enable Embedded Resource Serialization: if a document field is referencing
 # a document in another resource, clients can request the referenced document
@@ -440,6 +501,22 @@ rides = {
             'type': 'dict',
             'required': False,
         },
+        'start_geometry': {
+            'type': 'point',
+            'required': False,  # Added by server
+            'readonly': True,  # Automatically updated by server
+        },
+        'end_geometry': {
+            'type': 'point',
+            'required': False,  # Added by server
+            'readonly': True,  # Automatically updated by server
+        },
+    },
+    'mongo_indexes': {
+        'start_geometry_2dsphere': [ ('start_geometry', pymongo.GEOSPHERE) ],
+        'end_geometry_2dsphere': [ ('end_geometry', pymongo.GEOSPHERE) ],
+        'activated_deleted_date': [ ('activated', pymongo.ASCENDING), ('_deleted', pymongo.ASCENDING),
+                                    ('date', pymongo.ASCENDING) ],
     },
 }
 
@@ -688,6 +765,20 @@ lifts = {
             'schema': point_date_address_schema,
             'required': True,
         },
+        'start_geometry': {
+            'type': 'point',
+            'required': False,  # Added by server
+            'readonly': True,  # Automatically updated by server
+        },
+        'end_geometry': {
+            'type': 'point',
+            'required': False,  # Added by server
+            'readonly': True,  # Automatically updated by server
+        },
+    },
+    'mongo_indexes': {
+        'start_geometry_2dsphere': [ ('start_geometry', pymongo.GEOSPHERE) ],
+        'end_geometry_2dsphere': [ ('end_geometry', pymongo.GEOSPHERE) ],
     },
 }
 
@@ -910,7 +1001,12 @@ positions = {
             'type': date_type,
             'required': True,
         },
-    }
+    },
+    'pagination': True,
+    'datasource': {
+        # Keyset pagination needs items sorted by _id
+        'default_sort': [ ('_id', pymongo.ASCENDING) ],
+    },
 }
 
 #===============================================================================
@@ -964,6 +1060,19 @@ sites = {
             'type': 'string',
             'required': True,
         },
+        # Additional Route Planning services queried together with 'url'
+        'extra_urls': {
+            'type': 'list',
+            'schema': {
+                'type': 'string',
+            },
+            'required': False,
+        },
+        # Read timeout (secs) of the Route Planning services of this site
+        'route_planner_timeout': {
+            'type': 'float',
+            'required': False,
+        },
         'bounding_box': {
             'type': 'dict',
             'schema': {
@@ -1030,6 +1139,9 @@ sites = {
                     'type': 'string',
                     'required': True,
                 },
+                'tariffs': {
+                    'type': 'dict',
+                },
             }
         },
         'external_carpooling': {
@@ -1263,6 +1375,11 @@ messages = {
             'required': True,
         },
     },
+    'pagination': True,
+    'datasource': {
+        # Keyset pagination needs items sorted by _id
+        'default_sort': [ ('_id', pymongo.ASCENDING) ],
+    },
 }
 
 #===============================================================================
@@ -1326,3 +1443,24 @@ DOMAIN = {
     'eta_notify': eta_notify,
     'positions_button': positions_button,
 }
+
+# Fields (besides '_id') resources can be searched by, e.g. GET
+# /lifts?driver_id=x,y. A '_$op' suffix searches with operator $op instead of
+# $in, e.g. GET /positions?user_id=x&timestamp_$gt=1488793728
+RESOURCE_SEARCH_FIELDS = {
+    'users': [ 'email', 'social_provider.social_id', 'social_provider.social_network' ],
+    'rides': [ 'driver_id' ],
+    'lifts': [ 'driver_id', 'passenger_id' ],
+    'feedbacks': [ 'role', 'reviewer_id', 'reviewed_id', 'date_$gt', 'lift_id' ],
+    'positions': [ 'user_id', 'timestamp_$gt', 'timestamp_$lt' ],
+    'destinations': [ 'user_id' ],
+    'sites': [ 'name' ],
+    'messages': [ 'sender_id', 'receiver_id', 'lift_id' ],
+}
+
+# Every search field is indexed (Eve creates the indexes at startup), also in
+# the order of the pages of paginated resources
+for resource, search_fields in RESOURCE_SEARCH_FIELDS.items():
+    DOMAIN[resource].setdefault('mongo_indexes', {}).update(search_indexes(search_fields))
+    if DOMAIN[resource].get('pagination'):
+        DOMAIN[resource]['mongo_indexes'].update(page_indexes(search_fields))
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import math
+import threading
+import time
+from socialcar.utils import inside_bounding_box, slugify
+
+# Size (in degrees) of the cells of the grid used to index site bounding boxes
+SITES_GRID_CELL_SIZE = 0.5
+
+# Every worker re-reads the 'sites' collection at most this often (secs)
+SITES_REFRESH_INTERVAL = 60
+
+# Only the fields that do not change while serving requests are kept in memory;
+# counters such as 'ride_details' or 'carpooling_info' are always read from and
+# written to db.
+SITES_PROJECTION = { 'name': 1, 'url': 1, 'extra_urls': 1, 'route_planner_timeout': 1,
+                     'bounding_box': 1, 'price_info': 1 }
+
+#===============================================================================
+# SiteRegistry ()
+#===============================================================================
+class SiteRegistry(object):
+    """
+    In-process registry of the sites stored in db. Sites are loaded once per
+    worker and indexed on a regular lat/lon grid, so that finding the site that
+    contains a pair of points costs no db round-trip. Sites are also indexed by
+    the slug of their name (see find_by_slug()). The registry reloads
+    itself every 'refresh_interval' seconds, or on the next lookup after
+    invalidate() is called (e.g. from the Eve hooks of resource 'sites').
+
+    Args:
+        get_collection: function returning the 'sites' collection
+        cell_size: size of grid cells in degrees
+        refresh_interval: max age of the loaded sites (secs)
+    """
+    def __init__(self, get_collection, cell_size=SITES_GRID_CELL_SIZE,
+                 refresh_interval=SITES_REFRESH_INTERVAL):
+        self.get_collection = get_collection
+        self.cell_size = cell_size
+        self.refresh_interval = refresh_interval
+        # (sites, grid, slugs), replaced as a whole so lookups never mix
+        # the sites and indexes of two different loads
+        self.index = None
+        self.fingerprint = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    #---------------------------------------------------------------------------
+    # invalidate ()
+    #---------------------------------------------------------------------------
+    def invalidate(self, *args):
+        # Accepts (and ignores) any arguments, so it can be used as Eve hook
+        self.loaded_at = None
+
+    #---------------------------------------------------------------------------
+    # load ()
+    #---------------------------------------------------------------------------
+    def load(self, sites):
+        """
+        Replace the registry contents with 'sites' (list of site documents).
+
+        Examples:
+        >>> r = SiteRegistry(None)
+        >>> r.load([{'_id': 1, 'name': 'A', 'bounding_box': {'min_lat': 50.6, 'min_lon': 3.9, 'max_lat': 51.0, 'max_lon': 4.7}}])
+        >>> r.find(50.8, 4.3, 50.9, 4.4)['name']
+        'A'
+        >>> r.find(50.8, 4.3, 52.0, 4.4) is None
+        True
+        """
+        grid = {}
+        for position, site in enumerate(sites):
+            for cell in self.cells(site['bounding_box']):
+                grid.setdefault(cell, []).append(position)
+        self.index = (sites, grid, self.index_slugs(sites))
+        self.fingerprint = self.compute_fingerprint(sites)
+        self.loaded_at = time.time()
+
+    #---------------------------------------------------------------------------
+    # refresh ()
+    #---------------------------------------------------------------------------
+    def refresh(self):
+        # Only one thread of the worker hits the db; the others keep using the
+        # previous (still consistent) sites and index meanwhile, or wait for
+        # the first ones to be loaded
+        if not self.lock.acquire(self.index is None):
+            return
+        try:
+            if self.index is not None and not self.stale():
+                return
+            sites = list(self.get_collection().find({}, SITES_PROJECTION))
+            if self.compute_fingerprint(sites) != self.fingerprint:
+                self.load(sites)
+            else:
+                self.loaded_at = time.time()
+        finally:
+            self.lock.release()
+
+    #---------------------------------------------------------------------------
+    # ensure_fresh ()
+    #---------------------------------------------------------------------------
+    def ensure_fresh(self):
+        # Returns the current (sites, grid, slugs)
+        if self.index is None or self.stale():
+            self.refresh()
+        return self.index or ([], {}, {})
+
+    #---------------------------------------------------------------------------
+    # stale ()
+    #---------------------------------------------------------------------------
+    def stale(self):
+        return self.loaded_at is None or \
+               time.time() - self.loaded_at > self.refresh_interval
+
+    #---------------------------------------------------------------------------
+    # index_slugs ()
+    #---------------------------------------------------------------------------
+    @staticmethod
+    def index_slugs(sites):
+        # Sites are found by the slug of their name or, if no other site has it,
+        # by any of its words (e.g. 'ticino' for 'Canton Ticino')
+        slugs = {}
+        words = {}
+        for site in sites:
+            slug = slugify(site['name'])
+            slugs[slug] = site
+            for word in slug.split('-'):
+                words.setdefault(word, []).append(site)
+        for word, found in words.items():
+            if len(found) == 1 and word not in slugs:
+                slugs[word] = found[0]
+        return slugs
+
+    #---------------------------------------------------------------------------
+    # compute_fingerprint ()
+    #---------------------------------------------------------------------------
+    @staticmethod
+    def compute_fingerprint(sites):
+        return tuple(sorted(repr(sorted(site.items())) for site in sites))
+
+    #---------------------------------------------------------------------------
+    # cell ()
+    #---------------------------------------------------------------------------
+    def cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lon / self.cell_size)))
+
+    #---------------------------------------------------------------------------
+    # cells ()
+    #---------------------------------------------------------------------------
+    def cells(self, bounding_box):
+        min_row, min_col = self.cell(bounding_box['min_lat'], bounding_box['min_lon'])
+        max_row, max_col = self.cell(bounding_box['max_lat'], bounding_box['max_lon'])
+        return [ (row, col) for row in range(min_row, max_row + 1)
+                            for col in range(min_col, max_col + 1) ]
+
+    #---------------------------------------------------------------------------
+    # find_all ()
+    #---------------------------------------------------------------------------
+    def find_all(self, start_lat, start_lon, end_lat, end_lon):
+        """
+        Return all sites whose bounding box contains both the start and end
+        points, in the order they are stored in db.
+        """
+        sites, grid, _ = self.ensure_fresh()
+        candidates = grid.get(self.cell(start_lat, start_lon), [])
+        found = []
+        for position in candidates:
+            bb = sites[position]['bounding_box']
+            if inside_bounding_box(bb['min_lat'], bb['min_lon'], bb['max_lat'], bb['max_lon'],
+                                   start_lat, start_lon, end_lat, end_lon):
+                found.append(sites[position])
+        return found
+
+    #---------------------------------------------------------------------------
+    # find ()
+    #---------------------------------------------------------------------------
+    def find(self, start_lat, start_lon, end_lat, end_lon):
+        """
+        Return the site whose bounding box contains both the start and end
+        points, or None. If sites overlap, the last one stored in db wins.
+        """
+        found = self.find_all(start_lat, start_lon, end_lat, end_lon)
+        return found[-1] if found else None
+
+    #---------------------------------------------------------------------------
+    # find_by_slug ()
+    #---------------------------------------------------------------------------
+    def find_by_slug(self, slug):
+        """
+        Return the site whose name matches 'slug', or None.
+
+        Examples:
+        >>> r = SiteRegistry(None)
+        >>> bb = {'min_lat': 0, 'min_lon': 0, 'max_lat': 1, 'max_lon': 1}
+        >>> r.load([{'name': 'Canton Ticino', 'bounding_box': bb}, {'name': 'Brussels', 'bounding_box': bb}])
+        >>> r.find_by_slug('ticino')['name'], r.find_by_slug('canton-ticino')['name']
+        ('Canton Ticino', 'Canton Ticino')
+        >>> r.find_by_slug('Brussels')['name']
+        'Brussels'
+        >>> r.find_by_slug('edinburgh') is None
+        True
+        """
+        _, _, slugs = self.ensure_fresh()
+        return slugs.get(slugify(slug))
+
+#===============================================================================
+# SiteCounters ()
+#===============================================================================
+class SiteCounters(object):
+    """
+    Accumulates the statistics of a site during a request (e.g. 'ride_details'
+    counters, 'users' and 'external_carpooling' entries) and writes them with a
+    single atomic update, so concurrent requests never overwrite each other's
+    counts and list fields cannot grow with duplicates.
+
+    Examples:
+    >>> c = SiteCounters(1)
+    >>> c.inc('ride_details.internal')
+    >>> c.inc('ride_details.internal')
+    >>> c.add_to_set('users', 'a@mail.com')
+    >>> c.add_to_set('users', 'a@mail.com')
+    >>> c.update_spec() == {'$inc': {'ride_details.internal': 2}, '$addToSet': {'users': {'$each': ['a@mail.com']}}}
+    True
+    """
+    def __init__(self, site_id):
+        self.site_id = site_id
+        self.increments = {}
+        self.additions = {}
+
+    #---------------------------------------------------------------------------
+    # inc ()
+    #---------------------------------------------------------------------------
+    def inc(self, field, amount=1):
+        self.increments[field] = self.increments.get(field, 0) + amount
+
+    #---------------------------------------------------------------------------
+    # add_to_set ()
+    #---------------------------------------------------------------------------
+    def add_to_set(self, field, value):
+        values = self.additions.setdefault(field, [])
+        if value not in values:
+            values.append(value)
+
+    #---------------------------------------------------------------------------
+    # update_spec ()
+    #---------------------------------------------------------------------------
+    def update_spec(self):
+        spec = {}
+        if self.increments:
+            spec['$inc'] = dict(self.increments)
+        if self.additions:
+            spec['$addToSet'] = { field: {'$each': values}
+                                  for field, values in self.additions.items() }
+        return spec
+
+    #---------------------------------------------------------------------------
+    # flush ()
+    #---------------------------------------------------------------------------
+    def flush(self, collection):
+        spec = self.update_spec()
+        if spec:
+            collection.update({'_id': self.site_id}, spec, upsert = False)
+        self.increments = {}
+        self.additions = {}
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 import json
+import base64
+import binascii
 import datetime
 import polyline
 import hashlib
 import re
+import unicodedata
 from bson import ObjectId
-from math import radians, cos, sin, asin, sqrt
+from math import radians, degrees, cos, sin, asin, atan, sqrt, floor, ceil
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 EARTH_RADIUS_KM = 6371.0
 
@@ -58,6 +65,47 @@ def json_to_str(d):
         raise TypeError('Argument not a list or dict')
     return json.dumps(d)
 
+#===============================================================================
+# payload_to_json ()
+#===============================================================================
+def payload_to_json(s):
+    """
+    Deserialize a JSON response payload 's' (bytes or str), with orjson if it
+    is installed.
+
+    Examples:
+    >>> payload_to_json(b'{"a": [1, 2], "b": "c"}') == {'a': [1, 2], 'b': 'c'}
+    True
+    """
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s.decode() if isinstance(s, bytes) else s)
+
+#===============================================================================
+# json_to_payload ()
+#===============================================================================
+def json_to_payload(d):
+    """
+    Serialize dict or list 'd' to a compact JSON response payload, with orjson
+    if it is installed.
+
+    Raises:
+        TypeError: 'd' is not a list or dict, or cannot be serialized
+
+    Examples:
+    >>> payload_to_json(json_to_payload({'a': 1, 'c': {'d': [3]}})) == {'a': 1, 'c': {'d': [3]}}
+    True
+    >>> json_to_payload({1})
+    Traceback (most recent call last):
+        ...
+    TypeError: Argument not a list or dict
+    """
+    if not isinstance(d, dict) and not isinstance(d, list):
+        raise TypeError('Argument not a list or dict')
+    if orjson is not None:
+        return orjson.dumps(d, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(d, separators=(',', ':'))
+
 #===============================================================================
 # str_to_oid ()
 #===============================================================================
@@ -106,6 +154,46 @@ def oid_to_str(oid):
         raise TypeError('Argument not an ObjectId')
     return str(oid)
 
+#===============================================================================
+# oid_to_cursor ()
+#===============================================================================
+def oid_to_cursor(oid):
+    """
+    Serialize the ObjectId (or its string) of the last item of a page to an
+    opaque pagination cursor.
+
+    Examples:
+    >>> oid_to_cursor('582431a6a377f26970c543b3')
+    'WCQxpqN38mlwxUOz'
+    """
+    return base64.urlsafe_b64encode(bytes.fromhex(str(oid))).decode()
+
+#===============================================================================
+# cursor_to_oid ()
+#===============================================================================
+def cursor_to_oid(cursor):
+    """
+    Deserialize a pagination cursor to the ObjectId it was created from.
+
+    Raises:
+        ValueError: 'cursor' is not a valid cursor
+
+    Examples:
+    >>> cursor_to_oid('WCQxpqN38mlwxUOz')
+    ObjectId('582431a6a377f26970c543b3')
+    >>> cursor_to_oid('abc')
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid cursor abc
+    """
+    try:
+        oid = base64.urlsafe_b64decode(cursor.encode())
+    except (binascii.Error, ValueError):
+        oid = None
+    if oid is None or len(oid) != 12:
+        raise ValueError('Invalid cursor %s' % (cursor))
+    return ObjectId(oid.hex())
+
 #===============================================================================
 # apply_function ()
 #===============================================================================
@@ -204,49 +292,54 @@ def remove_fields(d, fields):
             d.pop(field, None)
 
 #===============================================================================
-# recursively_remove_fields ()
+# clean_object ()
 #===============================================================================
-def recursively_remove_fields(obj, fields):
+def clean_object(obj, fields, item_fields=()):
     """
-    Remove from dict 'd' (and all embedded dicts) all keys in list 'fields'.
+    Remove from all dicts in object 'obj' the keys in list 'fields', remove
+    from its items (the dicts in list 'obj', or dict 'obj' itself) the keys in
+    list 'item_fields', and convert all ObjectIds to str. Walks 'obj' only once
+    and without recursion.
 
     Args:
-        d: a dict
+        obj: object to clean. Must be a list or dict.
         fields: list of keys to remove
-    Returns:
-        None
+        item_fields: list of keys to remove from the items only
+    Raises:
+        TypeError: 'obj' is not a list or dict
 
     Examples:
-    >>> d = {'a': 1, 'b': 2, 'c': {'d': 3}}
-    >>> recursively_remove_fields(d, ['a', 'd'])
-    >>> d == {'b': 2, 'c': {}}
+    >>> d = {'a': ObjectId('582431a6a377f26970c543b3'), 'x': 1, 'b': [{'x': 2, 'c': ObjectId('582431a6a377f26970c543b2')}]}
+    >>> clean_object(d, ['x'])
+    >>> d == {'a': '582431a6a377f26970c543b3', 'b': [{'c': '582431a6a377f26970c543b2'}]}
     True
-    """
-    traverse_object(obj, remove_fields, fields)
-
-#===============================================================================
-# objectids_to_strings ()
-#===============================================================================
-def objectids_to_strings(obj):
-    """
-    Convert all fields and subfields of object 'obj' that are ObjectIds to str.
-
-    Examples:
-    >>> d = {'a': ObjectId('582431a6a377f26970c543b3'), 'b': {'d': [1, ObjectId('582431a6a377f26970c543b2')]}}
-    >>> objectids_to_strings(d)
-    >>> d == {'a': '582431a6a377f26970c543b3', 'b': {'d': [1, '582431a6a377f26970c543b2']}}
+    >>> l = [{'p': 1, 'x': 2, 'b': {'p': 3}}]
+    >>> clean_object(l, ['x'], ['p'])
+    >>> l == [{'b': {'p': 3}}]
     True
     """
-    def func(obj):
-        if isinstance(obj, list):
-            for i in range(len(obj)):
-                if isinstance(obj[i], ObjectId):
-                    obj[i] = oid_to_str(obj[i])
-        elif isinstance(obj, dict):
-            for key in obj:
-                if isinstance(obj[key], ObjectId):
-                    obj[key] = oid_to_str(obj[key])
-    traverse_object(obj, func)
+    if not isinstance(obj, list) and not isinstance(obj, dict):
+        raise TypeError('Argument not a list or dict')
+    # The stack holds (object, kind), kind being 'items' for list 'obj',
+    # 'item' for its items and None for anything else
+    stack = [ (obj, 'items' if isinstance(obj, list) else 'item') ]
+    while stack:
+        obj, kind = stack.pop()
+        if isinstance(obj, dict):
+            for field in fields:
+                obj.pop(field, None)
+            if kind == 'item':
+                for field in item_fields:
+                    obj.pop(field, None)
+            values = obj.items()
+        else:
+            values = enumerate(obj)
+        value_kind = 'item' if kind == 'items' else None
+        for key, value in values:
+            if isinstance(value, dict) or isinstance(value, list):
+                stack.append((value, value_kind))
+            elif isinstance(value, ObjectId):
+                obj[key] = str(value)
 
 #===============================================================================
 # strings_to_objectids ()
@@ -343,6 +436,211 @@ def find_site_for_rides(bb_minlat, bb_minlon, bb_maxlat, bb_maxlon, start_lat, s
     return (bb_minlat <= start_lat <= bb_maxlat and bb_minlon <= start_lon <= bb_maxlon) or \
             (bb_minlat <= end_lat <= bb_maxlat and bb_minlon <= end_lon <= bb_maxlon)   
 
+#===============================================================================
+# point_to_geometry ()
+#===============================================================================
+def point_to_geometry(point):
+    """
+    Convert a {'lat', 'lon'} point to a GeoJSON Point, which can be 2dsphere
+    indexed.
+
+    Examples:
+    >>> point_to_geometry({'lat': 50.85, 'lon': 4.35})
+    {'type': 'Point', 'coordinates': [4.35, 50.85]}
+    """
+    return { 'type': 'Point', 'coordinates': [ float(point['lon']), float(point['lat']) ] }
+
+#===============================================================================
+# bounding_box_to_geometry ()
+#===============================================================================
+def bounding_box_to_geometry(bb_minlat, bb_minlon, bb_maxlat, bb_maxlon):
+    """
+    Convert a bounding box to a GeoJSON Polygon, to be used with $geoWithin.
+    Note that MongoDB takes the edges of the polygon to be geodesics, so for
+    large boxes points very close to the min/max latitude may differ from a
+    plain comparison of coordinates.
+
+    Examples:
+    >>> bounding_box_to_geometry(50.7, 4.2, 50.9, 4.5)['coordinates']
+    [[[4.2, 50.7], [4.5, 50.7], [4.5, 50.9], [4.2, 50.9], [4.2, 50.7]]]
+    """
+    return {
+        'type': 'Polygon',
+        'coordinates': [ [ [ bb_minlon, bb_minlat ], [ bb_maxlon, bb_minlat ], [ bb_maxlon, bb_maxlat ],
+                           [ bb_minlon, bb_maxlat ], [ bb_minlon, bb_minlat ] ] ],
+    }
+
+#===============================================================================
+# widen_bounding_box ()
+#===============================================================================
+def widen_bounding_box(bb_minlat, bb_minlon, bb_maxlat, bb_maxlon, digits=4):
+    """
+    Round the bounding box to 'digits' decimals, rounding min coordinates
+    down and max coordinates up, so the rounded box always contains the
+    original one.
+
+    Examples:
+    >>> widen_bounding_box(45.12346, 8.98761, 46.00004, 9.5)
+    (45.1234, 8.9876, 46.0001, 9.5)
+    """
+    scale = 10 ** digits
+    return (floor(bb_minlat * scale) / scale, floor(bb_minlon * scale) / scale,
+            ceil(bb_maxlat * scale) / scale, ceil(bb_maxlon * scale) / scale)
+
+# GeoJSON fields of each resource, and the path of the {'lat', 'lon'} point
+# each of them is computed from
+GEOMETRY_FIELDS = {
+    'rides': { 'start_geometry': [ 'start_point' ], 'end_geometry': [ 'end_point' ] },
+    'lifts': { 'start_geometry': [ 'start_point', 'point' ], 'end_geometry': [ 'end_point', 'point' ] },
+}
+
+#===============================================================================
+# geometry_fields ()
+#===============================================================================
+def geometry_fields(resource, item, original=None):
+    """
+    Return the GeoJSON fields of 'item' of 'resource' that must be (re)set
+    because its points are new or changed. For updates, 'item' holds the
+    updated fields and 'original' the item before the update.
+
+    Examples:
+    >>> geometry_fields('lifts', {'start_point': {'point': {'lat': 1, 'lon': 2}, 'date': 0}})
+    {'start_geometry': {'type': 'Point', 'coordinates': [2.0, 1.0]}}
+    >>> geometry_fields('rides', {'end_point': {'lat': 3}}, {'end_point': {'lat': 1, 'lon': 2}})
+    {'end_geometry': {'type': 'Point', 'coordinates': [2.0, 3.0]}}
+    >>> geometry_fields('users', {'name': 'a'})
+    {}
+    """
+    fields = {}
+    for field, path in GEOMETRY_FIELDS.get(resource, {}).items():
+        point, original_point = item, original or {}
+        for key in path:
+            point = point.get(key) if isinstance(point, dict) else None
+            original_point = original_point.get(key) if isinstance(original_point, dict) else None
+        if point is None:
+            continue
+        # Updates may change only some of the coordinates
+        fields[field] = point_to_geometry(dict(original_point or {}, **point))
+    return fields
+
+#===============================================================================
+# geodesic_margin ()
+#===============================================================================
+def geodesic_margin(bb_minlon, bb_maxlon):
+    """
+    Return the max distance (in degrees of latitude) between a parallel and
+    the geodesic joining two of its points 'bb_minlon' and 'bb_maxlon' apart.
+    Geodesics bulge towards the pole, the most at latitude 45.
+
+    Examples:
+    >>> round(geodesic_margin(8.5, 9.5), 5)
+    0.00109
+    """
+    k = 1 / cos(radians(bb_maxlon - bb_minlon) / 2)
+    return degrees(2 * atan(sqrt(k))) - 90
+
+#===============================================================================
+# bounding_box_lookup ()
+#===============================================================================
+def bounding_box_lookup(resource, geometry_field, bb_minlat, bb_minlon, bb_maxlat, bb_maxlon):
+    """
+    Return the lookup of the items of 'resource' whose point of GeoJSON field
+    'geometry_field' (see GEOMETRY_FIELDS) is inside the bounding box, with
+    the same result as comparing the lat/lon of the point. $geoWithin uses the
+    2dsphere index to find the items inside a polygon widened so that its
+    geodesic edges contain the whole box; the lat/lon ranges of the point
+    then drop the ones outside of it.
+
+    Examples:
+    >>> lookup = bounding_box_lookup('lifts', 'start_geometry', 45.9, 8.5, 46.4, 9.5)
+    >>> lookup['$and'][1:]
+    [{'start_point.point.lat': {'$gte': 45.9, '$lte': 46.4}}, {'start_point.point.lon': {'$gte': 8.5, '$lte': 9.5}}]
+    """
+    margin = geodesic_margin(bb_minlon, bb_maxlon)
+    geometry = bounding_box_to_geometry(max(bb_minlat - margin, -90), bb_minlon, min(bb_maxlat + margin, 90), bb_maxlon)
+    point = '.'.join(GEOMETRY_FIELDS[resource][geometry_field])
+    return { '$and': [ { geometry_field: { '$geoWithin': { '$geometry': geometry } } },
+                       { point + '.lat': { '$gte': bb_minlat, '$lte': bb_maxlat } },
+                       { point + '.lon': { '$gte': bb_minlon, '$lte': bb_maxlon } } ] }
+
+#===============================================================================
+# search_indexes ()
+#===============================================================================
+def search_indexes(search_fields):
+    """
+    Return the mongo_indexes needed by the search fields of a resource (see
+    RESOURCE_SEARCH_FIELDS in settings.py). Fields compared by equality get an
+    index each; fields compared with a range operator (e.g. 'date_$gt') get
+    an index of their own and follow every equality field in a compound
+    index, so equality and range can be searched together.
+
+    Examples:
+    >>> sorted(search_indexes([ 'user_id', 'timestamp_$gt', 'timestamp_$lt' ]).items())
+    [('search_timestamp', [('timestamp', 1)]), ('search_user_id_timestamp', [('user_id', 1), ('timestamp', 1)])]
+    >>> search_indexes([ 'social_provider.social_id' ])
+    {'search_social_provider.social_id': [('social_provider.social_id', 1)]}
+    """
+    equality_fields = [ field for field in search_fields if '_$' not in field ]
+    range_fields = []
+    for field in search_fields:
+        if '_$' in field and field.split('_$')[0] not in range_fields:
+            range_fields.append(field.split('_$')[0])
+    indexes = {}
+    for field in range_fields:
+        indexes['search_%s' % (field)] = [ (field, 1) ]
+    for field in equality_fields:
+        if not range_fields:
+            indexes['search_%s' % (field)] = [ (field, 1) ]
+        for range_field in range_fields:
+            indexes['search_%s_%s' % (field, range_field)] = [ (field, 1), (range_field, 1) ]
+    return indexes
+
+#===============================================================================
+# page_indexes ()
+#===============================================================================
+def page_indexes(search_fields):
+    """
+    Return the mongo_indexes needed to page through the search results of a
+    paginated resource: pages are sorted by _id, so every field compared by
+    equality is followed by _id in a compound index. Pages are then read in
+    index order, and a search examines only about one page of items.
+
+    Examples:
+    >>> page_indexes([ 'user_id', 'timestamp_$gt', 'timestamp_$lt' ])
+    {'page_user_id': [('user_id', 1), ('_id', 1)]}
+    """
+    return { 'page_%s' % (field): [ (field, 1), ('_id', 1) ]
+             for field in search_fields if '_$' not in field }
+
+#===============================================================================
+# unindexed_search_fields ()
+#===============================================================================
+def unindexed_search_fields(search_fields, index_information):
+    """
+    Return the search fields of a resource that no index of its collection
+    ('index_information' as returned by pymongo) can be used for: equality
+    fields must be the first key of an index, range fields the first key or
+    the key following an equality search field.
+
+    Examples:
+    >>> indexes = {'_id_': {'key': [('_id', 1)]}, 'a': {'key': [('user_id', 1), ('date', 1)]}}
+    >>> unindexed_search_fields([ 'user_id', 'date_$gt', 'timestamp_$lt', 'role' ], indexes)
+    ['timestamp', 'role']
+    """
+    equality_fields = [ field for field in search_fields if '_$' not in field ]
+    indexed = set()
+    for index in index_information.values():
+        keys = [ key for key, _ in index['key'] ]
+        indexed.add(keys[0])
+        if len(keys) > 1 and keys[0] in equality_fields:
+            indexed.add(keys[1])
+    unindexed = []
+    for field in search_fields:
+        field = field.split('_$')[0]
+        if field not in indexed and field not in unindexed:
+            unindexed.append(field)
+    return unindexed
+
 #===============================================================================
 # remove_non_ascii()
 #===============================================================================
@@ -356,6 +654,22 @@ def remove_non_ascii(s):
     """
     return re.sub(r'[^\x00-\x7F]+',' ', s)
 
+#===============================================================================
+# slugify ()
+#===============================================================================
+def slugify(s):
+    """
+    Lowercase ASCII version of 's' with words separated by dashes.
+
+    Examples:
+    >>> slugify('Canton Ticino')
+    'canton-ticino'
+    >>> slugify(' Zürich (ZH) ')
+    'zurich-zh'
+    """
+    s = unicodedata.normalize('NFKD', s).encode('ascii', 'ignore').decode()
+    return re.sub(r'[^a-z0-9]+', '-', s.lower()).strip('-')
+
 #===============================================================================
 # waypoints_to_polyline ()
 #===============================================================================